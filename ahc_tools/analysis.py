@@ -0,0 +1,654 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Category grouping and performance comparison of cardiff, split per host
+# and per group so that the results of a previous run can be reused.
+
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import re
+import sys
+import tempfile
+
+from hardware.cardiff import check
+from hardware.cardiff import perf_cpu_tables
+from hardware.cardiff import utils as cardiff_utils
+from oslo_config import cfg
+import six
+
+from ahc_tools import conf  # noqa
+from ahc_tools import outliers
+
+CONF = cfg.CONF
+
+LOG = logging.getLogger('ahc_tools.analysis')
+
+Levels = cardiff_utils.Levels
+
+STATE_FILE = 'report-state.json'
+STATE_VERSION = 4
+
+# Same categories, in the same order, as cardiff.group_systems.
+CATEGORIES = (
+    ('hpa', check.hpa, "HPA Controller"),
+    ('disk', check.physical_hpa_disks, "HPA Disks"),
+    ('megaraid', check.megaraid, "Megaraid Controller"),
+    ('disk', check.physical_hpa_disks, "Megaraid Disks"),
+    ('ahci', check.ahci, "AHCI Controller"),
+    ('ipmi', check.ipmi, "IPMI SDR"),
+    ('system', check.systems, "System"),
+    ('firmware', check.firmware, "Firmware"),
+    ('memory', check.memory_timing, "DDR Timing"),
+    ('network', check.network_interfaces, "Network Interfaces"),
+    ('cpu', check.cpu, "Processors"))
+
+# Same checks, in the same order, as cardiff.compare_performance, with the
+# category of facts each of them reads.
+PERFORMANCE_CHECKS = (
+    ('disk', 'disk'),
+    ('cpu', 'cpu'),
+    ('memory', 'cpu'),
+    ('network', 'network'))
+
+# Elements of the facts the categories and the performance checks read.
+ELEMENTS = frozenset([name for name, _, _ in CATEGORIES] +
+                     [category for _, category in PERFORMANCE_CHECKS])
+
+
+class ReportState(object):
+    """Results of the previous report run, keyed by facts fingerprints.
+
+    Stores, for every host and hardware category, the fingerprint of the
+    facts of the category and the signature of the host, and the items
+    of the performance checks of every group. Categories whose facts did
+    not change reuse their signature, and groups whose hosts all kept the
+    facts read by a check reuse its items.
+    """
+
+    def __init__(self, path=None, unique_id='uuid'):
+        self.path = path
+        self.unique_id = unique_id
+        self.hosts = {}
+        self.performance = {}
+        self._used_performance = set()
+        if path and os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as state_file:
+                data = json.load(state_file)
+        except (IOError, OSError, ValueError) as e:
+            LOG.warning('Ignoring the report state in %s: %s' %
+                        (self.path, e))
+            return
+        if (data.get('version') == STATE_VERSION and
+                data.get('unique_id') == self.unique_id):
+            self.hosts = data['hosts']
+            self.performance = data['performance']
+
+    def save(self):
+        """Write the state atomically, dropping unused performance data."""
+        if not self.path:
+            return
+        data = {'version': STATE_VERSION,
+                'unique_id': self.unique_id,
+                'hosts': self.hosts,
+                'performance': dict(
+                    (key, value) for key, value in self.performance.items()
+                    if key in self._used_performance)}
+        directory = os.path.dirname(self.path)
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            with os.fdopen(fd, 'w') as state_file:
+                json.dump(data, state_file)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as e:
+            LOG.warning('Failed to save the report state in %s: %s' %
+                        (self.path, e))
+
+
+def load_state(unique_id):
+    """Return the ReportState of the facts cache directory.
+
+    The state is only persisted when [cache]/directory is set, otherwise
+    an empty state is returned and everything is computed again.
+    """
+    if not CONF.cache.directory:
+        return ReportState(unique_id=unique_id)
+    if not os.path.isdir(CONF.cache.directory):
+        os.makedirs(CONF.cache.directory)
+    return ReportState(os.path.join(CONF.cache.directory, STATE_FILE),
+                       unique_id)
+
+
+class FactsIndex(object):
+    """Facts of the nodes indexed by host and by element, in one pass.
+
+    The stages of the report read the facts through this index instead
+    of scanning the facts of every node again: the elements are the
+    categories of facts read by the categories and the performance checks,
+    with the same substring match as cardiff.utils.find_sub_element.
+
+    :param facts: list of the facts of each node
+    :param unique_id: fact identifying the hosts, 'uuid' or 'serial'
+    """
+
+    def __init__(self, facts, unique_id):
+        self.unique_id = unique_id
+        # Host and facts per element of each node, in the order of facts.
+        self.nodes = []
+        # All the values of the unique id, as cardiff.get_hosts_list.
+        self.host_set = set()
+        # Fingerprints of the facts of each element, per host.
+        self.fingerprints = dict((element, {}) for element in ELEMENTS)
+        matching = {}
+        for node_facts in facts:
+            host = ''
+            elements = dict((element, []) for element in ELEMENTS)
+            for fact in node_facts:
+                if fact[0] not in matching:
+                    matching[fact[0]] = [element for element in ELEMENTS
+                                         if element in fact[0]]
+                for element in matching[fact[0]]:
+                    elements[element].append(fact)
+                if (fact[0] == 'system' and fact[1] == 'product' and
+                        fact[2] == unique_id):
+                    host = fact[3]
+                    self.host_set.add(host)
+            self.nodes.append((host, elements))
+            for element, element_facts in elements.items():
+                self.fingerprints[element][host] = fingerprint(element_facts)
+
+    def hosts(self):
+        """Return the hosts in the order of their first node."""
+        seen = set()
+        hosts = []
+        for host, _ in self.nodes:
+            if host not in seen:
+                seen.add(host)
+                hosts.append(host)
+        return hosts
+
+    def systems(self, element, hosts=()):
+        """Return the same systems as cardiff.utils.find_sub_element."""
+        return [{self.unique_id: host, element: elements[element]}
+                for host, elements in self.nodes
+                if not hosts or host in hosts]
+
+
+def fingerprint(facts):
+    """Return a fingerprint of a list of facts."""
+    blob = json.dumps(facts, sort_keys=True).encode('utf-8')
+    return hashlib.sha1(blob).hexdigest()
+
+
+def group_categories(index, ignore_list, state, jobs=1):
+    """Group the hosts having identical hardware, category per category.
+
+    Produces the same groups as cardiff.group_systems. Each category is
+    only analyzed again for the hosts whose facts of this category
+    changed since the run recorded in state, the state is updated with
+    their results.
+
+    :param index: FactsIndex of the facts of the nodes
+    :param ignore_list: categories to leave out
+    :param state: ReportState of the previous run
+    :param jobs: number of worker processes analyzing the categories
+    :returns: list of (title, groups) tuples in the order of cardiff,
+        groups mapping the canonical signature of a category, see
+        canonical_signature, to the list of its hosts.
+    """
+    hosts = index.hosts()
+    for host in set(state.hosts) - set(hosts):
+        del state.hosts[host]
+
+    tasks = []
+    for category, (name, _, title) in enumerate(CATEGORIES):
+        if name in ignore_list:
+            continue
+        fingerprints = index.fingerprints[name]
+        changed = [host for host in hosts
+                   if state.hosts.get(host, {}).get(title, {}).get(
+                       'fingerprint') != fingerprints[host]]
+        if changed:
+            tasks.append((category, changed))
+    LOG.debug('Analyzing %d host categories of %d hosts' %
+              (sum(len(changed) for _, changed in tasks), len(hosts)))
+
+    for (category, _), groups in zip(tasks, run_tasks(_group_category, tasks,
+                                                      index, jobs)):
+        name, _, title = CATEGORIES[category]
+        for signature, group in groups.items():
+            for host in group:
+                state.hosts.setdefault(host, {})[title] = {
+                    'fingerprint': index.fingerprints[name][host],
+                    'signature': canonical_signature(signature)}
+
+    categories = []
+    for name, check_func, title in CATEGORIES:
+        if name in ignore_list:
+            continue
+        groups = {}
+        for host in hosts:
+            signature = state.hosts[host][title]['signature']
+            groups.setdefault(signature, []).append(host)
+        categories.append((title, groups))
+    return categories
+
+
+def canonical_signature(signature):
+    """Return a cardiff category signature independent of the hash seed.
+
+    cardiff signs a category with the repr of a set of facts, whose order
+    changes with PYTHONHASHSEED, so the signatures of identical hosts
+    analyzed by different processes may differ. The facts are sorted
+    instead, and the result is still read by compare_sets.print_groups.
+    """
+    return repr(sorted(eval(signature)))
+
+
+def performance_report(index, systems_groups, detail, state, jobs=1,
+                       engine='cardiff'):
+    """Return the performance outliers of each group of hosts.
+
+    Runs the same checks as cardiff.compare_performance. The output of a
+    check on a group is reused from state when the group and the
+    fingerprints of the facts it reads did not change, the other checks
+    run in jobs worker processes.
+
+    :param engine: 'cardiff' to run the checks of cardiff, 'numpy' to run
+        their vectorized versions from ahc_tools.outliers
+    :returns: list of dictionaries with the check, the group number and
+        the items of each check, in the order cardiff prints them. The
+        items are the statistics and the class of each host of every
+        metric, the summaries of the classes and the messages of the
+        check, see PerformanceRecorder. render_performance prints them.
+    """
+    checks = []
+    pending = []
+    for kind, category in PERFORMANCE_CHECKS:
+        for group in systems_groups:
+            group_number = systems_groups.index(group)
+            key = _performance_key(kind, group_number, group,
+                                   index.fingerprints[category], engine)
+            if key not in state.performance:
+                pending.append((key, (kind, category, group, group_number,
+                                      detail, engine)))
+            checks.append((kind, group_number, key))
+    results = run_tasks(_performance_items, [task for _, task in pending],
+                        index, jobs)
+    for (key, _), items in zip(pending, results):
+        state.performance[key] = items
+    report = []
+    for kind, group_number, key in checks:
+        state._used_performance.add(key)
+        report.append({'check': kind,
+                       'group': group_number,
+                       'items': state.performance[key]})
+    return report
+
+
+def compare_performance(index, systems_groups, detail, state, jobs=1,
+                        engine='cardiff'):
+    """Print the performance outliers of each group of hosts.
+
+    Prints the same report as cardiff.compare_performance, see
+    performance_report.
+    """
+    for check_report in performance_report(index, systems_groups, detail,
+                                           state, jobs, engine):
+        render_performance(check_report)
+
+
+class PerformanceRecorder(object):
+    """Records the findings of a performance check as structured items.
+
+    The checks of cardiff and of ahc_tools.outliers print their findings.
+    While a check is recorded, print_perf and print_summary of both are
+    wrapped to keep the statistics and the hosts they are given, and
+    what is printed is collected instead. The items are dictionaries with
+    a type:
+
+    - 'header': the title of the check printed before its first metric
+    - 'metric': min, mean, max and stddev of a metric, its status
+      ('consistent', 'suspicious' or 'unstable'), and the class of each
+      host ('consistent', 'over', 'under' or 'unstable') with the value
+      of the curious ones
+    - 'summary': the hosts of a class, their mean and stddev, and for the
+      consistent hosts of the cpu checks the comparison with the minimum
+      performance of cardiff
+    - 'message': a line printed by the check out of any metric
+    - 'text': the details cardiff prints as tables
+    """
+
+    def __init__(self):
+        self.items = []
+        self._calls = None
+        self._stdout = six.StringIO()
+
+    def record(self, func, *args):
+        """Call func and return the items of what it printed."""
+        patches = [
+            (cardiff_utils, 'do_print', self._do_print),
+            (check, 'print_perf',
+             self._wrap(check.print_perf, self._add_metric,
+                        lambda args: list(args[3].columns))),
+            (check, 'print_summary',
+             self._wrap(check.print_summary, self._add_summary,
+                        lambda args: args[1])),
+            (outliers, 'print_perf',
+             self._wrap(outliers.print_perf, self._add_metric,
+                        lambda args: args[2].hosts)),
+            (outliers, 'print_summary',
+             self._wrap(outliers.print_summary, self._add_summary,
+                        lambda args: args[2]))]
+        saved = [(module, name, getattr(module, name))
+                 for module, name, _ in patches]
+        stdout = sys.stdout
+        sys.stdout = self._stdout
+        try:
+            for module, name, value in patches:
+                setattr(module, name, value)
+            func(*args)
+            self._flush()
+        finally:
+            for module, name, value in saved:
+                setattr(module, name, value)
+            sys.stdout = stdout
+        return self.items
+
+    def _wrap(self, func, add_item, hosts_of):
+        def wrapper(*args, **kwargs):
+            self._flush()
+            self._calls = []
+            try:
+                func(*args, **kwargs)
+                if self._calls:
+                    add_item(self._calls, hosts_of(args), args, kwargs)
+            finally:
+                self._calls = None
+        return wrapper
+
+    def _do_print(self, mode, level, string, *args):
+        # Every level is recorded, render_performance applies print_level.
+        if self._calls is not None:
+            self._calls.append((mode, level, string, args))
+            return
+        self._flush()
+        self.items.append({'type': 'message',
+                           'mode': mode,
+                           'level': Levels.message[level],
+                           'text': string % args})
+
+    def _flush(self):
+        text = self._stdout.getvalue()
+        if not text:
+            return
+        self._stdout.seek(0)
+        self._stdout.truncate()
+        header = re.match(r'\nGroup \d+ : Checking (.*)\n$', text)
+        if header:
+            self.items.append({'type': 'header', 'title': header.group(1)})
+        else:
+            self.items.append({'type': 'text', 'text': text})
+
+    def _add_metric(self, calls, hosts, args, kwargs):
+        mode, _, _, (title, minimum, mean, maximum, stddev) = calls[0]
+        item = {'type': 'metric', 'mode': mode, 'title': title,
+                'min': float(minimum), 'mean': float(mean),
+                'max': float(maximum), 'stddev': float(stddev)}
+        if calls[1][1] == Levels.ERROR:
+            _, deviance, _, tolerance_max = calls[1][3]
+            item.update(status='unstable', deviance=float(deviance),
+                        tolerance_max=float(tolerance_max),
+                        hosts=[{'host': host, 'class': 'unstable'}
+                               for host in hosts])
+        else:
+            curious = {}
+            for _, _, string, values in calls[1:-1]:
+                curious[values[1]] = {
+                    'class': 'over' if 'overperformance' in string
+                    else 'under',
+                    'value': float(values[2])}
+            item['hosts'] = []
+            for host in hosts:
+                host_item = {'host': host, 'class': 'consistent'}
+                host_item.update(curious.get(host, {}))
+                item['hosts'].append(host_item)
+            _, _, string, (_, _, unit) = calls[-1]
+            item.update(status='suspicious' if 'SUSPICIOUS' in string
+                        else 'consistent', unit=unit)
+        self.items.append(item)
+
+    def _add_summary(self, calls, hosts, args, kwargs):
+        mode, _, _, values = calls[0]
+        _, _, array_name, _, mean, unit, stddev, perf_status = values
+        item = {'type': 'summary', 'mode': mode, 'class': array_name,
+                'hosts': list(hosts), 'mean': float(mean),
+                'stddev': float(stddev), 'unit': unit}
+        if perf_status:
+            cpu_type = args[5] if len(args) > 5 else kwargs['item_value']
+            min_perf = perf_cpu_tables.get_cpu_min_perf(mode, cpu_type)
+            if min_perf == 0:
+                status = 'unknown'
+            elif mean >= min_perf:
+                status = 'ok'
+            else:
+                status = 'fail'
+            item['perf'] = {'cpu': cpu_type, 'min': min_perf,
+                            'status': status}
+        self.items.append(item)
+
+
+def render_performance(check_report):
+    """Print a check of performance_report as cardiff prints it."""
+    for item in check_report['items']:
+        _RENDERERS[item['type']](check_report['group'], item)
+
+
+def _render_header(group_number, item):
+    sys.stdout.write('\nGroup %d : Checking %s\n' %
+                     (group_number, item['title']))
+
+
+def _render_metric(group_number, item):
+    mode = item['mode']
+    title = item['title']
+    mean = item['mean']
+    cardiff_utils.do_print(
+        mode, Levels.INFO,
+        "%-12s : Group performance : min=%8.2f, mean=%8.2f, "
+        "max=%8.2f, stddev=%8.2f", title, item['min'], mean, item['max'],
+        item['stddev'])
+    if item['status'] == 'unstable':
+        cardiff_utils.do_print(
+            mode, Levels.ERROR,
+            "%-12s : Group's variance is too important : %7.2f%% "
+            "of %7.2f whereas limit is set to %3.2f%%", title,
+            item['deviance'], mean, item['tolerance_max'])
+        cardiff_utils.do_print(mode, Levels.ERROR,
+                               "%-12s : Group performance : UNSTABLE",
+                               title)
+        return
+    min_group = mean - 2 * item['stddev']
+    max_group = mean + 2 * item['stddev']
+    for host in item['hosts']:
+        if host['class'] == 'over':
+            message = "Curious overperformance  %7.2f"
+        elif host['class'] == 'under':
+            message = "Curious underperformance %7.2f"
+        else:
+            continue
+        cardiff_utils.do_print(
+            mode, Levels.WARNING,
+            "%-12s : %s : " + message + " : "
+            "min_allow_group = %.2f, mean_group = %.2f "
+            "max_allow_group = %.2f", title, host['host'], host['value'],
+            min_group, mean, max_group)
+    if item['status'] == 'consistent':
+        cardiff_utils.do_print(
+            mode, Levels.INFO,
+            "%-12s : Group performance = %7.2f %s : CONSISTENT",
+            title, mean, item['unit'])
+    else:
+        cardiff_utils.do_print(
+            mode, Levels.WARNING,
+            "%-12s : Group performance = %7.2f %s : SUSPICIOUS",
+            title, mean, item['unit'])
+
+
+def _render_summary(group_number, item):
+    before = ""
+    after = ""
+    if item['class'] == 'unstable':
+        before = "\033[1;31m"
+        after = "\033[1;m"
+    if item['class'] == 'curious':
+        before = "\033[1;33m"
+        after = "\033[1;m"
+    perf = item.get('perf')
+    perf_status = ""
+    if perf and perf['status'] == 'unknown':
+        perf_status = (": \033[1;33mNO PERF ENTRY IN DB\033[1;m for " +
+                       perf['cpu'])
+    elif perf and perf['status'] == 'ok':
+        perf_status = ": \033[1;32mPERF OK\033[1;m"
+    elif perf:
+        perf_status = (": \033[1;31mPERF FAIL\033[1;m as min perf "
+                       "should have been : " + str(perf['min']))
+    cardiff_utils.do_print(
+        item['mode'], Levels.SUMMARY,
+        "%3d %s%-10s%s hosts with %8.2f %-4s as average value and %8.2f "
+        "standard deviation %s", len(item['hosts']), before, item['class'],
+        after, item['mean'], item['unit'], item['stddev'], perf_status)
+
+
+def _render_message(group_number, item):
+    level = dict((name, value)
+                 for value, name in Levels.message.items())[item['level']]
+    cardiff_utils.do_print(item['mode'], level, '%s', item['text'])
+
+
+def _render_text(group_number, item):
+    sys.stdout.write(item['text'])
+
+
+_RENDERERS = {'header': _render_header,
+              'metric': _render_metric,
+              'summary': _render_summary,
+              'message': _render_message,
+              'text': _render_text}
+
+
+def run_tasks(func, tasks, facts, jobs=1):
+    """Return the results of func(facts, *task) for each task, in order.
+
+    With more than one job, the tasks run in a pool of worker processes
+    which receive the facts, or their FactsIndex, once, when they start.
+    """
+    jobs = min(jobs or multiprocessing.cpu_count(), len(tasks))
+    if jobs <= 1:
+        return [func(facts, *task) for task in tasks]
+    LOG.debug('Running %d tasks in %d processes' % (len(tasks), jobs))
+    pool = multiprocessing.Pool(jobs, initializer=_set_worker_facts,
+                                initargs=(facts,))
+    try:
+        results = pool.map(_run_worker_task,
+                           [(func, task) for task in tasks], chunksize=1)
+    except BaseException:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+    return results
+
+
+# Facts of the nodes in a worker process of run_tasks.
+_worker_facts = None
+
+
+def _set_worker_facts(facts):
+    global _worker_facts
+    _worker_facts = facts
+
+
+def _run_worker_task(func_and_task):
+    func, task = func_and_task
+    return func(_worker_facts, *task)
+
+
+def _group_category(index, category, hosts):
+    name, check_func, _ = CATEGORIES[category]
+    return check_func(index.systems(name, hosts), index.unique_id)
+
+
+def _performance_items(index, kind, category, group, group_number, detail,
+                       engine):
+    return PerformanceRecorder().record(
+        _check_performance, kind, index.systems(category, group),
+        index.unique_id, group_number, detail, engine)
+
+
+def _performance_key(kind, group_number, group, fingerprints, engine):
+    members = sorted((host, fingerprints.get(host, '')) for host in group)
+    blob = json.dumps([kind, group_number, members, engine]).encode('utf-8')
+    return hashlib.sha1(blob).hexdigest()
+
+
+def _check_performance(kind, systems, unique_id, group_number, detail,
+                       engine='cardiff'):
+    # The details are printed as pandas DataFrames, only cardiff does it.
+    detail_level = cardiff_utils.Levels.DETAIL
+    if (engine == 'numpy' and
+            cardiff_utils.print_level & detail_level != detail_level):
+        _check_performance_numpy(kind, systems, unique_id, group_number)
+    elif kind == 'disk':
+        check.logical_disks_perf(systems, unique_id, group_number, detail,
+                                 "KBps")
+        check.logical_disks_perf(systems, unique_id, group_number, detail,
+                                 "IOps")
+    elif kind == 'cpu':
+        check.cpu_perf(systems, unique_id, group_number, detail)
+    elif kind == 'memory':
+        check.memory_perf(systems, unique_id, group_number, detail)
+    elif kind == 'network':
+        check.network_perf(systems, unique_id, group_number, detail)
+
+
+def _check_performance_numpy(kind, systems, unique_id, group_number):
+    if kind == 'disk':
+        outliers.logical_disks_perf(systems, unique_id, group_number, "KBps")
+        outliers.logical_disks_perf(systems, unique_id, group_number, "IOps")
+    elif kind == 'cpu':
+        outliers.cpu_perf(systems, unique_id, group_number)
+    elif kind == 'memory':
+        outliers.memory_perf(systems, unique_id, group_number)
+    elif kind == 'network':
+        outliers.network_perf(systems, unique_id, group_number)
+
+
+def _capture_output(func, *args):
+    """Call func and return what it printed instead of printing it."""
+    stdout = sys.stdout
+    sys.stdout = six.StringIO()
+    try:
+        func(*args)
+        return sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
@@ -0,0 +1,162 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Synthetic introspection facts of a fleet of nodes, shaped like the ones
+# the hardware ramdisk uploads to Swift, for the benchmarks.
+
+import os
+import pprint
+import random
+
+# Hardware models of the fleet. Most nodes share the first one, the
+# heterogeneity of a fleet sets how many nodes get one of the others.
+MODELS = (
+    {'name': 'PowerEdge R630', 'cpus': 2, 'cores': 8, 'memory': 65536,
+     'disks': 2, 'nics': 2, 'bios': '2.1.7'},
+    {'name': 'PowerEdge R630', 'cpus': 2, 'cores': 8, 'memory': 131072,
+     'disks': 2, 'nics': 2, 'bios': '2.1.5'},
+    {'name': 'PowerEdge R730', 'cpus': 2, 'cores': 12, 'memory': 262144,
+     'disks': 6, 'nics': 4, 'bios': '2.1.7'},
+    {'name': 'ProLiant DL360', 'cpus': 1, 'cores': 10, 'memory': 32768,
+     'disks': 4, 'nics': 2, 'bios': 'P89'},
+)
+
+
+def node_uuid(index):
+    """Return the uuid of the node at index in a generated fleet."""
+    return '00000000-0000-4000-8000-%012d' % index
+
+
+def node_model(index, heterogeneity, seed=0):
+    """Return the index in MODELS of the model of a node."""
+    rng = random.Random('%s-model-%d' % (seed, index))
+    if rng.random() < heterogeneity:
+        return rng.randint(1, len(MODELS) - 1)
+    return 0
+
+
+def generate_node_facts(index, num_facts=200, heterogeneity=0.1, seed=0):
+    """Generate the facts of a single node.
+
+    The same arguments always generate the same facts.
+
+    :param index: index of the node in the fleet
+    :param num_facts: minimum number of facts, IPMI sensors are added to
+        the facts of the hardware model until it is reached
+    :param heterogeneity: probability, between 0 and 1, that the node
+        is not of the most common model
+    :param seed: seed of the fleet
+    :returns: list of (category, item, key, value) tuples
+    """
+    model = MODELS[node_model(index, heterogeneity, seed)]
+    rng = random.Random('%s-facts-%d' % (seed, index))
+    facts = [
+        ('system', 'product', 'uuid', node_uuid(index)),
+        ('system', 'product', 'serial', 'SN%08d' % index),
+        ('system', 'product', 'name', model['name']),
+        ('system', 'product', 'vendor', model['name'].split()[0]),
+        ('system', 'kernel', 'cmdline',
+         'ip=192.0.2.%d:::::eth0:off' % (index % 250 + 1)),
+        ('firmware', 'bios', 'version', model['bios']),
+        ('firmware', 'bios', 'vendor', 'BIOS Vendor'),
+        ('memory', 'total', 'size', str(model['memory'] * 1024 * 1024)),
+        ('memory', 'DDR', 'size', str(model['memory'] // 4)),
+        ('memory', 'DDR', 'tRAS', '36'),
+        ('memory', 'DDR', 'tRCD', '15'),
+        ('cpu', 'physical', 'number', str(model['cpus'])),
+        ('cpu', 'logical', 'number', str(model['cpus'] * model['cores'])),
+        ('cpu', 'logical', 'loops_per_sec',
+         str(int(model['cpus'] * model['cores'] * rng.gauss(1000, 30)))),
+        ('cpu', 'logical', 'threaded_bandwidth_1M',
+         str(int(rng.gauss(32000, 800)))),
+        ('cpu', 'logical', 'forked_bandwidth_1M',
+         str(int(rng.gauss(32000, 800)))),
+    ]
+    for cpu in range(model['cpus']):
+        facts.extend([
+            ('cpu', 'physical_%d' % cpu, 'product', 'Intel Xeon E5-2630'),
+            ('cpu', 'physical_%d' % cpu, 'cores', str(model['cores'])),
+            ('cpu', 'physical_%d' % cpu, 'frequency', '2400000000')])
+    for core in range(model['cpus'] * model['cores']):
+        facts.extend([
+            ('cpu', 'logical_%d' % core, 'bogomips',
+             '%.2f' % rng.gauss(4800, 20)),
+            ('cpu', 'logical_%d' % core, 'loops_per_sec',
+             str(int(rng.gauss(1000, 30)))),
+            ('cpu', 'logical_%d' % core, 'bandwidth_1M',
+             str(int(rng.gauss(10000, 300))))])
+    for disk in range(model['disks']):
+        name = 'sd%s' % chr(ord('a') + disk)
+        facts.extend([
+            ('disk', name, 'size', '1000'),
+            ('disk', name, 'vendor', 'ATA'),
+            ('disk', name, 'model', 'ST1000NX0313'),
+            ('disk', name, 'standalone_randread_4k_IOps',
+             str(int(rng.gauss(120, 5)))),
+            ('disk', name, 'standalone_read_1M_KBps',
+             str(int(rng.gauss(120000, 4000))))])
+    for nic in range(model['nics']):
+        name = 'eth%d' % nic
+        facts.extend([
+            ('network', name, 'serial',
+             '52:54:%02x:%02x:%02x:%02x' % (
+                 (index >> 16) & 0xff, (index >> 8) & 0xff, index & 0xff,
+                 nic)),
+            ('network', name, 'vendor', 'Intel Corporation'),
+            ('network', name, 'link', 'yes'),
+            ('network', name, 'driver', 'ixgbe'),
+            # cardiff groups the nodes on these values too, so they do
+            # not vary between the nodes of a model.
+            ('network', 'bandwidth', name, '940'),
+            ('network', 'requests_per_sec', name, '9000')])
+    sensor = 0
+    while len(facts) < num_facts:
+        facts.append(('ipmi', 'Fan%d RPM' % sensor, 'value',
+                      str(int(rng.gauss(4800, 100)))))
+        sensor += 1
+    return facts
+
+
+def generate_fleet(num_nodes, num_facts=200, heterogeneity=0.1, seed=0):
+    """Generate the facts of num_nodes nodes, see generate_node_facts."""
+    return [generate_node_facts(index, num_facts, heterogeneity, seed)
+            for index in range(num_nodes)]
+
+
+def model_specs(model):
+    """Return the edeploy specs matching the nodes of a hardware model."""
+    return [
+        ('system', 'product', 'name', model['name']),
+        ('firmware', 'bios', 'version', model['bios']),
+        ('cpu', 'physical', 'number', str(model['cpus'])),
+        ('cpu', 'logical', 'number', str(model['cpus'] * model['cores'])),
+        ('memory', 'total', 'size', str(model['memory'] * 1024 * 1024)),
+        ('disk', 'sda', 'size', 'gt(500)'),
+        ('network', 'eth0', 'serial', '$mac'),
+    ]
+
+
+def write_profiles(directory):
+    """Write an edeploy configuration with one profile per model.
+
+    :param directory: existing directory to write the state and the
+        specs files to
+    :returns: list of the names of the profiles, in the order of MODELS
+    """
+    names = ['model%d' % index for index in range(len(MODELS))]
+    with open(os.path.join(directory, 'state'), 'w') as state_file:
+        pprint.pprint([(name, '*') for name in names], stream=state_file)
+    for name, model in zip(names, MODELS):
+        with open(os.path.join(directory, name + '.specs'), 'w') as specs:
+            pprint.pprint(model_specs(model), stream=specs)
+    return names
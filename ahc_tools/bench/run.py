@@ -0,0 +1,297 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Benchmarks of the facts parsing, the matching and the report on
+# synthetic fleets, written to a JSON file that can be compared between
+# runs, for example before and after upgrading hardware.
+
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import timeit
+
+from oslo_config import cfg
+import pkg_resources
+
+from ahc_tools import analysis
+from ahc_tools.bench import fleet
+from ahc_tools.bench import startup
+from ahc_tools.common import swift
+from ahc_tools import conf  # noqa
+from ahc_tools import match
+from ahc_tools import report
+from ahc_tools import snapshot
+from ahc_tools import utils
+
+CONF = cfg.CONF
+
+LOG = logging.getLogger('ahc_tools.bench.run')
+
+RESULTS_VERSION = 1
+
+bench_cli_opts = [
+    cfg.StrOpt('output',
+               short='O',
+               required=True,
+               help='File to write the results to.'),
+    cfg.StrOpt('baseline',
+               help='Results of a previous run to compare with.'),
+    cfg.FloatOpt('max-slowdown',
+                 dest='max_slowdown',
+                 default=1.25,
+                 help='Fail when a benchmark is this many times slower than '
+                      'in the baseline.'),
+    cfg.ListOpt('sizes',
+                default=['10', '100', '1000', '5000'],
+                help='Numbers of nodes of the fleets to benchmark.'),
+    cfg.ListOpt('benchmarks',
+                default=['parse', 'match', 'patches', 'report', 'outliers',
+                         'startup'],
+                help='Benchmarks to run. outliers times the performance '
+                     'checks of the report with the NumPy engine. startup '
+                     'times the --help and error paths of the tools and '
+                     'does not depend on the size of the fleet.'),
+    cfg.IntOpt('facts',
+               default=200,
+               min=1,
+               help='Number of facts of each node.'),
+    cfg.FloatOpt('heterogeneity',
+                 default=0.1,
+                 help='Probability that a node is not of the most common '
+                      'hardware model.'),
+    cfg.IntOpt('repeat',
+               default=3,
+               min=1,
+               help='Number of runs of each benchmark, the best and the '
+                    'median times are reported.'),
+    cfg.IntOpt('seed',
+               default=0,
+               help='Seed of the synthetic fleets.'),
+]
+
+
+class FakeSwiftPool(object):
+    """SwiftAPIPool serving the facts blobs from memory."""
+
+    def __init__(self, blobs):
+        self.blobs = blobs
+
+    def get_object(self, object_name, resp_chunk_size=None, **kwargs):
+        blob = self.blobs[object_name]
+        chunks = [blob[start:start + resp_chunk_size]
+                  for start in range(0, len(blob), resp_chunk_size)]
+        return {}, iter(chunks)
+
+
+class Fleet(object):
+    """Synthetic fleet and the edeploy configuration matching it."""
+
+    def __init__(self, num_nodes, num_facts, heterogeneity, seed):
+        self.facts = fleet.generate_fleet(num_nodes, num_facts,
+                                          heterogeneity, seed)
+        self.nodes = [
+            snapshot.SnapshotNode(
+                uuid=fleet.node_uuid(index),
+                extra={'hardware_swift_object': 'extra_hardware-%d' % index},
+                properties={})
+            for index in range(num_nodes)]
+        self.blobs = dict(
+            (node.extra['hardware_swift_object'],
+             json.dumps(node_facts).encode('utf-8'))
+            for node, node_facts in zip(self.nodes, self.facts))
+        self.configdir = tempfile.mkdtemp(prefix='ahc-bench-')
+        fleet.write_profiles(self.configdir)
+        self.nodes_info = None
+
+    def cleanup(self):
+        shutil.rmtree(self.configdir)
+
+
+def bench_parse(bench_fleet):
+    pool = FakeSwiftPool(bench_fleet.blobs)
+    get_pool = swift.get_pool
+    swift.get_pool = lambda: pool
+    try:
+        for node in bench_fleet.nodes:
+            utils._get_swift_facts(node.extra['hardware_swift_object'])
+    finally:
+        swift.get_pool = get_pool
+
+
+def bench_match(bench_fleet):
+    nodes_info, failures = match.match_nodes(bench_fleet.nodes,
+                                             bench_fleet.facts)
+    if failures:
+        raise RuntimeError('%d nodes did not match' % len(failures))
+    bench_fleet.nodes_info = nodes_info
+
+
+def bench_patches(bench_fleet):
+    if bench_fleet.nodes_info is None:
+        bench_match(bench_fleet)
+    for node in bench_fleet.nodes:
+        match.get_update_patches(node, bench_fleet.nodes_info[node.uuid])
+
+
+def bench_report(bench_fleet):
+    stdout = sys.stdout
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = devnull
+        try:
+            report.print_report(bench_fleet.facts)
+        finally:
+            sys.stdout = stdout
+
+
+def bench_outliers(bench_fleet):
+    index = analysis.FactsIndex(bench_fleet.facts, 'uuid')
+    detail = {'group': '', 'category': '', 'item': ''}
+    stdout = sys.stdout
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = devnull
+        try:
+            analysis.compare_performance(index, [index.host_set], detail,
+                                         analysis.ReportState(),
+                                         engine='numpy')
+        finally:
+            sys.stdout = stdout
+
+
+BENCHMARKS = {
+    'parse': bench_parse,
+    'match': bench_match,
+    'patches': bench_patches,
+    'report': bench_report,
+    'outliers': bench_outliers,
+}
+
+
+def run_benchmark(func, bench_fleet, repeat):
+    """Run func on the fleet repeat times and return its timings."""
+    times = []
+    for _ in range(repeat):
+        start = timeit.default_timer()
+        func(bench_fleet)
+        times.append(timeit.default_timer() - start)
+    times.sort()
+    return {'best': times[0],
+            'median': times[len(times) // 2],
+            'per_node': times[0] / len(bench_fleet.nodes)}
+
+
+def run(sizes, benchmarks, num_facts=200, heterogeneity=0.1, repeat=3,
+        seed=0):
+    """Run the benchmarks on a fleet of each size.
+
+    The report options must be registered, the report benchmark prints
+    the full report.
+
+    :returns: list of result dictionaries, one per benchmark and size
+    """
+    CONF.set_override('full', True)
+    CONF.set_override('lockname', None, 'edeploy')
+    results = []
+    for size in sizes:
+        bench_fleet = Fleet(size, num_facts, heterogeneity, seed)
+        CONF.set_override('configdir', bench_fleet.configdir, 'edeploy')
+        try:
+            for name in benchmarks:
+                LOG.info('Running the %s benchmark on %d nodes' %
+                         (name, size))
+                result = {'benchmark': name, 'nodes': size}
+                result.update(run_benchmark(BENCHMARKS[name], bench_fleet,
+                                            repeat))
+                results.append(result)
+        finally:
+            bench_fleet.cleanup()
+    return results
+
+
+def compare(baseline, results, max_slowdown):
+    """Compare the best times of results with the ones of baseline.
+
+    :returns: list of (benchmark, nodes, ratio) tuples of the benchmarks
+        more than max_slowdown times slower than in the baseline
+    """
+    previous = dict(((result['benchmark'], result['nodes']), result['best'])
+                    for result in baseline['results'])
+    regressions = []
+    for result in results:
+        key = (result['benchmark'], result['nodes'])
+        if not previous.get(key):
+            continue
+        ratio = result['best'] / previous[key]
+        LOG.info('%s on %d nodes: %.3fs, %.2f times the baseline' %
+                 (key[0], key[1], result['best'], ratio))
+        if ratio > max_slowdown:
+            regressions.append(key + (ratio,))
+    return regressions
+
+
+def _version(distribution):
+    try:
+        return pkg_resources.get_distribution(distribution).version
+    except pkg_resources.DistributionNotFound:
+        return None
+
+
+def main(args=sys.argv[1:]):
+    # The options of the benchmarks are kept apart from the ones of the
+    # tools, which the benchmarks run with their default values.
+    bench_conf = cfg.ConfigOpts()
+    bench_conf.register_cli_opts(bench_cli_opts)
+    bench_conf(args=args, default_config_files=[])
+    CONF.register_cli_opts(report.report_cli_opts)
+    CONF(args=[], default_config_files=[])
+    utils.setup_logging(False)
+
+    unknown = set(bench_conf.benchmarks) - set(BENCHMARKS) - set(['startup'])
+    if unknown:
+        LOG.error('Unknown benchmarks: %s' % ', '.join(sorted(unknown)))
+        sys.exit(1)
+
+    results = run([int(size) for size in bench_conf.sizes],
+                  [name for name in bench_conf.benchmarks
+                   if name in BENCHMARKS],
+                  bench_conf.facts, bench_conf.heterogeneity,
+                  bench_conf.repeat, bench_conf.seed)
+    if 'startup' in bench_conf.benchmarks:
+        results.extend(startup.run(bench_conf.repeat))
+    data = {'version': RESULTS_VERSION,
+            'python': platform.python_version(),
+            'hardware': _version('hardware'),
+            'parameters': {'facts': bench_conf.facts,
+                           'heterogeneity': bench_conf.heterogeneity,
+                           'repeat': bench_conf.repeat,
+                           'seed': bench_conf.seed},
+            'results': results}
+    with open(bench_conf.output, 'w') as output:
+        json.dump(data, output, indent=2, sort_keys=True)
+
+    if bench_conf.baseline:
+        with open(bench_conf.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(baseline, results, bench_conf.max_slowdown)
+        for name, size, ratio in regressions:
+            LOG.error('%s on %d nodes is %.2f times slower than the '
+                      'baseline' % (name, size, ratio))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Start up time of the tools on the paths that return before doing any
+# work, --help and usage or configuration errors, which orchestration
+# scripts hit many times per deployment.
+
+import json
+import os
+import subprocess
+import sys
+import timeit
+
+# Modules which are slow to import and must only be imported by the tools
+# once they need them.
+HEAVY_MODULES = ('hardware', 'ironicclient', 'keystoneclient', 'pandas',
+                 'swiftclient')
+
+# (name, tool, arguments) of the commands to time.
+COMMANDS = (
+    ('report --help', 'report', ['--help']),
+    ('match --help', 'match', ['--help']),
+    ('snapshot --help', 'snapshot', ['--help']),
+    ('report usage error', 'report', ['--unique-id', 'bogus']),
+    ('report nothing to print', 'report', ['--config-file', os.devnull]),
+    ('match missing config file', 'match',
+     ['--config-file', '/nonexistent/ahc-tools.conf']),
+)
+
+# Runs the main function of a tool, then prints the modules it imported
+# on the last line of the output.
+_SCRIPT = """
+import json
+import sys
+from ahc_tools import %s as tool
+try:
+    tool.main(args=sys.argv[1:])
+except BaseException:
+    pass
+sys.stdout.write('\\n' + json.dumps(sorted(sys.modules)) + '\\n')
+"""
+
+
+def heavy_modules(modules):
+    """Return the modules of HEAVY_MODULES, or of their packages, found."""
+    return sorted(module for module in modules
+                  if module.split('.')[0] in HEAVY_MODULES)
+
+
+def run_command(tool, args):
+    """Run a tool in a new interpreter.
+
+    :returns: a (seconds, modules) tuple, with the wall time of the run and
+        the list of the modules the tool imported
+    """
+    command = [sys.executable, '-c', _SCRIPT % tool] + list(args)
+    start = timeit.default_timer()
+    with open(os.devnull, 'w') as devnull:
+        output = subprocess.check_output(command, stderr=devnull)
+    seconds = timeit.default_timer() - start
+    last_line = output.decode('utf-8').strip().splitlines()[-1]
+    return seconds, json.loads(last_line)
+
+
+def run(repeat=3):
+    """Time every command of COMMANDS.
+
+    :returns: list of result dictionaries, one per command, with the heavy
+        modules the command imported
+    """
+    results = []
+    for name, tool, args in COMMANDS:
+        times = []
+        for _ in range(repeat):
+            seconds, modules = run_command(tool, args)
+            times.append(seconds)
+        times.sort()
+        results.append({'benchmark': 'startup: %s' % name,
+                        'nodes': 0,
+                        'best': times[0],
+                        'median': times[len(times) // 2],
+                        'heavy_modules': heavy_modules(modules)})
+    return results
@@ -0,0 +1,134 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+
+from oslo_config import cfg
+
+from ahc_tools import conf  # noqa
+
+CONF = cfg.CONF
+
+LOG = logging.getLogger('ahc_tools.cache')
+
+
+class FactsCache(object):
+    """Size bounded, least recently used on-disk cache of facts blobs.
+
+    Each Swift object is stored in its own file, named after the SHA1 of
+    the object name, holding the ETag on the first line followed by the
+    blob as downloaded. The modification time of the files records the
+    last use, so the LRU order survives between runs.
+    """
+
+    def __init__(self, directory, max_size):
+        """Constructor for creating a FactsCache object.
+
+        :param directory: directory holding the cached blobs
+        :param max_size: maximum total size of the cached blobs, in bytes
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._size = 0
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        files = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if name.endswith('.facts') and os.path.isfile(path):
+                stat = os.stat(path)
+                files.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(files):
+            self._entries[name] = size
+            self._size += size
+
+    @staticmethod
+    def _key(object_name):
+        return hashlib.sha1(object_name.encode('utf-8')).hexdigest() + '.facts'
+
+    def get(self, object_name):
+        """Return the cached (etag, blob) of an object, or None."""
+        key = self._key(object_name)
+        path = os.path.join(self.directory, key)
+        try:
+            with open(path, 'rb') as cache_file:
+                etag = cache_file.readline().rstrip(b'\n').decode('utf-8')
+                blob = cache_file.read()
+            os.utime(path, None)
+        except (IOError, OSError):
+            return None
+
+        with self._lock:
+            if key in self._entries:
+                self._entries[key] = self._entries.pop(key)
+        return etag, blob
+
+    def put(self, object_name, etag, blob):
+        """Store the blob of an object and evict the oldest entries."""
+        key = self._key(object_name)
+        path = os.path.join(self.directory, key)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as cache_file:
+                cache_file.write(etag.encode('utf-8') + b'\n')
+                cache_file.write(blob)
+            os.rename(tmp_path, path)
+        except (IOError, OSError) as e:
+            LOG.warning('Failed to cache the facts of %s: %s' %
+                        (object_name, e))
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            return
+
+        with self._lock:
+            self._size -= self._entries.pop(key, 0)
+            self._entries[key] = os.path.getsize(path)
+            self._size += self._entries[key]
+            while self._size > self.max_size and len(self._entries) > 1:
+                old_key, old_size = self._entries.popitem(last=False)
+                self._size -= old_size
+                try:
+                    os.unlink(os.path.join(self.directory, old_key))
+                except OSError:
+                    pass
+
+
+_CACHE = None
+_CACHE_LOCK = threading.Lock()
+
+
+def get_cache():
+    """Return the process-wide FactsCache, or None if it is disabled."""
+    global _CACHE
+    if not CONF.cache.directory:
+        return None
+    with _CACHE_LOCK:
+        if _CACHE is None:
+            _CACHE = FactsCache(CONF.cache.directory,
+                                CONF.cache.max_size * 1024 * 1024)
+        return _CACHE
+
+
+def reset_cache():
+    """Drop the process-wide FactsCache."""
+    global _CACHE
+    with _CACHE_LOCK:
+        _CACHE = None
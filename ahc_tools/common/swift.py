@@ -13,11 +13,12 @@
 
 # Mostly copied from ironic/common/swift.py
 
+import threading
+
 from oslo_config import cfg
-from swiftclient import client as swift_client
-from swiftclient import exceptions as swift_exceptions
 
 from ahc_tools import exc
+from ahc_tools import tokens
 
 CONF = cfg.CONF
 
@@ -50,6 +51,16 @@ SWIFT_OPTS = [
     cfg.StrOpt('os_auth_url',
                default='',
                help='Keystone authentication URL'),
+    cfg.IntOpt('pool_size',
+               default=10,
+               min=1,
+               help='Maximum number of Swift connections kept open and '
+                    'shared by the facts downloads of a single run.'),
+    cfg.IntOpt('concurrency',
+               default=10,
+               min=1,
+               help='Maximum number of facts downloads running at the same '
+                    'time.'),
 ]
 
 
@@ -65,40 +76,180 @@ class SwiftAPI(object):
     """API for communicating with Swift."""
 
     def __init__(self,
-                 user=CONF.swift.username,
-                 tenant_name=CONF.swift.tenant_name,
-                 key=CONF.swift.password,
-                 auth_url=CONF.swift.os_auth_url,
-                 auth_version=CONF.swift.os_auth_version):
+                 user=None,
+                 tenant_name=None,
+                 key=None,
+                 auth_url=None,
+                 auth_version=None,
+                 preauthurl=None,
+                 preauthtoken=None):
         """Constructor for creating a SwiftAPI object.
 
+        Unset parameters are read from the [swift] section of the
+        configuration when the object is created.
+
         :param user: the name of the user for Swift account
         :param tenant_name: the name of the tenant for Swift account
         :param key: the 'password' or key to authenticate with
         :param auth_url: the url for authentication
         :param auth_version: the version of api to use for authentication
+        :param preauthurl: storage URL of an already authenticated session
+        :param preauthtoken: token of an already authenticated session
         """
         params = {'retries': CONF.swift.max_retries,
-                  'user': user,
-                  'tenant_name': tenant_name,
-                  'key': key,
-                  'authurl': auth_url,
-                  'auth_version': auth_version}
-
+                  'user': user or CONF.swift.username,
+                  'tenant_name': tenant_name or CONF.swift.tenant_name,
+                  'key': key or CONF.swift.password,
+                  'authurl': auth_url or CONF.swift.os_auth_url,
+                  'auth_version': auth_version or CONF.swift.os_auth_version,
+                  'preauthurl': preauthurl,
+                  'preauthtoken': preauthtoken}
+
+        # swiftclient is imported on first use, it is slow to import and
+        # not needed for --help or when the facts come from a snapshot.
+        from swiftclient import client as swift_client
         self.connection = swift_client.Connection(**params)
 
-    def get_object(self, object_name, container='ironic-inspector'):
+    def get_object(self, object_name, container='ironic-inspector',
+                   headers=None, resp_headers=False, resp_chunk_size=None):
         """Downloads a given object from Swift.
 
         :param object_name: The name of the object in Swift
         :param container: The name of the container for the object.
         :param headers: the headers for the object to pass to Swift
-        :returns: Swift object
+        :param resp_headers: if True, return the response headers too
+        :param resp_chunk_size: if set, the object is returned as an
+            iterator of chunks of this size, read as they are consumed.
+        :returns: Swift object, or a (response headers, Swift object) tuple
+            if resp_headers is True. The object is None when a conditional
+            request was answered with 304 Not Modified.
         :raises: exc.SwiftDownloadFailed, if the Swift operation fails.
         """
+        from swiftclient import exceptions as swift_exceptions
         try:
-            _, obj = self.connection.get_object(container, object_name)
+            headers_out, obj = self.connection.get_object(
+                container, object_name, headers=headers,
+                resp_chunk_size=resp_chunk_size)
         except swift_exceptions.ClientException as e:
-            raise exc.SwiftDownloadError(e.msg, object_name)
+            if not (resp_headers and e.http_status == 304):
+                raise exc.SwiftDownloadError(e.msg, object_name)
+            headers_out, obj = e.http_response_headers or {}, None
+
+        if resp_headers:
+            return headers_out, obj
+        return obj
 
+
+class SwiftAPIPool(object):
+    """Pool of SwiftAPI objects shared by all the downloads of a run.
+
+    Connections are created on demand, up to ``size``, and are kept open
+    between requests. Once one connection has authenticated, the new ones
+    reuse its storage URL and token instead of going back to Keystone.
+    The first one uses the token shared with the Ironic client, if any.
+    """
+
+    def __init__(self, size=None):
+        self.size = size if size is not None else CONF.swift.pool_size
+        if self.size < 1:
+            raise ValueError('The Swift connection pool size must be at '
+                             'least 1, got %d.' % self.size)
+        self._free = []
+        self._created = 0
+        self._auth = None
+        self._cond = threading.Condition()
+
+    def _acquire(self):
+        with self._cond:
+            while not self._free and self._created >= self.size:
+                self._cond.wait()
+            if self._free:
+                return self._free.pop()
+            self._created += 1
+            auth = self._auth
+
+        try:
+            if not auth and CONF.swift.os_auth_version != '1':
+                auth = tokens.get_auth(
+                    'object-store', CONF.swift.os_auth_url,
+                    CONF.swift.username, CONF.swift.password,
+                    CONF.swift.tenant_name)
+            if auth:
+                return SwiftAPI(preauthurl=auth[0], preauthtoken=auth[1])
+            return SwiftAPI()
+        except Exception:
+            with self._cond:
+                self._created -= 1
+                self._cond.notify()
+            raise
+
+    def _release(self, swift_api, succeeded=True):
+        connection = swift_api.connection
+        with self._cond:
+            if succeeded and connection.url and connection.token:
+                self._auth = (connection.url, connection.token)
+            if succeeded:
+                self._free.append(swift_api)
+            else:
+                # Do not hand out a connection left in an unknown state by
+                # a failed request, open a new one when it is needed.
+                self._created -= 1
+            self._cond.notify()
+
+    def get_object(self, object_name, **kwargs):
+        """Downloads a given object from Swift using a pooled connection.
+
+        Accepts the same arguments as SwiftAPI.get_object. When the object
+        is returned in chunks, the connection goes back to the pool once
+        all of them were read.
+        """
+        swift_api = self._acquire()
+        try:
+            result = swift_api.get_object(object_name, **kwargs)
+        except Exception:
+            self._release(swift_api, succeeded=False)
+            raise
+
+        if kwargs.get('resp_headers'):
+            resp_headers, obj = result
+        else:
+            resp_headers, obj = None, result
+        if not kwargs.get('resp_chunk_size') or obj is None:
+            self._release(swift_api)
+            return result
+
+        obj = self._release_when_read(swift_api, obj)
+        if kwargs.get('resp_headers'):
+            return resp_headers, obj
         return obj
+
+    def _release_when_read(self, swift_api, chunks):
+        succeeded = False
+        try:
+            for chunk in chunks:
+                yield chunk
+            succeeded = True
+        finally:
+            # A body that was not read to the end leaves the connection in
+            # an unknown state, so it is not reused.
+            self._release(swift_api, succeeded)
+
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+def get_pool():
+    """Return the process-wide SwiftAPIPool, creating it if needed."""
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = SwiftAPIPool()
+        return _POOL
+
+
+def reset_pool():
+    """Drop the process-wide SwiftAPIPool and its connections."""
+    global _POOL
+    with _POOL_LOCK:
+        _POOL = None
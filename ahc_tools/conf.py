@@ -27,7 +27,23 @@ EDEPLOY_OPTS = [
 MATCH_OPTS = [
     cfg.BoolOpt('debug',
                 default=False,
-                help='Debug mode enabled/disabled.')
+                help='Debug mode enabled/disabled.'),
+    cfg.IntOpt('pipeline_queue_size',
+               default=50,
+               min=1,
+               help='With --pipeline, maximum number of nodes waiting to be '
+                    'matched, and of nodes waiting to be updated.'),
+    cfg.IntOpt('watch_interval',
+               default=60,
+               min=1,
+               help='With --watch, number of seconds between two polls of '
+                    'the nodes.'),
+    cfg.IntOpt('shard_commit_retries',
+               default=3,
+               min=0,
+               help='With --shard, number of times the nodes are matched '
+                    'again without the lock when another run used the same '
+                    'profiles, before matching them holding the lock.'),
 ]
 
 
@@ -38,6 +54,59 @@ REPORT_OPTS = [
 ]
 
 
+CACHE_OPTS = [
+    cfg.StrOpt('directory',
+               default='',
+               help='Directory where the facts downloaded from Swift are '
+                    'cached between runs. Leave empty to disable the '
+                    'cache.'),
+    cfg.IntOpt('max_size',
+               default=512,
+               min=1,
+               help='Maximum size of the facts cache in MiB. The least '
+                    'recently used facts are evicted first.'),
+    cfg.StrOpt('token_file',
+               default='',
+               help='File where the Keystone tokens of the Ironic and Swift '
+                    'clients are kept between runs, readable only by its '
+                    'owner. Leave empty to only share them within a run.'),
+]
+
+
+CLI_OPTS = [
+    cfg.BoolOpt('offline',
+                default=False,
+                help='Only use the facts from the local cache, do not '
+                     'download them from Swift.'),
+    cfg.StrOpt('snapshot',
+               help='Read the nodes and their facts from a snapshot written '
+                    'by ahc-snapshot instead of Ironic and Swift.'),
+    cfg.StrOpt('metrics',
+               help='Write the time, the number of calls and the bytes '
+                    'transferred of each phase of the run, overall and per '
+                    'node, to this JSON file at exit.'),
+]
+
+
+NODE_FILTER_OPTS = [
+    cfg.MultiStrOpt('node',
+                    default=[],
+                    help='UUID of a node to work on, can be repeated. All '
+                         'the nodes are used by default.'),
+    cfg.StrOpt('provision-state',
+               dest='provision_state',
+               help='Only use the nodes in this provision state.'),
+    cfg.BoolOpt('maintenance',
+                help='Only use the nodes in maintenance, or with '
+                     '--nomaintenance, the nodes not in maintenance.'),
+    cfg.BoolOpt('associated',
+                help='Only use the nodes associated with an instance, or '
+                     'with --noassociated, the nodes not associated.'),
+    cfg.StrOpt('driver',
+               help='Only use the nodes with this driver.'),
+]
+
+
 IRONIC_OPTS = [
     cfg.StrOpt('os_auth_url',
                default='',
@@ -60,6 +129,27 @@ IRONIC_OPTS = [
                help='Tenant name for accessing Ironic API. '
                     'Use [keystone_authtoken]/admin_tenant_name for keystone '
                     'authentication.'),
+    cfg.IntOpt('update_workers',
+               default=10,
+               min=1,
+               help='Maximum number of Ironic node updates running at the '
+                    'same time.'),
+    cfg.IntOpt('max_retries',
+               default=3,
+               min=0,
+               help='Maximum number of times to retry a node update that '
+                    'failed with a conflict or a transient error.'),
+    cfg.FloatOpt('retry_interval',
+                 default=1.0,
+                 min=0,
+                 help='Seconds to wait before the first retry of a node '
+                      'update. The wait doubles after each attempt.'),
+    cfg.IntOpt('list_page_size',
+               default=100,
+               min=1,
+               help='Number of nodes listed per request to Ironic. The '
+                    'facts of the nodes of a page are downloaded while the '
+                    'next page is listed.'),
 ]
 
 
@@ -67,6 +157,9 @@ cfg.CONF.register_opts(IRONIC_OPTS, group='ironic')
 cfg.CONF.register_opts(EDEPLOY_OPTS, group='edeploy')
 cfg.CONF.register_opts(MATCH_OPTS, group='match')
 cfg.CONF.register_opts(REPORT_OPTS, group='report')
+cfg.CONF.register_opts(CACHE_OPTS, group='cache')
+cfg.CONF.register_cli_opts(CLI_OPTS)
+cfg.CONF.register_cli_opts(NODE_FILTER_OPTS)
 
 
 def list_opts():
@@ -74,5 +167,6 @@ def list_opts():
         ('match', MATCH_OPTS),
         ('report', REPORT_OPTS),
         ('edeploy', EDEPLOY_OPTS),
+        ('cache', CACHE_OPTS),
         ('ironic', IRONIC_OPTS)
     ]
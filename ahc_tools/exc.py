@@ -52,3 +52,16 @@ class SwiftDownloadError(Exception):
                '\nERROR: %(error)s' %
                {'object_name': object_name, 'error': o_msg})
         super(SwiftDownloadError, self).__init__(msg)
+
+
+class FactsNotCachedError(Exception):
+    """The facts are not in the local cache and Swift may not be used.
+
+    Attributes:
+    object_name -- name of the Swift object missing from the cache
+    """
+
+    def __init__(self, object_name):
+        msg = ('The object %s is not in the local facts cache and cannot '
+               'be downloaded in offline mode.' % object_name)
+        super(FactsNotCachedError, self).__init__(msg)
@@ -0,0 +1,220 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import codecs
+import itertools
+import json
+import re
+import zlib
+
+import six
+
+_DECODER = json.JSONDecoder()
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+# Magic bytes starting the compressed blobs.
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+# The zstandard module once imported, False if it is not installed.
+_zstandard = None
+
+# Category, item and key strings shared by the facts of every node.
+_STRINGS = {}
+
+
+def intern_string(value):
+    """Return the shared copy of a string equal to value."""
+    return _STRINGS.setdefault(value, value)
+
+
+def to_fact(element):
+    """Convert a decoded fact into a tuple with interned strings."""
+    if not isinstance(element, list):
+        raise ValueError('Each fact must be a JSON array, got %r' %
+                         (element,))
+    fact = list(element)
+    for index in range(min(3, len(fact))):
+        if isinstance(fact[index], six.string_types):
+            fact[index] = intern_string(fact[index])
+    return tuple(fact)
+
+
+def iter_facts(chunks):
+    """Decode a JSON array of facts incrementally.
+
+    The facts are yielded as tuples as soon as they are complete, so the
+    blob never has to be held in memory as a whole nor decoded into lists
+    first. Their category, item and key strings are interned, so nodes
+    with the same hardware share them.
+
+    :param chunks: iterable of bytes or text chunks of the JSON array
+    :raises: ValueError, if the chunks are not a JSON array.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buf = ''
+    pos = 0
+    eof = False
+    # One of '[', 'first', 'value', 'separator' or 'done'.
+    expected = '['
+
+    while expected != 'done':
+        pos = _WHITESPACE.match(buf, pos).end()
+        if pos == len(buf):
+            if eof:
+                raise ValueError('Unexpected end of the facts array')
+            buf, pos, eof = _read_more(chunks, decoder, buf, pos)
+            continue
+
+        char = buf[pos]
+        if expected == '[':
+            if char != '[':
+                raise ValueError('The facts are not a JSON array')
+            pos += 1
+            expected = 'first'
+        elif char == ']' and expected in ('first', 'separator'):
+            pos += 1
+            expected = 'done'
+        elif expected == 'separator':
+            if char != ',':
+                raise ValueError('Expected "," or "]" at character %d '
+                                 'of the facts array' % pos)
+            pos += 1
+            expected = 'value'
+        else:
+            try:
+                element, end = _DECODER.raw_decode(buf, pos)
+            except ValueError:
+                if eof:
+                    raise
+                # The element is probably cut by the end of the chunk.
+                buf, pos, eof = _read_more(chunks, decoder, buf, pos)
+                continue
+            pos = end
+            expected = 'separator'
+            yield to_fact(element)
+
+    if buf[pos:].strip() or any(chunk.strip() for chunk in chunks):
+        raise ValueError('Extra data after the facts array')
+
+
+def _read_more(chunks, decoder, buf, pos):
+    """Drop the consumed part of buf and append the next chunk to it."""
+    try:
+        chunk = next(chunks)
+    except StopIteration:
+        return buf[pos:] + decoder.decode(b'', True), 0, True
+    if isinstance(chunk, six.binary_type):
+        chunk = decoder.decode(chunk)
+    return buf[pos:] + chunk, 0, False
+
+
+def parse_facts(blob):
+    """Decode a whole JSON blob of facts into a list of tuples."""
+    return list(iter_facts([blob]))
+
+
+def decompress_chunks(chunks, encoding=None):
+    """Decompress gzip or zstd compressed chunks of facts on the fly.
+
+    The compression is given by encoding, the Content-Encoding of the
+    download, or else detected from the magic bytes starting the blob,
+    which covers objects stored compressed without a Content-Encoding and
+    compressed blobs read back from the local cache. Other chunks are
+    returned as they are.
+
+    :param chunks: iterable of bytes or text chunks
+    :param encoding: Content-Encoding of the chunks, if known
+    :raises: ValueError, if the encoding is not supported, zstd is
+        needed without the zstandard module, or, while the chunks are
+        read, if they are corrupted.
+    """
+    chunks = iter(chunks)
+    encoding = (encoding or 'identity').strip().lower()
+    head = []
+    if encoding == 'identity':
+        size = 0
+        for chunk in chunks:
+            head.append(chunk)
+            size += len(chunk)
+            if size >= len(ZSTD_MAGIC):
+                break
+        encoding = _detect_encoding(head)
+    chunks = itertools.chain(head, chunks)
+    if encoding == 'identity':
+        return chunks
+    new_decompressor, error = _decompressor(encoding)
+    return _decompress(chunks, new_decompressor, error)
+
+
+def accepted_encodings():
+    """Return the Accept-Encoding of the facts downloads."""
+    return 'gzip, zstd' if _import_zstandard() else 'gzip'
+
+
+def _detect_encoding(head):
+    if any(isinstance(chunk, six.text_type) for chunk in head):
+        return 'identity'
+    start = b''.join(head)
+    if start.startswith(GZIP_MAGIC):
+        return 'gzip'
+    if start.startswith(ZSTD_MAGIC):
+        return 'zstd'
+    return 'identity'
+
+
+def _decompressor(encoding):
+    """Return a decompressor factory and the error of the decompressors."""
+    if encoding in ('gzip', 'x-gzip'):
+        return (lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)), zlib.error
+    if encoding == 'zstd':
+        zstandard = _import_zstandard()
+        if not zstandard:
+            raise ValueError('The facts are compressed with zstd, which '
+                             'needs the zstandard module.')
+        return (zstandard.ZstdDecompressor().decompressobj,
+                zstandard.ZstdError)
+    raise ValueError('Unsupported encoding of the facts: %s' % encoding)
+
+
+def _decompress(chunks, new_decompressor, error):
+    decompressor = new_decompressor()
+    try:
+        for chunk in chunks:
+            while chunk:
+                data = decompressor.decompress(chunk)
+                if data:
+                    yield data
+                if not getattr(decompressor, 'eof', False):
+                    break
+                # A decompressor stops at the end of a gzip member or zstd
+                # frame, the next ones start in its unused data.
+                chunk = decompressor.unused_data
+                decompressor = new_decompressor()
+        data = decompressor.flush()
+        if data:
+            yield data
+    except error as e:
+        raise ValueError('The compressed facts are corrupted: %s' % e)
+
+
+def _import_zstandard():
+    global _zstandard
+    if _zstandard is None:
+        try:
+            import zstandard
+        except ImportError:
+            zstandard = False
+        _zstandard = zstandard
+    return _zstandard
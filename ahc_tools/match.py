@@ -11,15 +11,27 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import atexit
+import collections
+import glob
+import hashlib
+import json
 import logging
-import shutil
+from multiprocessing import pool as mp_pool
+import os
 import sys
+import threading
+import time
 
-from hardware import state
 from oslo_config import cfg
+import six
 
+from ahc_tools.common import swift
 from ahc_tools import conf  # noqa
 from ahc_tools import exc
+from ahc_tools import metrics
+from ahc_tools import snapshot
+from ahc_tools import tokens
 from ahc_tools import utils
 
 
@@ -27,20 +39,59 @@ CONF = cfg.CONF
 
 LOG = logging.getLogger('ahc_tools.match')
 
+match_cli_opts = [
+    cfg.BoolOpt('pipeline',
+                default=False,
+                help='Download the facts, match and update the nodes at the '
+                     'same time instead of one phase after the other.'),
+    cfg.BoolOpt('watch',
+                default=False,
+                help='Keep running and, every [match]/watch_interval '
+                     'seconds, match and update the nodes introspected '
+                     'since the previous poll.'),
+    cfg.StrOpt('shard',
+               help='Only match the nodes of shard i out of N, given as '
+                    'i/N with i from 1 to N, the nodes being split by a '
+                    'hash of their UUID. The shards can run at the same '
+                    'time, in other processes or on other hosts sharing '
+                    'the configdir.'),
+]
+
+
+def _retriable_errors():
+    """Return the Ironic errors after which an update is worth retrying."""
+    # Imported here, ironicclient is slow to import.
+    from ironicclient import exc as ironic_exc
+    return (ironic_exc.Conflict,
+            ironic_exc.ServiceUnavailable,
+            ironic_exc.BadGateway,
+            ironic_exc.GatewayTimeout,
+            ironic_exc.ConnectionRefused)
+
+
+def _load_state():
+    """Create, lock and load the edeploy State of the configdir."""
+    # hardware is only imported when matching, not for --help.
+    from ahc_tools import profiles
 
-def match(node, node_info):
     sobj = None
     try:
-        sobj = state.State(lockname=CONF.edeploy.lockname)
-        sobj.load(CONF.edeploy.configdir)
+        sobj = profiles.IndexedState(lockname=CONF.edeploy.lockname)
+        with metrics.timed('state_load'):
+            sobj.load(CONF.edeploy.configdir)
     except Exception as e:
         if sobj:
             sobj.unlock()
         raise exc.LoadFailedError(e.__str__(), CONF.edeploy.configdir)
+    return sobj
+
 
+def _match_node(sobj, node, node_info, facts=None):
     try:
-        facts = utils.get_facts(node)
-        profile, data = sobj.find_match(facts)
+        if facts is None:
+            facts = utils.get_facts(node)
+        with metrics.timed('find_match'):
+            profile, data = sobj.find_match(facts)
         data['profile'] = profile
 
         if 'logical_disks' in data:
@@ -53,99 +104,718 @@ def match(node, node_info):
         node_info['hardware'] = data
     except Exception as e:
         raise exc.MatchFailedError(e.__str__(), node.uuid)
+
+
+def match(node, node_info, facts=None):
+    sobj = _load_state()
+    try:
+        with metrics.node(node.uuid):
+            _match_node(sobj, node, node_info, facts)
+    finally:
+        _save_state(sobj)
+
+
+def match_nodes(nodes, facts, save=True):
+    """Match several nodes against a single load of the edeploy State.
+
+    The State is locked and loaded once, the nodes are matched in order
+    against it in memory, then it is saved and unlocked once.
+
+    :param nodes: list of Ironic nodes
+    :param facts: list with the facts of each node, in the same order
+    :param save: whether to write the counters decremented by the matches
+        to the state file. Without it the matches only happen in memory.
+    :returns: a (nodes_info, failures) tuple. nodes_info maps the uuid of
+        each matched node to its node_info dictionary. failures maps the
+        uuid of each node that did not match to its MatchFailedError.
+    :raises: exc.LoadFailedError, if the State could not be loaded.
+    """
+    sobj = _load_state()
+    try:
+        return _match_all(sobj, nodes, facts)
+    finally:
+        _save_state(sobj, save)
+
+
+def _match_all(sobj, nodes, facts):
+    nodes_info = {}
+    failures = {}
+    for node, node_facts in zip(nodes, facts):
+        node_info = {}
+        LOG.debug('Attempting to match node %s' % node.uuid)
+        try:
+            with metrics.node(node.uuid):
+                _match_node(sobj, node, node_info, node_facts)
+        except exc.MatchFailedError as e:
+            failures[node.uuid] = e
+        else:
+            nodes_info[node.uuid] = node_info
+    return nodes_info, failures
+
+
+def parse_shard(value):
+    """Parse a --shard value into an (index, count) tuple.
+
+    :raises: ValueError, if the value is not i/N with 1 <= i <= N.
+    """
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise ValueError('Invalid shard %s, it must be i/N.' % value)
+    if not 1 <= index <= count:
+        raise ValueError('Invalid shard %s, i must be between 1 and N.' %
+                         value)
+    return index, count
+
+
+def in_shard(uuid, shard):
+    """Whether the node with this uuid belongs to the (index, count) shard.
+
+    The hash does not depend on the process, so all the shards agree on
+    the split.
+    """
+    index, count = shard
+    digest = hashlib.md5(uuid.encode('utf-8')).hexdigest()
+    return int(digest, 16) % count == index - 1
+
+
+def match_nodes_sharded(nodes, facts):
+    """Match nodes without holding the edeploy lock while matching.
+
+    The nodes are matched against a State loaded under the lock, then the
+    profiles they used are reserved in the state file: under the lock
+    again, the file is read and the counters of these profiles are
+    decremented, unless another run left too few nodes for them in the
+    meantime. The nodes are then matched again against the new state, up
+    to [match]/shard_commit_retries times, and a last time holding the
+    lock. When the configdir has cmdb files, the nodes are only matched
+    holding the lock, the cmdb being written while matching.
+
+    :param nodes: list of Ironic nodes
+    :param facts: list with the facts of each node, in the same order
+    :returns: a (nodes_info, failures, used) tuple. nodes_info and
+        failures are like for match_nodes, used maps the profiles
+        reserved in the state file to the number of nodes using them, to
+        be given back with release_profiles.
+    :raises: exc.LoadFailedError, if the State could not be loaded.
+    """
+    attempts = CONF.match.shard_commit_retries + 1
+    if glob.glob(os.path.join(CONF.edeploy.configdir, '*.cmdb')):
+        attempts = 0
+    for _ in range(attempts):
+        sobj = _load_state()
+        sobj.unlock()
+        nodes_info, failures = _match_all(sobj, nodes, facts)
+        used = _used_profiles(nodes_info)
+        if _reserve_profiles(used):
+            return nodes_info, failures, used
+        LOG.info('Another run used the same profiles, matching the nodes '
+                 'again.')
+
+    sobj = _load_state()
+    try:
+        nodes_info, failures = _match_all(sobj, nodes, facts)
+    finally:
+        _save_state(sobj)
+    return nodes_info, failures, _used_profiles(nodes_info)
+
+
+def release_profiles(used):
+    """Give back the profiles reserved by match_nodes_sharded."""
+    if not used:
+        return
+    sobj = _load_state()
+    try:
+        sobj.release(used)
+    finally:
+        _save_state(sobj)
+
+
+def _reserve_profiles(used):
+    sobj = _load_state()
+    try:
+        if not sobj.reserve(used):
+            return False
+        with metrics.timed('state_save'):
+            sobj.save()
+        return True
+    finally:
+        sobj.unlock()
+
+
+def _used_profiles(nodes_info):
+    return dict(collections.Counter(
+        node_info['hardware']['profile']
+        for node_info in nodes_info.values()))
+
+
+def _save_state(sobj, save=True):
+    """Unlock the State, after writing it to the state file if save."""
+    try:
+        if save:
+            with metrics.timed('state_save'):
+                sobj.save()
+    finally:
+        sobj.unlock()
+
+
+def match_pipelined(ironic_client, nodes, queue_size=None, save=True):
+    """Download the facts, match and update nodes in a pipeline.
+
+    The three stages run at the same time: the facts of the nodes are
+    downloaded while they are listed, each node is matched as soon as its
+    facts are there and updated as soon as it is matched. At most
+    queue_size nodes, [match]/pipeline_queue_size by default, wait to be
+    matched and to be updated. The nodes are still matched in the order
+    of ``nodes`` against a single load of the State, so they get the
+    same profiles as with match_nodes.
+
+    :param ironic_client: Ironic client instance
+    :param nodes: iterable of Ironic nodes
+    :param queue_size: maximum number of nodes waiting between two stages
+    :param save: whether to write the State to the state file, like for
+        match_nodes
+    :returns: a (failed_nodes, updated, skipped, failed) tuple.
+        failed_nodes lists the uuids of the nodes whose facts could not be
+        downloaded or which did not match, the others are the results of
+        the updates, like for update_nodes.
+    :raises: exc.LoadFailedError, if the State could not be loaded.
+    """
+    queue_size = queue_size or CONF.match.pipeline_queue_size
+    sobj = _load_state()
+    fetched = six.moves.queue.Queue()
+    fetch_slots = threading.BoundedSemaphore(queue_size)
+    update_slots = threading.BoundedSemaphore(queue_size)
+    fetch_pool = mp_pool.ThreadPool(CONF.swift.concurrency)
+    update_pool = mp_pool.ThreadPool(CONF.ironic.update_workers)
+    producer = threading.Thread(
+        target=_list_and_fetch,
+        args=(nodes, fetch_pool, fetch_slots, fetched))
+    # Only left running if the matching failed, blocked on fetch_slots.
+    producer.daemon = True
+    producer.start()
+
+    failed_nodes = []
+    skipped = []
+    updates = []
+    try:
+        # Facts downloaded out of order wait here for their turn.
+        waiting = {}
+        next_index = 0
+        count = None
+        while count is None or next_index < count:
+            item = fetched.get()
+            if item[0] == 'listed':
+                count = item[1]
+                continue
+            if item[0] == 'list_failed':
+                six.reraise(*item[1])
+
+            index, node, node_facts, error = item[1:]
+            waiting[index] = (node, node_facts, error)
+            while next_index in waiting:
+                node, node_facts, error = waiting.pop(next_index)
+                next_index += 1
+                fetch_slots.release()
+                patch = _match_for_update(sobj, node, node_facts, error)
+                if patch is None:
+                    failed_nodes.append(node.uuid)
+                elif not patch:
+                    skipped.append(node.uuid)
+                else:
+                    update_slots.acquire()
+                    updates.append((node.uuid, update_pool.apply_async(
+                        _update_node_in_slot,
+                        (update_slots, ironic_client, node.uuid, patch))))
+    except Exception:
+        fetch_pool.terminate()
+        update_pool.terminate()
+        raise
     finally:
-        sobj.save()
+        _save_state(sobj, save)
+
+    fetch_pool.close()
+    update_pool.close()
+    fetch_pool.join()
+    update_pool.join()
+    updated = []
+    failed = {}
+    for uuid, result in updates:
+        error = result.get()
+        if error is None:
+            updated.append(uuid)
+        else:
+            failed[uuid] = error
+    return failed_nodes, updated, skipped, failed
+
+
+def _list_and_fetch(nodes, fetch_pool, fetch_slots, fetched):
+    """Start the facts download of the nodes while they are listed."""
+    count = 0
+    try:
+        for node in nodes:
+            fetch_slots.acquire()
+            fetch_pool.apply_async(_fetch_to_queue, (fetched, count, node))
+            count += 1
+    except Exception:
+        fetched.put(('list_failed', sys.exc_info()))
+    else:
+        fetched.put(('listed', count))
+
+
+def _fetch_to_queue(fetched, index, node):
+    node_facts, error = utils.fetch_node_facts(node)
+    fetched.put(('facts', index, node, node_facts, error))
+
+
+def _match_for_update(sobj, node, node_facts, error, node_info=None):
+    """Match a node and return its patch, or None if it failed."""
+    if node_facts is None:
+        LOG.error('Failed to get the facts of node %s. Error was: %s' %
+                  (node.uuid, error))
+        return None
+    if node_info is None:
+        node_info = {}
+    LOG.debug('Attempting to match node %s' % node.uuid)
+    try:
+        with metrics.node(node.uuid):
+            _match_node(sobj, node, node_info, node_facts)
+    except exc.MatchFailedError as e:
+        LOG.error(str(e))
+        return None
+    return get_update_patches(node, node_info)
+
+
+def _update_node_in_slot(update_slots, ironic_client, uuid, patch):
+    try:
+        return _update_node(ironic_client, uuid, patch)
+    finally:
+        update_slots.release()
+
+
+class Watcher(object):
+    """Match and update the nodes whose facts changed since the last poll.
+
+    The Ironic client, the Swift connections and the edeploy State are
+    kept from one poll to the next. A node is only matched when it is new
+    or when its hardware_swift_object changed, after giving its previous
+    profile back to the State. All the nodes are matched again when the
+    state file or the specs change in the configdir.
+
+    The State is only locked while matching and is never saved, like in
+    the other modes of main.
+
+    :param ironic_client: Ironic client instance, created by connect when
+        not given
+    """
+
+    def __init__(self, ironic_client=None):
+        self.ironic_client = ironic_client
+        self.sobj = None
+        # Maps the uuid of each node matched to a (hardware_swift_object,
+        # profile) tuple, profile is None if the node did not match.
+        self.seen = {}
+        self._signature = None
+        # Cached (endpoint, token) the Ironic client was created with.
+        self._auth = None
+
+    def connect(self):
+        """Create the Ironic client again if its token was replaced.
+
+        A client using a cached token cannot authenticate again. The token
+        cache is looked up before each poll, and returns a new token when
+        the previous one is about to expire or was rejected.
+        """
+        auth = utils.get_ironic_auth()
+        if self.ironic_client is None or auth != self._auth:
+            if self.ironic_client is not None:
+                LOG.info('The Keystone token changed, creating a new Ironic '
+                         'client.')
+            self.ironic_client = utils.get_ironic_client(auth)
+            self._auth = auth
+
+    def load_state(self):
+        """Load the State again if the state file or the specs changed.
+
+        :raises: exc.LoadFailedError, if the State could not be loaded.
+        """
+        try:
+            signature = _configdir_signature()
+        except EnvironmentError as e:
+            raise exc.LoadFailedError(str(e), CONF.edeploy.configdir)
+        if signature == self._signature:
+            return
+        sobj = _load_state()
         sobj.unlock()
+        if self.sobj is not None:
+            LOG.info('The state or the specs changed in %s, all the nodes '
+                     'will be matched again.' % CONF.edeploy.configdir)
+        self.sobj = sobj
+        self.seen = {}
+        self._signature = signature
+
+    def poll(self):
+        """List the nodes, then match and update the new or changed ones.
+
+        :returns: a (failed_nodes, updated, skipped, failed) tuple, like
+            match_pipelined.
+        """
+        try:
+            self.load_state()
+        except exc.LoadFailedError as e:
+            if self.sobj is None:
+                raise
+            LOG.error('%s\nThe previous state is kept.' % e)
+        self.connect()
+
+        listed = set()
+        changed = []
+        for node in utils.list_nodes(self.ironic_client):
+            listed.add(node.uuid)
+            swift_object = node.extra.get('hardware_swift_object')
+            if self.seen.get(node.uuid, (None,))[0] != swift_object:
+                changed.append(node)
+        for uuid in set(self.seen) - listed:
+            self._forget(uuid)
+        if not changed:
+            return [], [], [], {}
+
+        nodes, facts, errors = utils.stream_facts(changed)
+        if errors:
+            # The token of the pooled connections may have expired, open
+            # new ones on the next poll.
+            swift.reset_pool()
+        failed_nodes = []
+        patches = []
+        self.sobj.lock()
+        try:
+            for node, node_facts in zip(nodes, facts):
+                self._forget(node.uuid)
+                node_info = {}
+                patch = _match_for_update(self.sobj, node, node_facts,
+                                          errors.get(node.uuid), node_info)
+                if node_facts is not None:
+                    # A failed download is retried on the next poll, a
+                    # failed match only when the facts change.
+                    self.seen[node.uuid] = (
+                        node.extra.get('hardware_swift_object'),
+                        node_info.get('hardware', {}).get('profile'))
+                if patch is None:
+                    failed_nodes.append(node.uuid)
+                else:
+                    patches.append((node.uuid, patch))
+        finally:
+            self.sobj.unlock()
+
+        updated, skipped, failed = update_nodes(self.ironic_client, patches)
+        for uuid in failed:
+            # Try again on the next poll.
+            self._forget(uuid)
+        return failed_nodes, updated, skipped, failed
+
+    def run(self, interval, polls=None):
+        """Poll every interval seconds, forever or ``polls`` times."""
+        count = 0
+        while True:
+            start = time.time()
+            try:
+                failed_nodes, updated, skipped, failed = self.poll()
+            except Exception as e:
+                LOG.error('Failed to poll the nodes. Error was: %s' % e)
+                self._check_unauthorized(e)
+            else:
+                if failed_nodes:
+                    LOG.error('The following nodes did not match any '
+                              'profiles and will not be updated: ' +
+                              ','.join(failed_nodes))
+                if updated or skipped or failed:
+                    _log_updates(updated, skipped, failed)
+            count += 1
+            if polls is not None and count >= polls:
+                return
+            time.sleep(max(0, interval - (time.time() - start)))
+
+    def _check_unauthorized(self, error):
+        """Drop the token of the client if Ironic rejected it."""
+        # Imported here, ironicclient is slow to import.
+        from ironicclient import exc as ironic_exc
+
+        if isinstance(error, ironic_exc.Unauthorized) and self._auth:
+            tokens.forget_token(self._auth[1])
+
+    def _forget(self, uuid):
+        """Give the profile matched by a node back to the State."""
+        swift_object, profile = self.seen.pop(uuid, (None, None))
+        if profile is not None:
+            self.sobj.failed_profile(profile)
+
+
+def _configdir_signature():
+    """Return the size and modification time of the state and specs."""
+    signature = []
+    for name in sorted(os.listdir(CONF.edeploy.configdir)):
+        if name == 'state' or name.endswith('.specs'):
+            stat = os.stat(os.path.join(CONF.edeploy.configdir, name))
+            signature.append((name, stat.st_size, stat.st_mtime))
+    return signature
 
 
 def get_update_patches(node, node_info):
+    """Build the patches needed to store the match results on a node.
+
+    Values the node already holds are not patched again, so a node whose
+    match results did not change gets an empty list.
+    """
     patches = []
 
     if 'hardware' not in node_info:
         return []
 
-    capabilities_dict = utils.capabilities_to_dict(
+    current_capabilities = utils.capabilities_to_dict(
         node.properties.get('capabilities'))
+    capabilities_dict = dict(current_capabilities)
     capabilities_dict['profile'] = node_info['hardware']['profile']
 
-    patches.append({'op': 'add',
-                    'path': '/extra/configdrive_metadata',
-                    'value': {'hardware': node_info['hardware']}})
-    patches.append(
-        {'op': 'add',
-         'path': '/properties/capabilities',
-         'value': utils.dict_to_capabilities(capabilities_dict)})
+    _add_patch(patches, node.extra, 'configdrive_metadata', '/extra',
+               {'hardware': node_info['hardware']})
 
-    if 'target_raid_configuration' in node_info:
+    if capabilities_dict != current_capabilities:
         patches.append(
             {'op': 'add',
-             'path': '/extra/target_raid_configuration',
-             'value': node_info['target_raid_configuration']})
+             'path': '/properties/capabilities',
+             'value': utils.dict_to_capabilities(capabilities_dict)})
+
+    if 'target_raid_configuration' in node_info:
+        _add_patch(patches, node.extra, 'target_raid_configuration',
+                   '/extra', node_info['target_raid_configuration'])
 
     if 'bios_settings' in node_info:
-        patches.append(
-            {'op': 'add',
-             'path': '/extra/bios_settings',
-             'value': node_info['bios_settings']})
+        _add_patch(patches, node.extra, 'bios_settings', '/extra',
+                   node_info['bios_settings'])
 
     return patches
 
 
+def _add_patch(patches, current, key, prefix, value):
+    """Append an 'add' operation unless current[key] already is value."""
+    # Ironic returns JSON, so compare the values the way Ironic would
+    # store them, lists instead of tuples for example.
+    if key in current and current[key] == json.loads(json.dumps(value)):
+        return
+    patches.append({'op': 'add',
+                    'path': '%s/%s' % (prefix, key),
+                    'value': value})
+
+
+def update_nodes(ironic_client, patches, workers=None):
+    """Apply the patches of several nodes concurrently.
+
+    Updates failing with a conflict or a transient error are retried with
+    an exponential backoff, up to [ironic]/max_retries times. Nodes with
+    an empty patch are skipped.
+
+    :param ironic_client: Ironic client instance
+    :param patches: list of (uuid, patch) tuples
+    :param workers: maximum number of concurrent updates, defaults to
+        [ironic]/update_workers
+    :returns: an (updated, skipped, failed) tuple. updated and skipped are
+        lists of uuids, failed maps uuids to the last error message.
+    """
+    skipped = [uuid for uuid, patch in patches if not patch]
+    to_update = [(uuid, patch) for uuid, patch in patches if patch]
+    updated = []
+    failed = {}
+    if not to_update:
+        return updated, skipped, failed
+
+    workers = min(workers or CONF.ironic.update_workers, len(to_update))
+    thread_pool = mp_pool.ThreadPool(workers)
+    try:
+        errors = thread_pool.map(
+            lambda item: _update_node(ironic_client, *item), to_update)
+    finally:
+        thread_pool.close()
+        thread_pool.join()
+
+    for (uuid, _), error in zip(to_update, errors):
+        if error is None:
+            updated.append(uuid)
+        else:
+            failed[uuid] = error
+    return updated, skipped, failed
+
+
+def _update_node(ironic_client, uuid, patch):
+    retriable_errors = _retriable_errors()
+    attempt = 0
+    while True:
+        try:
+            with metrics.node(uuid), metrics.timed('node_update'):
+                ironic_client.node.update(uuid, patch)
+            return None
+        except retriable_errors as e:
+            if attempt >= CONF.ironic.max_retries:
+                return str(e)
+            delay = CONF.ironic.retry_interval * 2 ** attempt
+            LOG.debug('Update of node %s failed, retrying in %.1f seconds. '
+                      'Error was: %s' % (uuid, delay, e))
+            time.sleep(delay)
+            attempt += 1
+        except Exception as e:
+            return str(e)
+
+
 def main(args=sys.argv[1:]):
+    CONF.register_cli_opts(match_cli_opts)
     CONF(args=args, default_config_files=utils.DEFAULT_CONF_FILES)
     debug = CONF.match.debug
     utils.setup_logging(debug)
+    if CONF.metrics:
+        metrics.enable()
+        atexit.register(metrics.get_metrics().write, CONF.metrics)
 
-    ironic_client = utils.get_ironic_client()
-    nodes = ironic_client.node.list(detail=True)
+    shard = _get_shard()
+
+    if CONF.watch:
+        _main_watch()
+        return
+
+    if CONF.snapshot:
+        ironic_client = None
+        with metrics.timed('snapshot_load'):
+            nodes, facts, errors = snapshot.load(CONF.snapshot,
+                                                 _node_selected(shard))
+    else:
+        ironic_client = utils.get_ironic_client()
+        if not CONF.pipeline:
+            nodes, facts, errors = utils.stream_facts(
+                node for node in utils.list_nodes(ironic_client)
+                if not shard or in_shard(node.uuid, shard))
     patches = {}
 
+    if ironic_client and CONF.pipeline:
+        _main_pipelined(ironic_client)
+        return
+
+    failed_nodes = []
+    matchable_nodes = []
+    matchable_facts = []
+    for node, node_facts in zip(nodes, facts):
+        if node_facts is None:
+            LOG.error('Failed to get the facts of node %s. Error was: %s' %
+                      (node.uuid, errors[node.uuid]))
+            failed_nodes.append(node)
+        else:
+            matchable_nodes.append(node)
+            matchable_facts.append(node_facts)
+
+    used = None
     try:
-        _copy_state()
-    except Exception as e:
-        err_msg = ('Failed to copy the state file: %s/state. '
-                   'Error was: %s' % (CONF.edeploy.configdir, e.__str__()))
-        LOG.error(err_msg)
+        if shard:
+            nodes_info, failures, used = match_nodes_sharded(
+                matchable_nodes, matchable_facts)
+        else:
+            # The counters are only decremented in memory, a run leaves
+            # the state file as it was.
+            nodes_info, failures = match_nodes(matchable_nodes,
+                                               matchable_facts, save=False)
+    except exc.LoadFailedError as e:
+        LOG.error(str(e))
         sys.exit()
 
-    failed_nodes = []
-    for node in nodes:
-        try:
-            node_info = {}
-            LOG.debug('Attempting to match node %s' % node.uuid)
-            match(node, node_info)
-            patches[node.uuid] = get_update_patches(node, node_info)
-        except exc.LoadFailedError as e:
-            LOG.error(e.message)
-            sys.exit()
-        except exc.MatchFailedError as e:
-            LOG.error(e.message)
+    for node in matchable_nodes:
+        if node.uuid in failures:
+            LOG.error(str(failures[node.uuid]))
             failed_nodes.append(node)
+        else:
+            patches[node.uuid] = get_update_patches(node,
+                                                    nodes_info[node.uuid])
 
     if failed_nodes:
         err_msg = ('The following nodes did not match any profiles '
                    'and will not be updated: ' +
                    ','.join(node.uuid for node in failed_nodes))
         LOG.error(err_msg)
-    _restore_state()
+    if shard:
+        release_profiles(used)
 
-    for node in nodes:
-        if node not in failed_nodes:
-            try:
-                ironic_client.node.update(node.uuid, patches[node.uuid])
-            except Exception as e:
-                err_msg = ('Failed to update node (%s). '
-                           'Error was: %s' % (node.uuid, e.__str__()))
-                LOG.error(err_msg)
+    node_patches = [(node.uuid, patches[node.uuid]) for node in nodes
+                    if node not in failed_nodes]
+    if not ironic_client:
+        # A snapshot is read only, show what would have been updated.
+        for uuid, patch in node_patches:
+            if patch:
+                LOG.info('Node %s would be updated with: %s' %
+                         (uuid, patch))
+        return
 
+    updated, skipped, failed = update_nodes(ironic_client, node_patches)
+    _log_updates(updated, skipped, failed)
 
-def _copy_state():
-    src = CONF.edeploy.configdir + '/state'
-    dst = CONF.edeploy.configdir + '/state.bak'
-    shutil.copyfile(src, dst)
 
+def _node_selected(shard):
+    """Return the filter selecting the nodes of a snapshot."""
+    if not shard:
+        return utils.node_selected
 
-def _restore_state():
-    src = CONF.edeploy.configdir + '/state.bak'
-    dst = CONF.edeploy.configdir + '/state'
-    shutil.copyfile(src, dst)
+    def selected(node):
+        return utils.node_selected(node) and in_shard(node.uuid, shard)
+    return selected
+
+
+def _get_shard():
+    """Return the (index, count) shard of --shard, None without it."""
+    if not CONF.shard:
+        return None
+    if CONF.pipeline or CONF.watch:
+        LOG.error('--shard cannot be used with --pipeline or --watch.')
+        sys.exit(1)
+    try:
+        return parse_shard(CONF.shard)
+    except ValueError as e:
+        LOG.error(str(e))
+        sys.exit(1)
+
+
+def _main_watch():
+    if CONF.snapshot:
+        LOG.error('--watch polls Ironic, it cannot be used with --snapshot.')
+        sys.exit(1)
+    watcher = Watcher()
+    watcher.connect()
+    try:
+        watcher.load_state()
+    except exc.LoadFailedError as e:
+        LOG.error(str(e))
+        sys.exit()
+    LOG.info('Watching the nodes every %d seconds.' %
+             CONF.match.watch_interval)
+    try:
+        watcher.run(CONF.match.watch_interval)
+    except KeyboardInterrupt:
+        LOG.info('Stopped watching the nodes.')
+
+
+def _main_pipelined(ironic_client):
+    try:
+        failed_nodes, updated, skipped, failed = match_pipelined(
+            ironic_client, utils.list_nodes(ironic_client), save=False)
+    except exc.LoadFailedError as e:
+        LOG.error(str(e))
+        sys.exit()
+
+    if failed_nodes:
+        err_msg = ('The following nodes did not match any profiles '
+                   'and will not be updated: ' + ','.join(failed_nodes))
+        LOG.error(err_msg)
+    _log_updates(updated, skipped, failed)
+
+
+def _log_updates(updated, skipped, failed):
+    for uuid, error in sorted(failed.items()):
+        err_msg = ('Failed to update node (%s). '
+                   'Error was: %s' % (uuid, error))
+        LOG.error(err_msg)
+    LOG.info('Updated %d nodes, skipped %d nodes without changes, '
+             'failed to update %d nodes.' %
+             (len(updated), len(skipped), len(failed)))
@@ -0,0 +1,233 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+import timeit
+
+LOG = logging.getLogger('ahc_tools.metrics')
+
+METRICS_VERSION = 1
+
+# Number of durations of a phase kept to compute its percentiles.
+SAMPLE_SIZE = 1000
+
+_LOCAL = threading.local()
+
+
+class Metrics(object):
+    """Wall time, call count and bytes of each phase of a run.
+
+    The phases are recorded overall and for each node. A phase running
+    inside another one, such as the Swift download inside the decoding of
+    the facts, is not counted in the time of the outer phase.
+
+    The count, total and maximum of a phase are kept as running values,
+    and its percentiles are computed from a uniform sample of at most
+    SAMPLE_SIZE of its durations, so that a long running ahc-match
+    --watch uses a bounded memory.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self._start_timer = timeit.default_timer()
+        self._lock = threading.Lock()
+        self._random = random.Random()
+        self._phases = {}
+        self._nodes = {}
+
+    def record(self, phase, seconds, nbytes=0, node=None):
+        """Record one call of a phase."""
+        with self._lock:
+            phase_data = self._phases.setdefault(
+                phase, {'count': 0, 'total': 0.0, 'bytes': 0,
+                        'max': seconds, 'sample': []})
+            phase_data['count'] += 1
+            phase_data['total'] += seconds
+            phase_data['bytes'] += nbytes
+            phase_data['max'] = max(phase_data['max'], seconds)
+            # Reservoir sampling: each duration has the same chance to
+            # be in the sample.
+            sample = phase_data['sample']
+            if len(sample) < SAMPLE_SIZE:
+                sample.append(seconds)
+            else:
+                index = self._random.randrange(phase_data['count'])
+                if index < SAMPLE_SIZE:
+                    sample[index] = seconds
+            if node is not None:
+                node_phase = self._nodes.setdefault(node, {}).setdefault(
+                    phase, {'count': 0, 'total': 0.0, 'bytes': 0})
+                node_phase['count'] += 1
+                node_phase['total'] += seconds
+                node_phase['bytes'] += nbytes
+
+    def summary(self):
+        """Return the metrics as a JSON serializable dictionary."""
+        with self._lock:
+            phases = {}
+            for phase, phase_data in self._phases.items():
+                sample = sorted(phase_data['sample'])
+                phases[phase] = {'count': phase_data['count'],
+                                 'total': phase_data['total'],
+                                 'bytes': phase_data['bytes'],
+                                 'p50': percentile(sample, 50),
+                                 'p95': percentile(sample, 95),
+                                 'max': phase_data['max']}
+            return {'version': METRICS_VERSION,
+                    'started': self.started,
+                    'wall_time': timeit.default_timer() - self._start_timer,
+                    'phases': phases,
+                    'nodes': self._nodes}
+
+    def write(self, path):
+        """Write the summary to path atomically."""
+        directory = os.path.dirname(os.path.abspath(path))
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            with os.fdopen(fd, 'w') as metrics_file:
+                json.dump(self.summary(), metrics_file, indent=2,
+                          sort_keys=True)
+            os.rename(tmp_path, path)
+        except (IOError, OSError) as e:
+            LOG.error('Failed to write the metrics to %s: %s' % (path, e))
+
+
+def percentile(sorted_values, percent):
+    """Return the nearest-rank percentile of a sorted list."""
+    rank = max(int(-(-len(sorted_values) * percent // 100)), 1)
+    return sorted_values[rank - 1]
+
+
+class _Phase(object):
+    def __init__(self, name):
+        self.name = name
+        self.start = timeit.default_timer()
+        self.nested = 0.0
+        self.bytes = 0
+
+
+def _stack():
+    if not hasattr(_LOCAL, 'stack'):
+        _LOCAL.stack = []
+    return _LOCAL.stack
+
+
+def current_node():
+    """Return the uuid of the node the phases are attributed to."""
+    return getattr(_LOCAL, 'node', None)
+
+
+def _add_nested(seconds):
+    stack = _stack()
+    if stack:
+        stack[-1].nested += seconds
+
+
+@contextlib.contextmanager
+def node(uuid):
+    """Attribute the phases run in the block, in this thread, to a node."""
+    previous = current_node()
+    _LOCAL.node = uuid
+    try:
+        yield
+    finally:
+        _LOCAL.node = previous
+
+
+@contextlib.contextmanager
+def timed(phase):
+    """Record the time spent in the block as one call of phase.
+
+    The object given to the block has a bytes attribute to count the
+    bytes transferred by the phase. Nothing is recorded unless the
+    metrics were enabled.
+    """
+    current = _Phase(phase)
+    if not _ENABLED:
+        yield current
+        return
+    stack = _stack()
+    stack.append(current)
+    try:
+        yield current
+    finally:
+        stack.pop()
+        elapsed = timeit.default_timer() - current.start
+        _add_nested(elapsed)
+        get_metrics().record(phase, elapsed - current.nested, current.bytes,
+                             current_node())
+
+
+def timed_chunks(phase, chunks):
+    """Yield the chunks, recording the time spent reading them as phase.
+
+    The reads are recorded as one call of phase, with the bytes of the
+    chunks, once all of them were read.
+    """
+    if not _ENABLED:
+        for chunk in chunks:
+            yield chunk
+        return
+    seconds = 0.0
+    nbytes = 0
+    iterator = iter(chunks)
+    try:
+        while True:
+            start = timeit.default_timer()
+            try:
+                chunk = next(iterator)
+            finally:
+                elapsed = timeit.default_timer() - start
+                seconds += elapsed
+                _add_nested(elapsed)
+            nbytes += len(chunk)
+            yield chunk
+    except StopIteration:
+        pass
+    finally:
+        get_metrics().record(phase, seconds, nbytes, current_node())
+
+
+_METRICS = None
+_METRICS_LOCK = threading.Lock()
+_ENABLED = False
+
+
+def enable():
+    """Record the phases, as requested with --metrics."""
+    global _ENABLED
+    _ENABLED = True
+
+
+def get_metrics():
+    """Return the process-wide Metrics, creating it if needed."""
+    global _METRICS
+    with _METRICS_LOCK:
+        if _METRICS is None:
+            _METRICS = Metrics()
+        return _METRICS
+
+
+def reset_metrics():
+    """Drop the process-wide Metrics and stop recording."""
+    global _METRICS, _ENABLED
+    with _METRICS_LOCK:
+        _METRICS = None
+        _ENABLED = False
@@ -0,0 +1,474 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Vectorized versions of the performance checks of cardiff. The metrics of
+# a group are loaded in a hosts x metrics array and the statistics of all
+# the metrics are computed at once with NumPy, instead of one pandas
+# Series at a time. The output is the same as the one of cardiff.check.
+
+import contextlib
+import warnings
+
+from hardware.cardiff import check
+from hardware.cardiff import perf_cpu_tables
+from hardware.cardiff import utils as cardiff_utils
+import numpy
+
+Levels = cardiff_utils.Levels
+
+MEMORY_MODES = ['1K', '4K', '1M', '16M', '128M', '256M', '1G', '2G']
+
+
+class Frame(object):
+    """Metrics of a group of hosts, one column per host.
+
+    Built from the same columns as the DataFrame of cardiff: the rows are
+    the union of the labels of the hosts, in the order of the hosts when
+    they all have the same labels and sorted otherwise, as pandas does.
+    Missing metrics are NaN.
+
+    :param columns: list of (host, labels, values) tuples
+    """
+
+    def __init__(self, columns):
+        self.hosts = [host for host, _, _ in columns]
+        indexes = [labels for _, labels, _ in columns if labels]
+        if not indexes:
+            self.rows = []
+        elif all(labels == indexes[0] for labels in indexes):
+            self.rows = list(indexes[0])
+        else:
+            self.rows = sorted(set().union(*indexes))
+        positions = dict((row, index) for index, row in enumerate(self.rows))
+        self.values = numpy.full((len(self.rows), len(self.hosts)),
+                                 numpy.nan)
+        for column, (host, labels, values) in enumerate(columns):
+            if len(labels) != len(values):
+                raise ValueError('Length of values (%d) does not match '
+                                 'length of index (%d) for host %s' %
+                                 (len(values), len(labels), host))
+            for label, value in zip(labels, values):
+                self.values[positions[label], column] = value
+
+        with _quiet():
+            # Reduced along contiguous rows, so that the sums are made in
+            # the same order as pandas does on a single Series.
+            by_host = numpy.ascontiguousarray(self.values.T)
+            self.host_means = numpy.nanmean(by_host, axis=1)
+            self.host_sums = numpy.nansum(by_host, axis=1)
+            self.counts = numpy.sum(~numpy.isnan(self.values), axis=1)
+            self.means = numpy.nanmean(self.values, axis=1)
+            self.stds = numpy.nanstd(self.values, axis=1, ddof=1)
+            self.mins = numpy.nanmin(self.values, axis=1)
+            self.maxs = numpy.nanmax(self.values, axis=1)
+
+
+class Classes(object):
+    """The consistent, curious and unstable hosts of cardiff."""
+
+    def __init__(self):
+        self.consistent = []
+        self.curious = []
+        self.unstable = []
+        self._consistent = set()
+        self._curious = set()
+
+    def add_consistent(self, host):
+        if host not in self._consistent and host not in self._curious:
+            self.consistent.append(host)
+            self._consistent.add(host)
+
+    def add_curious(self, host):
+        if host not in self._curious:
+            self.curious.append(host)
+            self._curious.add(host)
+            if host in self._consistent:
+                self.consistent.remove(host)
+                self._consistent.discard(host)
+
+    def add_unstable(self, host):
+        if host not in self._curious:
+            self.unstable.append(host)
+
+
+@contextlib.contextmanager
+def _quiet():
+    """Silence the NumPy warnings on empty and single value statistics."""
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            yield
+
+
+def print_perf(tolerance_min, tolerance_max, frame, row, mode, classes):
+    """Print the statistics of a metric and classify the hosts.
+
+    Same as cardiff.check.print_perf: hosts are compared to the group
+    with the value of this metric for the cpu benchmarks, and with the
+    mean of all their metrics otherwise.
+    """
+    title = frame.rows[row]
+    mean_group = frame.means[row]
+    variance_group = frame.stds[row]
+    min_group = mean_group - 2 * variance_group
+    max_group = mean_group + 2 * variance_group
+
+    cardiff_utils.do_print(
+        mode, Levels.INFO,
+        "%-12s : Group performance : min=%8.2f, mean=%8.2f, "
+        "max=%8.2f, stddev=%8.2f", title, frame.mins[row],
+        mean_group, frame.maxs[row], variance_group)
+
+    if frame.counts[row] == 1:
+        variance_tolerance = 0
+    else:
+        with _quiet():
+            variance_tolerance = variance_group / mean_group * 100
+
+    if variance_tolerance > tolerance_max:
+        cardiff_utils.do_print(
+            mode, Levels.ERROR,
+            "%-12s : Group's variance is too important : %7.2f%% "
+            "of %7.2f whereas limit is set to %3.2f%%", title,
+            variance_tolerance, mean_group, tolerance_max)
+        cardiff_utils.do_print(mode, Levels.ERROR,
+                               "%-12s : Group performance : UNSTABLE",
+                               title)
+        for host in frame.hosts:
+            classes.add_unstable(host)
+        return
+
+    if "loops_per_sec" in mode or "bogomips" in mode:
+        host_means = frame.values[row]
+    else:
+        host_means = frame.host_means
+    curious_performance = False
+    if variance_tolerance > tolerance_min:
+        with _quiet():
+            over = host_means > max_group
+            under = host_means < min_group
+        for column in numpy.flatnonzero(over | under):
+            host = frame.hosts[column]
+            if over[column]:
+                message = "Curious overperformance  %7.2f"
+            else:
+                message = "Curious underperformance %7.2f"
+            cardiff_utils.do_print(
+                mode, Levels.WARNING,
+                "%-12s : %s : " + message + " : "
+                "min_allow_group = %.2f, mean_group = %.2f "
+                "max_allow_group = %.2f", title, host, host_means[column],
+                min_group, mean_group, max_group)
+            curious_performance = True
+        for column, host in enumerate(frame.hosts):
+            if over[column] or under[column]:
+                classes.add_curious(host)
+            else:
+                classes.add_consistent(host)
+    else:
+        for host in frame.hosts:
+            classes.add_consistent(host)
+
+    unit = " "
+    if "Effi." in title:
+        unit = "%"
+    if curious_performance is False:
+        cardiff_utils.do_print(
+            mode, Levels.INFO,
+            "%-12s : Group performance = %7.2f %s : CONSISTENT",
+            title, mean_group, unit)
+    else:
+        cardiff_utils.do_print(
+            mode, Levels.WARNING,
+            "%-12s : Group performance = %7.2f %s : SUSPICIOUS",
+            title, mean_group, unit)
+
+
+def print_summary(mode, frame, hosts, array_name, unit, item_value=None):
+    """Same as cardiff.check.print_summary."""
+    if not (cardiff_utils.print_level & Levels.SUMMARY) or not hosts:
+        return
+    columns = dict((host, column)
+                   for column, host in enumerate(frame.hosts))
+    result = [frame.host_sums[columns[host]] for host in hosts]
+    before = ""
+    after = ""
+    if "unstable" in array_name:
+        before = "\033[1;31m"
+        after = "\033[1;m"
+    if "curious" in array_name:
+        before = "\033[1;33m"
+        after = "\033[1;m"
+
+    mean = numpy.mean(result)
+    perf_status = ""
+    if (array_name == "consistent" and item_value is not None and
+            mode in ("loops_per_sec", "bogomips")):
+        min_cpu_perf = perf_cpu_tables.get_cpu_min_perf(mode, item_value)
+        if min_cpu_perf == 0:
+            perf_status = (": \033[1;33mNO PERF ENTRY IN DB\033[1;m for " +
+                           item_value)
+        elif mean >= min_cpu_perf:
+            perf_status = ": \033[1;32mPERF OK\033[1;m"
+        else:
+            perf_status = (": \033[1;31mPERF FAIL\033[1;m as min perf "
+                           "should have been : " + str(min_cpu_perf))
+    cardiff_utils.do_print(
+        mode, Levels.SUMMARY,
+        "%3d %s%-10s%s hosts with %8.2f %-4s as average value and %8.2f "
+        "standard deviation %s", len(hosts), before, array_name, after,
+        mean, unit, numpy.std(result), perf_status)
+
+
+def _print_summaries(mode, frame, classes, unit, item_value=None):
+    print_summary(mode, frame, classes.consistent, "consistent", unit,
+                  item_value)
+    print_summary(mode, frame, classes.curious, "curious", unit)
+    print_summary(mode, frame, classes.unstable, "unstable", unit)
+
+
+def _header(group_number, what):
+    print()
+    print("Group %d : Checking %s" % (group_number, what))
+
+
+def network_perf(system_list, unique_id, group_number):
+    """Same as cardiff.check.network_perf."""
+    have_net_data = False
+    sets = check.search_item(system_list, unique_id, "network", r"(.*)",
+                             [], [])
+    for mode in sorted(['bandwidth', 'requests_per_sec']):
+        columns = []
+        for system in sets:
+            net = []
+            global_perf = 0.0
+            for perf in sets[system]:
+                if perf[1] == mode:
+                    if perf[1] not in net:
+                        net.append(perf[1])
+                    global_perf = global_perf + float(perf[3])
+            columns.append((system, net, [global_perf]))
+
+        frame = Frame(columns)
+        if mode == 'bandwidth':
+            unit = "MB/sec"
+        else:
+            unit = "RRQ/sec"
+        for row, net in enumerate(frame.rows):
+            if have_net_data is False:
+                _header(group_number, "network disks perf")
+                have_net_data = True
+            classes = Classes()
+            print_perf(2, 15, frame, row, mode, classes)
+            _print_summaries("%-30s %s" % (mode, net), frame, classes, unit)
+
+
+def logical_disks_perf(system_list, unique_id, group_number, perf_unit):
+    """Same as cardiff.check.logical_disks_perf."""
+    have_disk_data = False
+    sets = check.search_item(system_list, unique_id, "disk",
+                             r"[a-z]d(\S+)", [],
+                             ['simultaneous', 'standalone'])
+    modes = []
+    for system in sets:
+        for perf in sets[system]:
+            if perf[2] not in modes and perf_unit in perf[2]:
+                modes.append(perf[2])
+
+    for mode in sorted(modes):
+        columns = []
+        for system in sets:
+            disks = []
+            series = []
+            for perf in sets[system]:
+                if perf[2] == mode:
+                    if perf[1] not in disks:
+                        disks.append(perf[1])
+                    series.append(int(perf[3]))
+            columns.append((system, disks, series))
+
+        frame = Frame(columns)
+        # In random mode, the variance could be higher as we cannot
+        # insure the distribution pattern was similar.
+        if "rand" in mode:
+            tolerance_min, tolerance_max = 5, 15
+        else:
+            tolerance_min, tolerance_max = 2, 10
+        for row, disk in enumerate(frame.rows):
+            if have_disk_data is False:
+                _header(group_number, "logical disks perf")
+                have_disk_data = True
+            classes = Classes()
+            print_perf(tolerance_min, tolerance_max, frame, row, mode,
+                       classes)
+            _print_summaries("%-30s %s" % (mode, disk), frame, classes,
+                             perf_unit)
+
+
+def cpu_perf(system_list, unique_id, group_number):
+    """Same as cardiff.check.cpu_perf."""
+    have_cpu_data = False
+    host_cpu_list = check.search_item(system_list, unique_id, "cpu", "(.*)",
+                                      [], ['product'])
+    host_cpu_number = check.search_item(system_list, unique_id, "cpu",
+                                        "(.*logical.*)", [], ['number'])
+    core_counts = 1
+    for host in host_cpu_number:
+        for item in host_cpu_number[host]:
+            core_counts = item[3]
+            break
+
+    cpu_type = ''
+    for host in host_cpu_list:
+        for item in host_cpu_list[host]:
+            cpu_type = item[3]
+            break
+
+    modes = ['bogomips', 'loops_per_sec']
+    sets = check.search_item(system_list, unique_id, "cpu", "(.*)", [],
+                             modes)
+    global_perf = dict()
+    for mode in sorted(modes):
+        columns = []
+        for system in sets:
+            cpus = []
+            series = []
+            found_data = False
+            for perf in sets[system]:
+                if perf[2] == mode:
+                    # Individual cpu benchmarks are split from the global
+                    # one.
+                    if "_" in perf[1]:
+                        if perf[1] not in cpus:
+                            cpus.append(perf[1])
+                        series.append(float(perf[3]))
+                        found_data = True
+                    elif "loops_per_sec" in mode:
+                        global_perf[system] = float(perf[3])
+                        found_data = True
+
+            if found_data is True:
+                # A single "All CPU" run was done.
+                if not series:
+                    series.append(global_perf[system])
+                    cpus.append("logical")
+                columns.append((system, cpus, series))
+
+        if not columns:
+            continue
+
+        frame = Frame(columns)
+        classes = Classes()
+        for row in range(len(frame.rows)):
+            if have_cpu_data is False:
+                _header(group_number, "CPU perf")
+                have_cpu_data = True
+            print_perf(2, 7, frame, row, mode, classes)
+        _print_summaries(mode, frame, classes, "", cpu_type)
+
+        if mode == "loops_per_sec":
+            mode_text = 'CPU Effi.'
+            hosts = dict((host, column)
+                         for column, host in enumerate(frame.hosts))
+            counts = numpy.sum(~numpy.isnan(frame.values), axis=0)
+            efficiency = []
+            for system in sets:
+                column = hosts[system]
+                host_perf = (frame.host_sums[column] *
+                             (int(core_counts) / counts[column]))
+                with _quiet():
+                    efficiency.append((system, [mode_text],
+                                       [global_perf[system] / host_perf *
+                                        100]))
+            cpu_eff = Frame(efficiency)
+            classes = Classes()
+            print_perf(1, 2, cpu_eff, 0, mode, classes)
+            _print_summaries("CPU Efficiency", cpu_eff, classes, '%')
+
+
+def memory_perf(system_list, unique_id, group_number):
+    """Same as cardiff.check.memory_perf."""
+    have_memory_data = False
+    sets = check.search_item(system_list, unique_id, "cpu", "(.*)", [],
+                             MEMORY_MODES)
+    for mode in sorted(MEMORY_MODES):
+        real_mode = "Memory benchmark %s" % mode
+        columns = []
+        threaded_perf = dict()
+        forked_perf = dict()
+        for system in sets:
+            memory = []
+            series = []
+            found_data = ""
+            threaded_perf[system] = 0
+            forked_perf[system] = 0
+            for perf in sets[system]:
+                if mode in perf[2]:
+                    # Individual cpu benchmarks are split from the global
+                    # one.
+                    if ("logical_" in perf[1] and
+                            ("bandwidth_%s" % mode) in perf[2]):
+                        if perf[1] not in memory:
+                            memory.append(perf[1])
+                        series.append(float(perf[3]))
+                    elif "threaded_bandwidth_%s" % mode in perf[2]:
+                        threaded_perf[system] = float(perf[3])
+                        found_data = float(perf[3])
+                    elif "forked_bandwidth_%s" % mode in perf[2]:
+                        forked_perf[system] = float(perf[3])
+                        found_data = float(perf[3])
+
+            # A single "All CPU" run was done.
+            if found_data and not series:
+                series.append(found_data)
+                memory.append("logical")
+            columns.append((system, memory, series))
+
+        if not columns:
+            continue
+
+        frame = Frame(columns)
+        classes = Classes()
+        for row in range(len(frame.rows)):
+            if have_memory_data is False:
+                _header(group_number, "Memory perf")
+                have_memory_data = True
+            print_perf(1, 7, frame, row, real_mode, classes)
+        _print_summaries(mode, frame, classes, "MB/s")
+
+        for bench_type in ["threaded", "forked"]:
+            if "threaded" in bench_type:
+                mode_text = "Thread effi."
+                bench_perf = threaded_perf
+            else:
+                mode_text = "Forked Effi."
+                bench_perf = forked_perf
+            efficiency = []
+            for column, system in enumerate(frame.hosts):
+                host_perf = frame.host_sums[column]
+                if (host_perf > 0 and threaded_perf[system] > 0 and
+                        forked_perf[system] > 0):
+                    efficiency.append((system, [mode_text],
+                                       [bench_perf[system] / host_perf *
+                                        100]))
+
+            if efficiency:
+                memory_eff = Frame(efficiency)
+                classes = Classes()
+                print_perf(2, 10, memory_eff, 0, real_mode, classes)
+                _print_summaries(mode + " " + mode_text, memory_eff,
+                                 classes, "%")
+            else:
+                cardiff_utils.do_print(
+                    real_mode, Levels.WARNING,
+                    "%-12s : Benchmark not run on this group", mode_text)
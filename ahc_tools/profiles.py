@@ -0,0 +1,150 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import os
+import pprint
+import stat
+import tempfile
+
+from hardware import state
+import six
+
+LOG = logging.getLogger('ahc_tools.profiles')
+
+
+def is_literal(spec):
+    """Whether a spec line can only match a fact equal to it.
+
+    Lines with a $variable or a function such as gt(4) in any of their
+    fields are handled by the matcher and are not literal.
+    """
+    if len(spec) != 4:
+        return False
+    for field in spec:
+        if not isinstance(field, six.string_types) or not field:
+            return False
+        if field[0] == '$' or field[-1] == ')':
+            return False
+    return True
+
+
+def _fsync_directory(directory):
+    """Make a rename in directory durable."""
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class IndexedState(state.State):
+    """edeploy State ruling out impossible profiles before matching them.
+
+    The specs of each profile are loaded once per State and the literal
+    lines of each of them are indexed. A node lacking any literal line of
+    a profile cannot match it, so the matcher only gets a single line
+    that fails with one pass of comparisons instead of the specs of that
+    profile, with their regular expressions and variable bindings. The
+    order of the profiles and their counters are handled by State as
+    usual.
+
+    The state file is only written when the counters changed since it was
+    loaded, and is replaced atomically.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(IndexedState, self).__init__(*args, **kwargs)
+        self._specs = {}
+        self._literals = {}
+        self._hw_items = None
+        self._saved_data = None
+
+    def load(self, cfg_dir):
+        super(IndexedState, self).load(cfg_dir)
+        self._saved_data = list(self._data)
+
+    def save(self):
+        """Write the counters to the state file if they changed.
+
+        The data is written to a temporary file in the same directory and
+        synced to disk before being renamed over the state file, so a
+        crash leaves either the previous or the new state, never a
+        partial one.
+        """
+        if not self._state_filename or self._data == self._saved_data:
+            return
+        directory = os.path.dirname(self._state_filename) or '.'
+        fd, tmp_name = tempfile.mkstemp(prefix='.state.', dir=directory)
+        try:
+            with os.fdopen(fd, 'w') as state_file:
+                pprint.pprint(self._data, stream=state_file)
+                state_file.flush()
+                os.fsync(state_file.fileno())
+            if os.path.exists(self._state_filename):
+                os.chmod(tmp_name, stat.S_IMODE(
+                    os.stat(self._state_filename).st_mode))
+            os.rename(tmp_name, self._state_filename)
+        except Exception:
+            if os.path.exists(tmp_name):
+                os.unlink(tmp_name)
+            raise
+        _fsync_directory(directory)
+        self._saved_data = list(self._data)
+
+    def _load_specs(self, name):
+        if name not in self._specs:
+            specs = super(IndexedState, self)._load_specs(name)
+            self._specs[name] = specs
+            self._literals[name] = frozenset(
+                tuple(spec) for spec in specs if is_literal(spec))
+
+        if (self._hw_items is not None and
+                not self._literals[name].issubset(self._hw_items)):
+            LOG.debug('Profile %s ruled out by its literal specs' % name)
+            # The specs State uses for a missing profile never match.
+            return state._INVALID_SPECS
+        return self._specs[name]
+
+    def find_match(self, hw_items):
+        self._hw_items = frozenset(tuple(item) for item in hw_items)
+        try:
+            return super(IndexedState, self).find_match(hw_items)
+        finally:
+            self._hw_items = None
+
+    def reserve(self, used):
+        """Decrement the counters of the profiles used by another State.
+
+        :param used: dictionary mapping profile names to the number of
+            nodes that matched them
+        :returns: False, leaving the counters unchanged, if one of the
+            profiles is gone or has fewer nodes left than it was used for.
+        """
+        for name, count in used.items():
+            try:
+                times = self[name]
+            except KeyError:
+                return False
+            if times != '*' and int(times) < count:
+                return False
+        self._data = [(name, times if times == '*'
+                       else int(times) - used.get(name, 0))
+                      for name, times in self._data]
+        return True
+
+    def release(self, used):
+        """Give back the counters taken by reserve."""
+        for name, count in used.items():
+            for _ in range(count):
+                self.failed_profile(name)
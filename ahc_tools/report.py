@@ -11,15 +11,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import atexit
+import json
 import logging
 import sys
 
-from hardware.cardiff import cardiff
-from hardware.cardiff import compare_sets
-from hardware.cardiff import utils as cardiff_utils
 from oslo_config import cfg
 
 from ahc_tools import conf  # noqa
+from ahc_tools import metrics
+from ahc_tools import snapshot
 from ahc_tools import utils
 
 CONF = cfg.CONF
@@ -47,16 +48,63 @@ report_cli_opts = [
                dest='unique_id',
                default='uuid',
                choices=['uuid', 'serial'],
-               help='Unique key to identify the nodes by.')
+               help='Unique key to identify the nodes by.'),
+    cfg.IntOpt('jobs',
+               short='j',
+               default=1,
+               min=0,
+               help='Number of processes analyzing the hardware categories '
+                    'and the performance of the nodes in parallel, 0 for '
+                    'one per CPU.'),
+    cfg.StrOpt('outliers-engine',
+               dest='outliers_engine',
+               default='cardiff',
+               choices=['cardiff', 'numpy'],
+               help='Engine looking for the performance outliers: the '
+                    'checks of cardiff, or their vectorized NumPy versions '
+                    'which print the same report faster on large groups.'),
+    cfg.StrOpt('format',
+               default='text',
+               choices=['text', 'json'],
+               help='Print the report as text, or as a JSON result that '
+                    'can be rendered again with --from-result.'),
+    cfg.StrOpt('from-result',
+               dest='from_result',
+               help='Render the report from a JSON result printed by a '
+                    'previous run with --format json, instead of analyzing '
+                    'the facts of the nodes again.'),
 ]
 
+RESULT_VERSION = 2
 
-def print_report(facts):
-    # The global_params are only used for a single output_dir key.
-    # The output_dir key is not currently useful for this use case.
-    # We could probably refactor hardware to make it a kwarg, so we don't need
-    # to pass an empty dictionary.
-    global_params = {}
+
+def report_sections():
+    """Return the names of the sections of the report to print."""
+    return [name for name in ('groups', 'categories', 'outliers')
+            if CONF.full or getattr(CONF, name)]
+
+
+def compute_report(facts):
+    """Analyze the facts and return the result of the report.
+
+    Only the sections selected by the options are computed. The result
+    only contains lists, dictionaries and strings, so that it can be
+    serialized to JSON and rendered again with render_report.
+
+    :returns: dictionary with the unique_id and the sections of the
+        report: 'groups', the list of the hosts of each group of identical
+        hardware, 'categories', the title and groups of hosts of each
+        hardware category, 'similar_groups', the groups of hosts identical
+        in every category, and 'outliers', the check, group and items of
+        each performance check, see analysis.performance_report.
+    """
+    # cardiff pulls pandas in, it is only imported once there is a report
+    # to print, so that --help and usage errors return quickly.
+    from hardware.cardiff import compare_sets
+
+    from ahc_tools import analysis
+
+    sections = report_sections()
     # The detail dictionary has three keys (group, category, item). This is
     # only used in the case that we have the print_level set to
     # utils.Levels.DETAIL
@@ -68,21 +116,97 @@ def print_report(facts):
     # unique_id can either be 'serial' or 'uuid', in virtual environments
     # 'serial' is not reported so we default to 'uuid'
     unique_id = CONF.unique_id
+    result = {'version': RESULT_VERSION, 'unique_id': unique_id}
+    # Every stage reads the facts through this index, built in one pass.
+    index = analysis.FactsIndex(facts, unique_id)
     # Extract the host list from the data to get the initial list of hosts.
     systems_groups = []
-    systems_groups.append(cardiff_utils.get_hosts_list(facts, unique_id))
-    # Print the group information
-    if CONF.groups or CONF.full:
-        compare_sets.print_systems_groups(systems_groups)
+    systems_groups.append(set(index.host_set))
+    if 'groups' in sections:
+        result['groups'] = [list(group) for group in systems_groups]
+
+    # The results of the previous run are reused for the hosts whose facts
+    # did not change since then.
+    report_state = analysis.load_state(unique_id)
+
+    if 'categories' in sections:
+        result['categories'] = []
+        for title, groups in analysis.group_categories(
+                index, ignore_list, report_state, jobs=CONF.jobs):
+            compare_sets.compute_similar_hosts_list(
+                systems_groups,
+                compare_sets.get_hosts_list_from_result(groups))
+            result['categories'].append({'title': title, 'groups': groups})
+        result['similar_groups'] = [list(group) for group in systems_groups]
+
+    if 'outliers' in sections:
+        result['outliers'] = analysis.performance_report(
+            index, systems_groups, detail, report_state, jobs=CONF.jobs,
+            engine=CONF.outliers_engine)
+
+    report_state.save()
+    return result
 
-    # Print the category information
-    if CONF.categories or CONF.full:
-        cardiff.group_systems(global_params, facts, unique_id,
-                              systems_groups, ignore_list)
 
-    # Print the outlier information
-    if CONF.outliers or CONF.full:
-        cardiff.compare_performance(facts, unique_id, systems_groups, detail)
+def render_report(result):
+    """Print the sections of a result selected by the options as text."""
+    from hardware.cardiff import compare_sets
+
+    from ahc_tools import analysis
+
+    sections = report_sections()
+    # The global_params are only used for a single output_dir key.
+    # The output_dir key is not currently useful for this use case.
+    # We could probably refactor hardware to make it a kwarg, so we don't need
+    # to pass an empty dictionary.
+    global_params = {}
+    if 'groups' in sections:
+        compare_sets.print_systems_groups(result['groups'])
+    if 'categories' in sections:
+        for category in result['categories']:
+            compare_sets.print_groups(global_params, category['groups'],
+                                      category['title'])
+    if 'outliers' in sections:
+        for check_report in result['outliers']:
+            analysis.render_performance(check_report)
+
+
+def write_report(result):
+    """Print a result in the format selected by --format."""
+    if CONF.format == 'json':
+        sections = ['version', 'unique_id'] + report_sections()
+        if 'categories' in sections:
+            sections.append('similar_groups')
+        # The keys are not sorted, the groups of a category are printed in
+        # the order of their dictionary.
+        json.dump(dict((key, value) for key, value in result.items()
+                       if key in sections),
+                  sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        render_report(result)
+
+
+def load_result(path):
+    """Load a result written with --format json.
+
+    :raises: ValueError if the file is not a result of this version, or
+        misses one of the sections selected by the options.
+    """
+    with open(path) as result_file:
+        result = json.load(result_file)
+    if not isinstance(result, dict) or result.get('version') != RESULT_VERSION:
+        raise ValueError('unsupported result version')
+    missing = [name for name in report_sections() if name not in result]
+    if missing:
+        raise ValueError('the %s section(s) were not computed, run the '
+                         'report again with the matching options' %
+                         ', '.join(missing))
+    return result
+
+
+def print_report(facts):
+    render_report(compute_report(facts))
 
 
 def main(args=sys.argv[1:]):
@@ -90,6 +214,9 @@ def main(args=sys.argv[1:]):
     CONF(args=args, default_config_files=utils.DEFAULT_CONF_FILES)
     debug = CONF.report.debug
     utils.setup_logging(debug)
+    if CONF.metrics:
+        metrics.enable()
+        atexit.register(metrics.get_metrics().write, CONF.metrics)
 
     # If we did not pass any print arguments, print the help and exit
     if not (CONF.groups or CONF.categories or CONF.outliers or CONF.full):
@@ -97,8 +224,29 @@ def main(args=sys.argv[1:]):
         LOG.error("You did not specify anything to print.")
         sys.exit(1)
 
-    ironic_client = utils.get_ironic_client()
-    nodes = ironic_client.node.list(detail=True)
-    facts = [utils.get_facts(node) for node in nodes]
+    if CONF.from_result:
+        try:
+            result = load_result(CONF.from_result)
+        except (IOError, OSError, ValueError) as e:
+            LOG.error('Failed to load the report result from %s: %s' %
+                      (CONF.from_result, e))
+            sys.exit(1)
+        write_report(result)
+        return
+
+    if CONF.snapshot:
+        with metrics.timed('snapshot_load'):
+            nodes, facts, errors = snapshot.load(CONF.snapshot,
+                                                 utils.node_selected)
+    else:
+        ironic_client = utils.get_ironic_client()
+        nodes, facts, errors = utils.stream_facts(
+            utils.list_nodes(ironic_client))
+    for uuid, error in sorted(errors.items()):
+        LOG.error('Failed to get the facts of node %s, it will not be part '
+                  'of the report. Error was: %s' % (uuid, error))
 
-    print_report(facts)
+    with metrics.timed('report'):
+        result = compute_report([node_facts for node_facts in facts
+                                 if node_facts is not None])
+    write_report(result)
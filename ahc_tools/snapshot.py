@@ -0,0 +1,125 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gzip
+import json
+import logging
+import os
+import sys
+import tempfile
+
+from oslo_config import cfg
+
+from ahc_tools import conf  # noqa
+from ahc_tools import facts_parser
+from ahc_tools import utils
+
+CONF = cfg.CONF
+
+LOG = logging.getLogger('ahc_tools.snapshot')
+
+SNAPSHOT_VERSION = 1
+
+# Node attributes kept in a snapshot.
+NODE_FIELDS = ('uuid', 'extra', 'properties', 'provision_state',
+               'maintenance', 'driver', 'instance_uuid')
+
+snapshot_cli_opts = [
+    cfg.StrOpt('output',
+               short='O',
+               required=True,
+               help='File to write the snapshot to.'),
+]
+
+
+class SnapshotNode(object):
+    """Ironic node read back from a snapshot."""
+
+    def __init__(self, **fields):
+        for field in NODE_FIELDS:
+            setattr(self, field, fields.get(field))
+
+
+def save(path, nodes, facts):
+    """Write the nodes and their facts to a gzip compressed JSON file.
+
+    :param path: file to write the snapshot to
+    :param nodes: list of Ironic nodes
+    :param facts: list with the facts of each node, None for the nodes
+        whose facts could not be fetched
+    """
+    data = {'version': SNAPSHOT_VERSION,
+            'nodes': [dict((field, getattr(node, field, None))
+                           for field in NODE_FIELDS) for node in nodes],
+            'facts': dict((node.uuid, node_facts)
+                          for node, node_facts in zip(nodes, facts)
+                          if node_facts is not None)}
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as raw_file:
+            with gzip.GzipFile(fileobj=raw_file, mode='wb') as snapshot_file:
+                snapshot_file.write(json.dumps(data).encode('utf-8'))
+        os.rename(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+def load(path, select=None):
+    """Read the nodes and their facts from a snapshot.
+
+    :param path: snapshot written by save
+    :param select: if set, only the nodes for which select(node) is true
+        are returned
+    :returns: a (nodes, facts, errors) tuple like the one of fetching the
+        facts of the nodes from Ironic and Swift.
+    :raises: ValueError, if the file is not a snapshot.
+    """
+    with gzip.open(path, 'rb') as snapshot_file:
+        data = json.loads(snapshot_file.read().decode('utf-8'))
+    if not isinstance(data, dict) or data.get('version') != SNAPSHOT_VERSION:
+        raise ValueError('%s is not a version %d ahc-tools snapshot' %
+                         (path, SNAPSHOT_VERSION))
+
+    nodes = [SnapshotNode(**fields) for fields in data['nodes']]
+    if select is not None:
+        nodes = [node for node in nodes if select(node)]
+    facts = []
+    errors = {}
+    for node in nodes:
+        node_facts = data['facts'].get(node.uuid)
+        if node_facts is None:
+            facts.append(None)
+            errors[node.uuid] = 'The snapshot holds no facts for this node'
+        else:
+            facts.append([facts_parser.to_fact(fact) for fact in node_facts])
+    return nodes, facts, errors
+
+
+def main(args=sys.argv[1:]):
+    CONF.register_cli_opts(snapshot_cli_opts)
+    CONF(args=args, default_config_files=utils.DEFAULT_CONF_FILES)
+    # The snapshots feed ahc-report, which shares its debug setting.
+    utils.setup_logging(CONF.report.debug)
+
+    ironic_client = utils.get_ironic_client()
+    nodes, facts, errors = utils.stream_facts(
+        utils.list_nodes(ironic_client, NODE_FIELDS))
+    for uuid, error in sorted(errors.items()):
+        LOG.error('Failed to get the facts of node %s, they will not be '
+                  'part of the snapshot. Error was: %s' % (uuid, error))
+
+    save(CONF.output, nodes, facts)
+    LOG.info('Saved %d nodes and the facts of %d of them to %s' %
+             (len(nodes), len(nodes) - len(errors), CONF.output))
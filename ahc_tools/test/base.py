@@ -16,7 +16,11 @@ import unittest
 from oslo_config import cfg
 
 # Import configuration options
+from ahc_tools import cache
+from ahc_tools.common import swift
 from ahc_tools import conf  # noqa
+from ahc_tools import metrics
+from ahc_tools import tokens
 
 CONF = cfg.CONF
 
@@ -27,3 +31,7 @@ class BaseTest(unittest.TestCase):
         CONF.reset()
         for group in ('ironic', 'swift'):
             CONF.register_group(cfg.OptGroup(group))
+        swift.reset_pool()
+        cache.reset_cache()
+        metrics.reset_metrics()
+        tokens.reset_token_cache()
@@ -0,0 +1,275 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from hardware.cardiff import cardiff
+from hardware.cardiff import check
+from hardware.cardiff import utils as cardiff_utils
+import mock
+from oslo_config import cfg
+
+from ahc_tools import analysis
+from ahc_tools.bench import fleet
+from ahc_tools.test import base
+
+CONF = cfg.CONF
+
+
+def _node_facts(uuid, cpu='Intel Xeon', firmware='1.0'):
+    return [('system', 'product', 'uuid', uuid),
+            ('cpu', 'physical_0', 'product', cpu),
+            ('firmware', 'bios', 'version', firmware),
+            ('network', 'eth0', 'serial', uuid)]
+
+
+def _facts_length(facts, offset):
+    if offset < 0:
+        raise ValueError('negative offset')
+    return len(facts) + offset
+
+
+def _index(facts):
+    return analysis.FactsIndex(facts, 'uuid')
+
+
+class TestFactsIndex(base.BaseTest):
+    def setUp(self):
+        super(TestFactsIndex, self).setUp()
+        self.facts = fleet.generate_fleet(5, 60, 0.5)
+        self.facts.append([('cpu', 'logical', 'number', '4')])
+
+    def test_same_as_cardiff(self):
+        index = _index(self.facts)
+        self.assertEqual(cardiff_utils.get_hosts_list(self.facts, 'uuid'),
+                         index.host_set)
+        hosts = set([fleet.node_uuid(1), fleet.node_uuid(3)])
+        for element in analysis.ELEMENTS:
+            self.assertEqual(
+                cardiff_utils.find_sub_element(self.facts, 'uuid', element),
+                index.systems(element))
+            self.assertEqual(
+                cardiff_utils.find_sub_element(self.facts, 'uuid', element,
+                                               hosts),
+                index.systems(element, hosts))
+        self.assertEqual([fleet.node_uuid(i) for i in range(5)] + [''],
+                         index.hosts())
+
+    def test_fingerprints(self):
+        before = _index(self.facts)
+        self.facts[0] = [fact for fact in self.facts[0]
+                         if fact[0] != 'firmware']
+        after = _index(self.facts)
+        uuid = fleet.node_uuid(0)
+        for element in analysis.ELEMENTS:
+            self.assertEqual(element == 'firmware',
+                             before.fingerprints[element][uuid] !=
+                             after.fingerprints[element][uuid])
+
+
+class TestGroupCategories(base.BaseTest):
+    def setUp(self):
+        super(TestGroupCategories, self).setUp()
+        self.facts = [_node_facts('uuid1'),
+                      _node_facts('uuid2', firmware='2.0'),
+                      _node_facts('uuid3')]
+
+    def _cardiff_groups(self, facts):
+        """Groups printed by cardiff.group_systems, per title."""
+        groups = {}
+        with mock.patch.object(cardiff.compare_sets, 'print_groups',
+                               autospec=True) as pg_mock:
+            cardiff.group_systems({}, facts, 'uuid', [set()], 'system')
+        for call in pg_mock.call_args_list:
+            groups[call[0][2]] = dict(
+                (analysis.canonical_signature(signature), group)
+                for signature, group in call[0][1].items())
+        return groups
+
+    def test_same_groups_as_cardiff(self):
+        state = analysis.ReportState()
+        categories = analysis.group_categories(_index(self.facts), 'system',
+                                               state)
+        self.assertEqual(self._cardiff_groups(self.facts), dict(categories))
+        self.assertEqual({'Intel Xeon'}, set(
+            fact[3] for sig in dict(categories)['Processors']
+            for fact in eval(sig)))
+
+    def test_unchanged_hosts_reused(self):
+        state = analysis.ReportState()
+        analysis.group_categories(_index(self.facts), 'system', state)
+
+        self.facts[1] = _node_facts('uuid2')
+        with mock.patch.object(analysis.FactsIndex, 'systems', autospec=True,
+                               side_effect=analysis.FactsIndex.systems
+                               ) as systems_mock:
+            categories = analysis.group_categories(_index(self.facts),
+                                                   'system', state)
+        # Only the changed category of the changed host is analyzed again.
+        self.assertEqual([('firmware', ['uuid2'])],
+                         [call[0][1:] for call in systems_mock.call_args_list])
+        self.assertEqual(self._cardiff_groups(self.facts), dict(categories))
+        self.assertEqual(1, len(dict(categories)['Firmware']))
+
+    def test_reused_by_other_hash_seeds(self):
+        # The signatures of a run are reused by runs of another process,
+        # whose sets of facts have another order.
+        script = ('import json, sys\n'
+                  'from ahc_tools import analysis\n'
+                  'from ahc_tools.bench import fleet\n'
+                  'index = analysis.FactsIndex(\n'
+                  '    fleet.generate_fleet(3, 200, 0), "uuid")\n'
+                  'state = analysis.ReportState()\n'
+                  'analysis.group_categories(index, "system", state)\n'
+                  'json.dump(state.hosts, sys.stdout)\n')
+        outputs = set()
+        for seed in ('1', '2', '3'):
+            env = dict(os.environ, PYTHONHASHSEED=seed)
+            outputs.add(subprocess.check_output([sys.executable, '-c',
+                                                 script], env=env))
+        self.assertEqual(1, len(outputs))
+        hosts = json.loads(outputs.pop().decode('utf-8'))
+        self.assertEqual(1, len(set(host['Processors']['signature']
+                                    for host in hosts.values())))
+
+    def test_removed_hosts_forgotten(self):
+        state = analysis.ReportState()
+        analysis.group_categories(_index(self.facts), 'system', state)
+        analysis.group_categories(_index(self.facts[:2]), 'system', state)
+        self.assertEqual(set(['uuid1', 'uuid2']), set(state.hosts))
+
+    def test_jobs(self):
+        index = _index(fleet.generate_fleet(20, 60, 0.5))
+        categories = analysis.group_categories(index, 'system',
+                                               analysis.ReportState())
+        self.assertEqual(categories, analysis.group_categories(
+            index, 'system', analysis.ReportState(), jobs=3))
+
+
+class TestRunTasks(base.BaseTest):
+    def test_in_process(self):
+        with mock.patch.object(analysis.multiprocessing, 'Pool',
+                               autospec=True) as pool_mock:
+            self.assertEqual([3, 4], analysis.run_tasks(
+                _facts_length, [(0,), (1,)], ['a', 'b', 'c']))
+        self.assertFalse(pool_mock.called)
+
+    def test_processes(self):
+        tasks = [(offset,) for offset in range(10)]
+        self.assertEqual([3 + offset for offset in range(10)],
+                         analysis.run_tasks(_facts_length, tasks,
+                                            ['a', 'b', 'c'], jobs=4))
+
+    def test_error(self):
+        self.assertRaises(ValueError, analysis.run_tasks, _facts_length,
+                          [(0,), (-1,)], [], jobs=2)
+
+
+class TestReportState(base.BaseTest):
+    def setUp(self):
+        super(TestReportState, self).setUp()
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+
+    def test_not_persisted_without_cache(self):
+        state = analysis.load_state('uuid')
+        self.assertIsNone(state.path)
+        state.save()
+
+    def test_persisted(self):
+        CONF.set_override('directory', self.cache_dir, 'cache')
+        facts = [_node_facts('uuid1')]
+        state = analysis.load_state('uuid')
+        analysis.group_categories(_index(facts), 'system', state)
+        state.save()
+        self.assertTrue(os.path.exists(
+            os.path.join(self.cache_dir, analysis.STATE_FILE)))
+
+        state = analysis.load_state('uuid')
+        self.assertEqual(
+            analysis.fingerprint([('firmware', 'bios', 'version', '1.0')]),
+            state.hosts['uuid1']['Firmware']['fingerprint'])
+        # A state recorded for another unique id is not used.
+        self.assertEqual({}, analysis.load_state('serial').hosts)
+
+    def test_other_version_dropped(self):
+        # Older states hold signatures depending on the hash seed.
+        CONF.set_override('directory', self.cache_dir, 'cache')
+        state = analysis.load_state('uuid')
+        analysis.group_categories(_index([_node_facts('uuid1')]), 'system',
+                                  state)
+        with mock.patch.object(analysis, 'STATE_VERSION',
+                               analysis.STATE_VERSION - 1):
+            state.save()
+        self.assertEqual({}, analysis.load_state('uuid').hosts)
+
+
+@mock.patch.object(check, 'network_perf', autospec=True)
+@mock.patch.object(check, 'memory_perf', autospec=True)
+@mock.patch.object(check, 'cpu_perf', autospec=True)
+@mock.patch.object(check, 'logical_disks_perf', autospec=True)
+class TestComparePerformance(base.BaseTest):
+    def setUp(self):
+        super(TestComparePerformance, self).setUp()
+        self.facts = [_node_facts('uuid1'), _node_facts('uuid2')]
+        self.groups = [set(['uuid1', 'uuid2'])]
+        self.detail = {'group': '', 'category': '', 'item': ''}
+
+    def test_checks_run_once_per_unchanged_group(self, disks_mock, cpu_mock,
+                                                 memory_mock, network_mock):
+        cpu_mock.side_effect = lambda *args: sys.stdout.write('cpu report\n')
+        state = analysis.ReportState()
+        with mock.patch('sys.stdout') as stdout_mock:
+            analysis.compare_performance(_index(self.facts), self.groups,
+                                         self.detail, state)
+            analysis.compare_performance(_index(self.facts), self.groups,
+                                         self.detail, state)
+        self.assertEqual(2, disks_mock.call_count)
+        self.assertEqual(1, cpu_mock.call_count)
+        self.assertEqual(1, memory_mock.call_count)
+        self.assertEqual(1, network_mock.call_count)
+        stdout_mock.write.assert_any_call('cpu report\n')
+
+    def test_checks_run_again_on_change(self, disks_mock, cpu_mock,
+                                        memory_mock, network_mock):
+        state = analysis.ReportState()
+        analysis.compare_performance(_index(self.facts), self.groups,
+                                     self.detail, state)
+        self.facts[0] = _node_facts('uuid1', cpu='AMD Opteron')
+        analysis.compare_performance(_index(self.facts), self.groups,
+                                     self.detail, state)
+        # Only the checks reading the cpu facts run again.
+        self.assertEqual(2, cpu_mock.call_count)
+        self.assertEqual(2, memory_mock.call_count)
+        self.assertEqual(1, network_mock.call_count)
+        self.assertEqual(2, disks_mock.call_count)
+
+
+class TestComparePerformanceJobs(base.BaseTest):
+    def test_same_output(self):
+        index = _index(fleet.generate_fleet(20, 60, 0.5))
+        groups = [set(fleet.node_uuid(i) for i in range(10)),
+                  set(fleet.node_uuid(i) for i in range(10, 20))]
+        detail = {'group': '', 'category': '', 'item': ''}
+        outputs = []
+        for jobs in (1, 3):
+            outputs.append(analysis._capture_output(
+                analysis.compare_performance, index, groups, detail,
+                analysis.ReportState(), jobs))
+        self.assertTrue(outputs[0])
+        self.assertEqual(outputs[0], outputs[1])
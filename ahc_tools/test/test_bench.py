@@ -0,0 +1,135 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import shutil
+import tempfile
+
+import mock
+from oslo_config import cfg
+
+from ahc_tools.bench import fleet
+from ahc_tools.bench import run
+from ahc_tools import outliers
+from ahc_tools import report
+from ahc_tools.test import base
+
+CONF = cfg.CONF
+
+
+class TestFleet(base.BaseTest):
+    def test_deterministic(self):
+        self.assertEqual(fleet.generate_fleet(5, seed=1),
+                         fleet.generate_fleet(5, seed=1))
+        self.assertNotEqual(fleet.generate_fleet(5, seed=1),
+                            fleet.generate_fleet(5, seed=2))
+
+    def test_num_facts(self):
+        facts = fleet.generate_node_facts(0, num_facts=500)
+        self.assertEqual(500, len(facts))
+        self.assertIn(('system', 'product', 'uuid', fleet.node_uuid(0)),
+                      facts)
+
+    def test_heterogeneity(self):
+        self.assertEqual(set([0]), set(fleet.node_model(index, 0)
+                                       for index in range(100)))
+        self.assertNotIn(0, set(fleet.node_model(index, 1)
+                                for index in range(100)))
+
+
+class BenchBase(base.BaseTest):
+    def setUp(self):
+        super(BenchBase, self).setUp()
+        CONF.register_cli_opts(report.report_cli_opts)
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+
+class TestRun(BenchBase):
+    def test_match_profiles(self):
+        bench_fleet = run.Fleet(20, 100, 0.5, 0)
+        self.addCleanup(bench_fleet.cleanup)
+        CONF.set_override('configdir', bench_fleet.configdir, 'edeploy')
+        CONF.set_override('lockname', None, 'edeploy')
+
+        run.bench_match(bench_fleet)
+
+        for index, node in enumerate(bench_fleet.nodes):
+            self.assertEqual(
+                'model%d' % fleet.node_model(index, 0.5),
+                bench_fleet.nodes_info[node.uuid]['hardware']['profile'])
+
+    def test_parse(self):
+        bench_fleet = run.Fleet(3, 50, 0, 0)
+        self.addCleanup(bench_fleet.cleanup)
+        with mock.patch.object(run.utils, '_get_swift_facts',
+                               wraps=run.utils._get_swift_facts) as get_mock:
+            run.bench_parse(bench_fleet)
+        self.assertEqual(3, get_mock.call_count)
+
+    def test_outliers(self):
+        bench_fleet = run.Fleet(5, 50, 0, 0)
+        self.addCleanup(bench_fleet.cleanup)
+        with mock.patch.object(outliers, 'network_perf',
+                               wraps=outliers.network_perf) as net_mock:
+            run.bench_outliers(bench_fleet)
+        self.assertEqual(1, net_mock.call_count)
+
+    def test_run(self):
+        results = run.run([2, 3], ['parse', 'match', 'patches'],
+                          num_facts=50, repeat=2)
+        self.assertEqual([('parse', 2), ('match', 2), ('patches', 2),
+                          ('parse', 3), ('match', 3), ('patches', 3)],
+                         [(result['benchmark'], result['nodes'])
+                          for result in results])
+        for result in results:
+            self.assertTrue(result['best'] <= result['median'])
+
+    def test_compare(self):
+        baseline = {'results': [
+            {'benchmark': 'parse', 'nodes': 10, 'best': 1.0},
+            {'benchmark': 'match', 'nodes': 10, 'best': 1.0}]}
+        results = [{'benchmark': 'parse', 'nodes': 10, 'best': 1.1},
+                   {'benchmark': 'match', 'nodes': 10, 'best': 2.0},
+                   {'benchmark': 'report', 'nodes': 10, 'best': 5.0}]
+        self.assertEqual([('match', 10, 2.0)],
+                         run.compare(baseline, results, 1.25))
+
+
+class TestMain(BenchBase):
+    def test_main(self):
+        output = os.path.join(self.tmpdir, 'results.json')
+        run.main(args=['--output', output, '--sizes', '2',
+                       '--benchmarks', 'parse,report', '--repeat', '1'])
+        with open(output) as output_file:
+            data = json.load(output_file)
+        self.assertEqual(run.RESULTS_VERSION, data['version'])
+        self.assertEqual(['parse', 'report'],
+                         [result['benchmark'] for result in data['results']])
+
+    def test_regression(self):
+        output = os.path.join(self.tmpdir, 'results.json')
+        baseline = os.path.join(self.tmpdir, 'baseline.json')
+        with open(baseline, 'w') as baseline_file:
+            json.dump({'results': [{'benchmark': 'parse', 'nodes': 2,
+                                    'best': 1e-9}]}, baseline_file)
+        self.assertRaises(SystemExit, run.main,
+                          args=['--output', output, '--sizes', '2',
+                                '--benchmarks', 'parse', '--repeat', '1',
+                                '--baseline', baseline])
+
+    def test_unknown_benchmark(self):
+        self.assertRaises(SystemExit, run.main,
+                          args=['--output', 'results.json',
+                                '--benchmarks', 'foo'])
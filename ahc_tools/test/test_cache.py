@@ -0,0 +1,71 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+
+from oslo_config import cfg
+
+from ahc_tools import cache
+from ahc_tools.test import base
+
+CONF = cfg.CONF
+
+
+class TestFactsCache(base.BaseTest):
+    def setUp(self):
+        super(TestFactsCache, self).setUp()
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+
+    def _entries(self):
+        return [name for name in os.listdir(self.cache_dir)
+                if name.endswith('.facts')]
+
+    def test_put_get(self):
+        facts_cache = cache.FactsCache(self.cache_dir, 1024)
+        self.assertIsNone(facts_cache.get('obj1'))
+        facts_cache.put('obj1', 'etag1', b'[["cpu"]]')
+        self.assertEqual(('etag1', b'[["cpu"]]'), facts_cache.get('obj1'))
+
+    def test_persisted(self):
+        cache.FactsCache(self.cache_dir, 1024).put('obj1', 'etag1', b'[]')
+        facts_cache = cache.FactsCache(self.cache_dir, 1024)
+        self.assertEqual(('etag1', b'[]'), facts_cache.get('obj1'))
+
+    def test_lru_eviction(self):
+        facts_cache = cache.FactsCache(self.cache_dir, 100)
+        facts_cache.put('obj1', 'etag1', b'x' * 40)
+        facts_cache.put('obj2', 'etag2', b'x' * 40)
+        # Using obj1 makes obj2 the least recently used entry.
+        facts_cache.get('obj1')
+        facts_cache.put('obj3', 'etag3', b'x' * 40)
+        self.assertIsNotNone(facts_cache.get('obj1'))
+        self.assertIsNone(facts_cache.get('obj2'))
+        self.assertIsNotNone(facts_cache.get('obj3'))
+        self.assertEqual(2, len(self._entries()))
+
+    def test_replace_entry(self):
+        facts_cache = cache.FactsCache(self.cache_dir, 100)
+        facts_cache.put('obj1', 'etag1', b'x' * 40)
+        facts_cache.put('obj1', 'etag2', b'y' * 40)
+        self.assertEqual(('etag2', b'y' * 40), facts_cache.get('obj1'))
+        self.assertEqual(1, len(self._entries()))
+
+    def test_disabled(self):
+        self.assertIsNone(cache.get_cache())
+
+    def test_get_cache_shared(self):
+        CONF.set_override('directory', self.cache_dir, 'cache')
+        self.assertIs(cache.get_cache(), cache.get_cache())
@@ -0,0 +1,158 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import zlib
+
+import mock
+
+from ahc_tools import facts_parser
+from ahc_tools.test import base
+
+
+def _gzip(blob):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(blob) + compressor.flush()
+
+
+class FakeZstandard(object):
+    """zstandard module "compressing" by prepending the magic bytes."""
+
+    class ZstdError(Exception):
+        pass
+
+    class ZstdDecompressor(object):
+        def decompressobj(self):
+            return FakeZstandard.Decompressor()
+
+    class Decompressor(object):
+        def __init__(self):
+            self.skip = len(facts_parser.ZSTD_MAGIC)
+
+        def decompress(self, data):
+            skipped = data[:self.skip]
+            self.skip -= len(skipped)
+            return data[len(skipped):]
+
+        def flush(self):
+            return b''
+
+
+class TestIterFacts(base.BaseTest):
+    def setUp(self):
+        super(TestIterFacts, self).setUp()
+        self.facts = [[u'cpu', u'logical_%d' % i, u'bogomips', u'4199.99']
+                      for i in range(50)]
+        self.facts.append([u'system', u'product', u'vendor', u'Soci\xe9t\xe9'])
+        self.blob = json.dumps(self.facts, indent=1,
+                               ensure_ascii=False).encode('utf-8')
+        self.expected = [tuple(fact) for fact in self.facts]
+
+    def test_any_chunk_size(self):
+        for size in (1, 2, 7, 100, len(self.blob)):
+            chunks = [self.blob[i:i + size]
+                      for i in range(0, len(self.blob), size)]
+            self.assertEqual(self.expected,
+                             list(facts_parser.iter_facts(chunks)))
+
+    def test_text_blob(self):
+        self.assertEqual(self.expected,
+                         facts_parser.parse_facts(self.blob.decode('utf-8')))
+
+    def test_empty(self):
+        self.assertEqual([], facts_parser.parse_facts(b' [ ] '))
+
+    def test_strings_interned(self):
+        first = facts_parser.parse_facts(
+            b'[["cpu", "logical", "number", "4"]]')
+        second = facts_parser.parse_facts(
+            b'[["cpu", "logical", "number", "4"]]')
+        for index in range(3):
+            self.assertIs(first[0][index], second[0][index])
+
+    def test_invalid(self):
+        for blob in (b'', b'{}', b'[["cpu"]', b'[["cpu"] ["disk"]]',
+                     b'[["cpu"]] []', b'[1]'):
+            self.assertRaises(ValueError, facts_parser.parse_facts, blob)
+
+
+class TestDecompressChunks(base.BaseTest):
+    def setUp(self):
+        super(TestDecompressChunks, self).setUp()
+        self.blob = json.dumps([['cpu', 'logical_%d' % i, 'bogomips', '4199']
+                                for i in range(100)]).encode('utf-8')
+
+    def _decompressed(self, blob, size, encoding=None):
+        chunks = [blob[i:i + size] for i in range(0, len(blob), size)]
+        return b''.join(facts_parser.decompress_chunks(chunks, encoding))
+
+    def test_gzip(self):
+        compressed = _gzip(self.blob)
+        for size in (1, 3, 100, len(compressed)):
+            self.assertEqual(self.blob, self._decompressed(compressed, size))
+        self.assertEqual(self.blob,
+                         self._decompressed(compressed, 10, 'gzip'))
+
+    def test_gzip_members(self):
+        other = json.dumps([['disk', 'sda', 'size', '100']]).encode('utf-8')
+        compressed = _gzip(self.blob) + _gzip(other) + _gzip(b'')
+        for size in (1, 7, 100, len(compressed)):
+            self.assertEqual(self.blob + other,
+                             self._decompressed(compressed, size))
+
+    def test_gzip_corrupted(self):
+        self.assertRaises(ValueError, list, facts_parser.decompress_chunks(
+            [b'not gzip at all'], 'gzip'))
+        compressed = _gzip(self.blob)
+        corrupted = compressed[:20] + b'\xff' * 20 + compressed[40:]
+        self.assertRaises(ValueError, self._decompressed, corrupted, 10)
+
+    def test_not_compressed(self):
+        for size in (1, 100):
+            self.assertEqual(self.blob, self._decompressed(self.blob, size))
+        text = self.blob.decode('utf-8')
+        self.assertEqual([text],
+                         list(facts_parser.decompress_chunks([text])))
+        self.assertEqual([], list(facts_parser.decompress_chunks([])))
+
+    @mock.patch.object(facts_parser, '_zstandard', FakeZstandard)
+    def test_zstd(self):
+        compressed = facts_parser.ZSTD_MAGIC + self.blob
+        self.assertEqual(self.blob, self._decompressed(compressed, 2))
+        self.assertEqual(self.blob,
+                         self._decompressed(compressed, 100, 'zstd'))
+        self.assertEqual('gzip, zstd', facts_parser.accepted_encodings())
+
+    @mock.patch.object(facts_parser, '_zstandard', FakeZstandard)
+    def test_zstd_corrupted(self):
+        compressed = facts_parser.ZSTD_MAGIC + self.blob
+        with mock.patch.object(FakeZstandard.Decompressor, 'decompress',
+                               side_effect=FakeZstandard.ZstdError('bad')):
+            self.assertRaises(ValueError, self._decompressed, compressed,
+                              100)
+
+    @mock.patch.object(facts_parser, '_zstandard', False)
+    def test_zstd_missing(self):
+        compressed = facts_parser.ZSTD_MAGIC + self.blob
+        self.assertRaises(ValueError, self._decompressed, compressed, 100)
+        self.assertEqual('gzip', facts_parser.accepted_encodings())
+
+    def test_unsupported_encoding(self):
+        self.assertRaises(ValueError, self._decompressed, self.blob, 100,
+                          'br')
+
+    def test_parsed(self):
+        chunks = [_gzip(self.blob)]
+        self.assertEqual(
+            100, len(list(facts_parser.iter_facts(
+                facts_parser.decompress_chunks(chunks)))))
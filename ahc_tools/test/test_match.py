@@ -13,14 +13,21 @@
 
 import mock
 import os
+import random
+import shutil
+import time
 
 from hardware import cmdb
 from hardware import state
+from ironicclient import client as ironic_client
+from ironicclient import exc as ironic_exc
 from oslo_config import cfg
 
+from ahc_tools.bench import run as bench_run
 from ahc_tools import exc
 from ahc_tools import match
 from ahc_tools.test import base
+from ahc_tools import tokens
 from ahc_tools import utils
 
 CONF = cfg.CONF
@@ -46,7 +53,8 @@ class MatchBase(base.BaseTest):
                               uuid=self.uuid,
                               power_state='power on',
                               provision_state='inspecting',
-                              extra={'on_discovery': 'true'},
+                              extra={'on_discovery': 'true',
+                                     'hardware_swift_object': 'obj'},
                               instance_uuid=None,
                               maintenance=False)
         self.facts = [
@@ -93,6 +101,25 @@ class TestMatch(MatchBase):
     def test_no_match(self, find_mock, mock_facts):
         self.assertRaises(exc.MatchFailedError, match.match, self.node, {})
 
+    def test_match_nodes(self, mock_facts):
+        other = mock.Mock(uuid='other-uuid', properties={}, extra={})
+        bad_facts = [['cpu', 'logical', 'number', '4']]
+        with mock.patch.object(state.State, 'load', autospec=True,
+                               side_effect=fake_load) as load_mock:
+            nodes_info, failures = match.match_nodes(
+                [self.node, other], [self.facts, bad_facts])
+        self.assertEqual(1, load_mock.call_count)
+        self.assertEqual('hw1', nodes_info[self.uuid]['hardware']['profile'])
+        self.assertEqual(['other-uuid'], list(failures))
+        self.assertIsInstance(failures['other-uuid'], exc.MatchFailedError)
+        self.assertFalse(mock_facts.called)
+
+    @mock.patch.object(state.State, '__init__',
+                       side_effect=Exception('boom'), autospec=True)
+    def test_match_nodes_load_failed(self, state_mock, mock_facts):
+        self.assertRaises(exc.LoadFailedError, match.match_nodes,
+                          [self.node], [self.facts])
+
     def test_multiple_capabilities(self, mock_facts):
         self.node.properties['capabilities'] = 'cat:meow,profile:robin'
         node_info = {'hardware': {'profile': 'batman'}, 'edeploy_facts': []}
@@ -102,6 +129,33 @@ class TestMatch(MatchBase):
         # Assert the old profile is gone
         self.assertNotIn('profile:robin', node_patches[1]['value'])
 
+    def test_unchanged_node_not_patched(self, mock_facts):
+        hardware = {'profile': 'hw1', 'iface': 'eth0'}
+        raid = {'logical_disks': ({'raid_level': '1', 'size_gb': 50},)}
+        node_info = {'hardware': hardware,
+                     'target_raid_configuration': raid,
+                     'bios_settings': {'ProcVirtualization': 'Disabled'}}
+        self.node.properties['capabilities'] = 'boot_mode:bios,profile:hw1'
+        # Ironic returns JSON, where the tuples became lists.
+        self.node.extra = {
+            'configdrive_metadata': {'hardware': dict(hardware)},
+            'target_raid_configuration': {
+                'logical_disks': [{'raid_level': '1', 'size_gb': 50}]},
+            'bios_settings': {'ProcVirtualization': 'Disabled'}}
+        self.assertEqual([], match.get_update_patches(self.node, node_info))
+
+    def test_only_changes_patched(self, mock_facts):
+        node_info = {'hardware': {'profile': 'hw2'},
+                     'bios_settings': {'ProcVirtualization': 'Enabled'}}
+        self.node.properties['capabilities'] = 'profile:hw1'
+        self.node.extra = {
+            'configdrive_metadata': {'hardware': {'profile': 'hw2'}},
+            'bios_settings': {'ProcVirtualization': 'Disabled'}}
+        node_patches = match.get_update_patches(self.node, node_info)
+        self.assertEqual(['/properties/capabilities', '/extra/bios_settings'],
+                         [patch['path'] for patch in node_patches])
+        self.assertEqual('profile:hw2', node_patches[0]['value'])
+
     def test_no_data(self, mock_facts):
         node_info = {}
         self.assertEqual([], match.get_update_patches(self.node, node_info))
@@ -148,51 +202,570 @@ class TestMatch(MatchBase):
 @mock.patch.object(match.cfg, 'ConfigParser', autospec=True)
 @mock.patch.object(match, 'LOG')
 @mock.patch.object(utils, 'get_ironic_client', autospec=True)
-@mock.patch.object(match, '_restore_state', lambda: None)
 class TestMain(MatchBase):
     def setUp(self):
         super(TestMain, self).setUp()
         self.mock_client = mock.Mock()
         self.mock_client.node.list.return_value = [self.node]
+        fetch_patcher = mock.patch.object(utils, 'stream_facts',
+                                          autospec=True)
+        self.mock_fetch = fetch_patcher.start()
+        self.mock_fetch.side_effect = lambda nodes: (list(nodes),
+                                                     [self.facts], {})
+        self.addCleanup(fetch_patcher.stop)
 
-    @mock.patch.object(match, '_copy_state', side_effect=Exception('boom'))
-    def test_copy_failed(self, mock_copy, mock_ic, mock_log, mock_cfg):
-        mock_ic.return_value = self.mock_client
-        self.assertRaises(SystemExit, match.main, args=[])
-        self.assertTrue(1, mock_log.error.call_count)
-
-    @mock.patch.object(match, 'match', autospec=True,
+    @mock.patch.object(match, 'match_nodes', autospec=True,
                        side_effect=exc.LoadFailedError('boom', '/etc/edeploy'))
-    @mock.patch.object(match, '_copy_state', lambda: None)
     def test_load_failed(self, mock_match, mock_ic, mock_log, mock_cfg):
         mock_ic.return_value = self.mock_client
         self.assertRaises(SystemExit, match.main, args=[])
         self.assertTrue(1, mock_log.error.call_count)
 
     @mock.patch.object(match, 'get_update_patches', autospec=True)
-    @mock.patch.object(match, 'match', autospec=True,
-                       side_effect=exc.MatchFailedError('boom', '1234567890'))
-    @mock.patch.object(match, '_copy_state', lambda: None)
+    @mock.patch.object(match, 'match_nodes', autospec=True)
     def test_match_failed(self, mock_match, mock_update, mock_ic, mock_log,
                           mock_cfg):
+        mock_match.return_value = (
+            {}, {self.uuid: exc.MatchFailedError('boom', self.uuid)})
         mock_ic.return_value = self.mock_client
         match.main(args=[])
         self.assertEqual(2, mock_log.error.call_count)
         self.assertFalse(mock_update.called)
 
-    @mock.patch.object(match, 'match', lambda x, y: None)
     @mock.patch.object(match, 'get_update_patches', lambda x, y: None)
-    @mock.patch.object(match, '_copy_state', lambda: None)
-    def test_match_success(self, mock_ic, mock_log, mock_cfg):
+    @mock.patch.object(match, 'match_nodes', autospec=True)
+    def test_match_success(self, mock_match, mock_ic, mock_log, mock_cfg):
+        mock_match.return_value = ({self.uuid: {}}, {})
         mock_ic.return_value = self.mock_client
         match.main(args=[])
         self.assertFalse(mock_log.error.called)
 
-    @mock.patch.object(match, 'match', lambda x, y: None)
-    @mock.patch.object(match, 'get_update_patches', lambda x, y: None)
-    @mock.patch.object(match, '_copy_state', lambda: None)
-    def test_update_failed(self, mock_ic, mock_log, mock_cfg):
+    @mock.patch.object(match, 'get_update_patches',
+                       lambda x, y: [{'op': 'add'}])
+    @mock.patch.object(match, 'match_nodes', autospec=True)
+    def test_update_failed(self, mock_match, mock_ic, mock_log, mock_cfg):
+        mock_match.return_value = ({self.uuid: {}}, {})
         self.mock_client.node.update.side_effect = Exception('boom')
         mock_ic.return_value = self.mock_client
         match.main(args=[])
-        self.assertTrue(1, mock_log.error.call_count)
+        self.assertEqual(1, mock_log.error.call_count)
+        self.mock_client.node.update.assert_called_once_with(
+            self.uuid, [{'op': 'add'}])
+
+    @mock.patch.object(match, 'match_nodes', autospec=True,
+                       return_value=({}, {}))
+    def test_facts_failed(self, mock_match, mock_ic, mock_log, mock_cfg):
+        self.mock_fetch.side_effect = lambda nodes: (
+            list(nodes), [None], {self.uuid: 'boom'})
+        mock_ic.return_value = self.mock_client
+        match.main(args=[])
+        mock_match.assert_called_once_with([], [], save=False)
+        self.assertFalse(self.mock_client.node.update.called)
+        self.assertEqual(2, mock_log.error.call_count)
+
+    @mock.patch.object(match, 'get_update_patches', lambda x, y: [])
+    @mock.patch.object(match, 'match_nodes', autospec=True)
+    def test_prefetched_facts_used(self, mock_match, mock_ic, mock_log,
+                                   mock_cfg):
+        mock_match.return_value = ({self.uuid: {}}, {})
+        mock_ic.return_value = self.mock_client
+        match.main(args=[])
+        mock_match.assert_called_once_with([self.node], [self.facts],
+                                           save=False)
+
+    @mock.patch.object(match, 'get_update_patches',
+                       lambda x, y: [{'op': 'add'}])
+    @mock.patch.object(match, 'match_nodes', autospec=True)
+    @mock.patch.object(match.snapshot, 'load', autospec=True)
+    def test_snapshot(self, mock_load, mock_match, mock_ic, mock_log,
+                      mock_cfg):
+        mock_load.return_value = ([self.node], [self.facts], {})
+        mock_match.return_value = ({self.uuid: {}}, {})
+        match.main(args=['--snapshot', '/tmp/fleet.snapshot'])
+        mock_load.assert_called_once_with('/tmp/fleet.snapshot',
+                                          utils.node_selected)
+        mock_match.assert_called_once_with([self.node], [self.facts],
+                                           save=False)
+        self.assertFalse(mock_ic.called)
+        self.assertFalse(self.mock_fetch.called)
+        self.assertFalse(mock_log.error.called)
+        self.assertEqual(1, mock_log.info.call_count)
+
+    @mock.patch.object(match, 'get_update_patches',
+                       lambda x, y: [{'op': 'add'}])
+    @mock.patch.object(match, 'match_nodes', autospec=True)
+    @mock.patch.object(match.atexit, 'register', autospec=True)
+    def test_metrics(self, mock_register, mock_match, mock_ic, mock_log,
+                     mock_cfg):
+        mock_match.return_value = ({self.uuid: {}}, {})
+        mock_ic.return_value = self.mock_client
+        match.main(args=['--metrics', '/tmp/metrics.json'])
+
+        metrics_obj = match.metrics.get_metrics()
+        mock_register.assert_called_once_with(metrics_obj.write,
+                                              '/tmp/metrics.json')
+        phases = metrics_obj.summary()['phases']
+        self.assertEqual(1, phases['node_list']['count'])
+        self.assertEqual(1, phases['node_update']['count'])
+
+    @mock.patch.object(match, 'match_pipelined', autospec=True)
+    def test_pipeline(self, mock_pipelined, mock_ic, mock_log, mock_cfg):
+        mock_pipelined.return_value = ([self.uuid], [], [], {})
+        mock_ic.return_value = self.mock_client
+        match.main(args=['--pipeline'])
+        self.assertEqual(self.mock_client, mock_pipelined.call_args[0][0])
+        self.assertEqual([self.node], list(mock_pipelined.call_args[0][1]))
+        self.assertFalse(mock_pipelined.call_args[1]['save'])
+        self.assertFalse(self.mock_fetch.called)
+        self.assertEqual(1, mock_log.error.call_count)
+
+    @mock.patch.object(match, 'release_profiles', autospec=True)
+    @mock.patch.object(match, 'get_update_patches', lambda x, y: [])
+    @mock.patch.object(match, 'match_nodes_sharded', autospec=True)
+    def test_shard(self, mock_sharded, mock_release, mock_ic,
+                   mock_log, mock_cfg):
+        other = mock.Mock(uuid='other-uuid', extra={})
+        self.mock_client.node.list.return_value = [self.node, other]
+        mock_ic.return_value = self.mock_client
+        mock_sharded.return_value = ({self.uuid: {}}, {}, {'hw1': 1})
+        shard = [i for i in range(1, 3)
+                 if match.in_shard(self.uuid, (i, 2))][0]
+        self.assertFalse(match.in_shard('other-uuid', (shard, 2)))
+        with mock.patch.object(utils, 'list_nodes', autospec=True,
+                               return_value=[self.node, other]):
+            match.main(args=['--shard', '%d/2' % shard])
+        mock_sharded.assert_called_once_with([self.node], [self.facts])
+        mock_release.assert_called_once_with({'hw1': 1})
+
+    def test_shard_invalid(self, mock_ic, mock_log, mock_cfg):
+        self.assertRaises(SystemExit, match.main, args=['--shard', '3/2'])
+        self.assertEqual(1, mock_log.error.call_count)
+        self.assertFalse(mock_ic.called)
+
+    def test_shard_pipeline(self, mock_ic, mock_log, mock_cfg):
+        self.assertRaises(SystemExit, match.main,
+                          args=['--shard', '1/2', '--pipeline'])
+        self.assertEqual(1, mock_log.error.call_count)
+
+    @mock.patch.object(match, 'Watcher', autospec=True)
+    def test_watch(self, mock_watcher, mock_ic, mock_log, mock_cfg):
+        mock_ic.return_value = self.mock_client
+        mock_watcher.return_value.run.side_effect = KeyboardInterrupt
+        match.main(args=['--watch'])
+        mock_watcher.assert_called_once_with()
+        mock_watcher.return_value.connect.assert_called_once_with()
+        mock_watcher.return_value.run.assert_called_once_with(60)
+        self.assertFalse(self.mock_fetch.called)
+
+    @mock.patch.object(match, 'Watcher', autospec=True)
+    def test_watch_snapshot(self, mock_watcher, mock_ic, mock_log, mock_cfg):
+        self.assertRaises(SystemExit, match.main,
+                          args=['--watch', '--snapshot', '/tmp/fleet'])
+        self.assertFalse(mock_watcher.called)
+
+
+class TestMatchPipelined(base.BaseTest):
+    def setUp(self):
+        super(TestMatchPipelined, self).setUp()
+        self.fleet = bench_run.Fleet(30, 60, 0.5, 0)
+        self.addCleanup(self.fleet.cleanup)
+        CONF.set_override('configdir', self.fleet.configdir, 'edeploy')
+        CONF.set_override('lockname', None, 'edeploy')
+        CONF.set_override('concurrency', 8, 'swift')
+        self.state_path = os.path.join(self.fleet.configdir, 'state')
+        self.facts = dict((node.uuid, node_facts) for node, node_facts
+                          in zip(self.fleet.nodes, self.fleet.facts))
+        self.client = mock.Mock()
+
+    def _get_facts(self, node):
+        # Finish the downloads out of order.
+        time.sleep(random.random() / 500)
+        return self.facts[node.uuid]
+
+    def test_same_as_serial(self):
+        # Limited counts make the result depend on the matching order.
+        with open(self.state_path, 'w') as state_file:
+            state_file.write("[('model0', 10), ('model1', '*'), "
+                             "('model2', 1), ('model3', '*')]")
+        shutil.copyfile(self.state_path, self.state_path + '.orig')
+        nodes_info, failures = match.match_nodes(self.fleet.nodes,
+                                                 self.fleet.facts)
+        expected = [mock.call(node.uuid,
+                              match.get_update_patches(
+                                  node, nodes_info[node.uuid]))
+                    for node in self.fleet.nodes
+                    if node.uuid in nodes_info]
+        shutil.copyfile(self.state_path + '.orig', self.state_path)
+
+        with mock.patch.object(utils, 'get_facts', autospec=True,
+                               side_effect=self._get_facts):
+            failed_nodes, updated, skipped, failed = match.match_pipelined(
+                self.client, iter(self.fleet.nodes), queue_size=3)
+
+        self.assertEqual(sorted(failures), sorted(failed_nodes))
+        self.assertEqual([node.uuid for node in self.fleet.nodes
+                          if node.uuid in nodes_info], updated)
+        self.assertEqual([], skipped)
+        self.assertEqual({}, failed)
+        self.assertEqual(sorted(expected),
+                         sorted(self.client.node.update.call_args_list))
+
+    def test_not_saved(self):
+        with open(self.state_path, 'w') as state_file:
+            state_file.write("[('model0', 10), ('model1', '*'), "
+                             "('model2', 1), ('model3', '*')]")
+        mtime = os.stat(self.state_path).st_mtime
+        with mock.patch.object(utils, 'get_facts', autospec=True,
+                               side_effect=self._get_facts):
+            match.match_pipelined(self.client, self.fleet.nodes,
+                                  save=False)
+        nodes_info, failures = match.match_nodes(
+            self.fleet.nodes, self.fleet.facts, save=False)
+        self.assertEqual(30, len(nodes_info) + len(failures))
+        self.assertEqual(mtime, os.stat(self.state_path).st_mtime)
+        # No lock, backup or temporary file left.
+        self.assertEqual(['state'], [name for name in
+                                     os.listdir(self.fleet.configdir)
+                                     if not name.endswith('.specs')])
+
+    @mock.patch.object(match, 'LOG')
+    def test_failures(self, log_mock):
+        nodes = self.fleet.nodes[:3]
+        nodes[1].extra['configdrive_metadata'] = None
+
+        def fetch_node_facts(node):
+            if node is nodes[0]:
+                return None, 'boom'
+            if node is nodes[1]:
+                return [('cpu', 'logical', 'number', '1')], None
+            return self.facts[node.uuid], None
+
+        self.client.node.update.side_effect = Exception('update failed')
+        with mock.patch.object(utils, 'fetch_node_facts',
+                               side_effect=fetch_node_facts):
+            failed_nodes, updated, skipped, failed = match.match_pipelined(
+                self.client, nodes)
+
+        self.assertEqual([nodes[0].uuid, nodes[1].uuid], failed_nodes)
+        self.assertEqual([], updated)
+        self.assertEqual({nodes[2].uuid: 'update failed'}, failed)
+        self.assertEqual(2, log_mock.error.call_count)
+
+    def test_listing_failed(self):
+        def list_nodes():
+            yield self.fleet.nodes[0]
+            raise RuntimeError('listing failed')
+
+        with mock.patch.object(utils, 'get_facts', autospec=True,
+                               side_effect=self._get_facts):
+            self.assertRaises(RuntimeError, match.match_pipelined,
+                              self.client, list_nodes())
+        self.assertFalse(os.path.exists(os.path.join(self.fleet.configdir,
+                                                     'lock')))
+
+
+class TestShard(base.BaseTest):
+    def test_parse_shard(self):
+        self.assertEqual((2, 4), match.parse_shard('2/4'))
+        for value in ('0/4', '5/4', '1', '1/2/3', 'a/b'):
+            self.assertRaises(ValueError, match.parse_shard, value)
+
+    def test_in_shard(self):
+        uuids = ['%08d-0000-4000-8000-000000000000' % index
+                 for index in range(400)]
+        shards = [[uuid for uuid in uuids if match.in_shard(uuid, (i, 4))]
+                  for i in range(1, 5)]
+        self.assertEqual(sorted(uuids), sorted(sum(shards, [])))
+        for shard in shards:
+            self.assertTrue(60 < len(shard) < 140)
+
+
+class TestMatchNodesSharded(base.BaseTest):
+    def setUp(self):
+        super(TestMatchNodesSharded, self).setUp()
+        self.fleet = bench_run.Fleet(10, 60, 0.5, 0)
+        self.addCleanup(self.fleet.cleanup)
+        CONF.set_override('configdir', self.fleet.configdir, 'edeploy')
+        CONF.set_override('lockname', None, 'edeploy')
+        self.state_path = os.path.join(self.fleet.configdir, 'state')
+        # 5 of the nodes are model0.
+        self._write_state([('model0', 5), ('model1', '*'),
+                           ('model2', '*'), ('model3', '*')])
+
+    def _write_state(self, data):
+        with open(self.state_path, 'w') as state_file:
+            state_file.write(repr(data))
+
+    def _read_state(self):
+        with open(self.state_path) as state_file:
+            return eval(state_file.read())
+
+    def test_reserved_and_released(self):
+        nodes_info, failures, used = match.match_nodes_sharded(
+            self.fleet.nodes, self.fleet.facts)
+        self.assertEqual({}, failures)
+        self.assertEqual(10, len(nodes_info))
+        self.assertEqual(5, used['model0'])
+        self.assertEqual(('model0', 0), self._read_state()[0])
+        match.release_profiles(used)
+        self.assertEqual(('model0', 5), self._read_state()[0])
+
+    def test_other_run_reserved_meanwhile(self):
+        match_all = match._match_all
+        calls = []
+
+        def concurrent_match(*args):
+            if not calls:
+                # Another shard takes 2 model0 nodes while this one
+                # matches.
+                self.assertTrue(match._reserve_profiles({'model0': 2}))
+            calls.append(args)
+            return match_all(*args)
+
+        with mock.patch.object(match, '_match_all',
+                               side_effect=concurrent_match):
+            nodes_info, failures, used = match.match_nodes_sharded(
+                self.fleet.nodes, self.fleet.facts)
+        self.assertEqual(2, len(calls))
+        self.assertEqual(2, len(failures))
+        self.assertEqual(3, used['model0'])
+        self.assertEqual(('model0', 0), self._read_state()[0])
+        match.release_profiles(used)
+        # The other shard still holds its 2 nodes.
+        self.assertEqual(('model0', 3), self._read_state()[0])
+
+    def test_retries_exhausted(self):
+        CONF.set_override('shard_commit_retries', 0, 'match')
+        with mock.patch.object(match, '_reserve_profiles',
+                               return_value=False) as reserve_mock:
+            nodes_info, failures, used = match.match_nodes_sharded(
+                self.fleet.nodes, self.fleet.facts)
+        self.assertEqual(1, reserve_mock.call_count)
+        # Matched a last time holding the lock, and saved.
+        self.assertEqual(('model0', 0), self._read_state()[0])
+        self.assertEqual(5, used['model0'])
+
+    def test_cmdb_matched_under_lock(self):
+        open(os.path.join(self.fleet.configdir, 'model9.cmdb'), 'w').close()
+        with mock.patch.object(match, '_reserve_profiles') as reserve_mock:
+            nodes_info, failures, used = match.match_nodes_sharded(
+                self.fleet.nodes, self.fleet.facts)
+        self.assertFalse(reserve_mock.called)
+        self.assertEqual(('model0', 0), self._read_state()[0])
+        self.assertFalse(os.path.exists(os.path.join(self.fleet.configdir,
+                                                     'lock')))
+
+
+class TestWatcher(base.BaseTest):
+    def setUp(self):
+        super(TestWatcher, self).setUp()
+        self.fleet = bench_run.Fleet(10, 60, 0.5, 0)
+        self.addCleanup(self.fleet.cleanup)
+        CONF.set_override('configdir', self.fleet.configdir, 'edeploy')
+        CONF.set_override('lockname', None, 'edeploy')
+        self.state_path = os.path.join(self.fleet.configdir, 'state')
+        self.facts = dict((node.uuid, node_facts) for node, node_facts
+                          in zip(self.fleet.nodes, self.fleet.facts))
+        self.client = mock.Mock()
+        self.nodes = []
+        list_patcher = mock.patch.object(
+            utils, 'list_nodes', side_effect=lambda client: list(self.nodes))
+        list_patcher.start()
+        self.addCleanup(list_patcher.stop)
+        fetch_patcher = mock.patch.object(
+            utils, 'fetch_node_facts',
+            side_effect=lambda node: (self.facts[node.uuid], None))
+        self.mock_fetch = fetch_patcher.start()
+        self.addCleanup(fetch_patcher.stop)
+        self.watcher = match.Watcher(self.client)
+
+    def _fetched(self):
+        fetched = [call[0][0].uuid for call in self.mock_fetch.call_args_list]
+        self.mock_fetch.reset_mock()
+        return fetched
+
+    def test_only_new_nodes_matched(self):
+        self.nodes = self.fleet.nodes[:4]
+        failed_nodes, updated, skipped, failed = self.watcher.poll()
+        self.assertEqual([node.uuid for node in self.nodes], updated)
+        self.assertEqual([node.uuid for node in self.nodes], self._fetched())
+
+        self.nodes = self.fleet.nodes[:6]
+        failed_nodes, updated, skipped, failed = self.watcher.poll()
+        self.assertEqual([], failed_nodes)
+        self.assertEqual([node.uuid for node in self.fleet.nodes[4:6]],
+                         updated)
+        self.assertEqual(updated, self._fetched())
+
+        self.assertEqual(([], [], [], {}), self.watcher.poll())
+        self.assertEqual([], self._fetched())
+        self.assertEqual(6, self.client.node.update.call_count)
+        self.assertFalse(os.path.exists(os.path.join(self.fleet.configdir,
+                                                     'lock')))
+
+    def test_changed_object_matched_again(self):
+        node = self.fleet.nodes[0]
+        self.nodes = [node]
+        self.watcher.load_state()
+        # Every profile may only be used once.
+        self.watcher.sobj._data = [(name, 1) for name, times
+                                   in self.watcher.sobj._data]
+        self.watcher.poll()
+        profile = self.watcher.seen[node.uuid][1]
+        self.assertIn((profile, 0), self.watcher.sobj._data)
+
+        node.extra['hardware_swift_object'] = 'extra_hardware-new'
+        failed_nodes, updated, skipped, failed = self.watcher.poll()
+        self.assertEqual([], failed_nodes)
+        self.assertEqual([node.uuid], updated)
+        self.assertEqual(('extra_hardware-new', profile),
+                         self.watcher.seen[node.uuid])
+
+        # The profile of a node that is gone is given back.
+        self.nodes = []
+        self.watcher.poll()
+        self.assertIn((profile, 1), self.watcher.sobj._data)
+
+    def test_state_changed(self):
+        self.nodes = self.fleet.nodes[:2]
+        self.watcher.poll()
+        first_state = self.watcher.sobj
+        self.assertEqual(([], [], [], {}), self.watcher.poll())
+        self.assertIs(first_state, self.watcher.sobj)
+
+        with open(self.state_path, 'a') as state_file:
+            state_file.write('\n')
+        self._fetched()
+        failed_nodes, updated, skipped, failed = self.watcher.poll()
+        self.assertIsNot(first_state, self.watcher.sobj)
+        self.assertEqual([node.uuid for node in self.nodes], self._fetched())
+        self.assertEqual([node.uuid for node in self.nodes], updated)
+
+    @mock.patch.object(match, 'LOG')
+    def test_failures(self, log_mock):
+        self.nodes = self.fleet.nodes[:2]
+        self.mock_fetch.side_effect = [(None, 'boom'),
+                                       (self.facts[self.nodes[1].uuid],
+                                        None)]
+        self.client.node.update.side_effect = Exception('update failed')
+        failed_nodes, updated, skipped, failed = self.watcher.poll()
+        self.assertEqual([self.nodes[0].uuid], failed_nodes)
+        self.assertEqual([self.nodes[1].uuid], list(failed))
+        # Both nodes are tried again on the next poll.
+        self.assertEqual({}, self.watcher.seen)
+
+    @mock.patch.object(match.time, 'sleep', autospec=True)
+    @mock.patch.object(match, 'LOG')
+    def test_run(self, log_mock, sleep_mock):
+        self.nodes = self.fleet.nodes[:2]
+        self.client.node.update.side_effect = [None, None]
+        with mock.patch.object(utils, 'list_nodes',
+                               side_effect=[self.nodes,
+                                            RuntimeError('boom'),
+                                            self.nodes]):
+            self.watcher.run(10, polls=3)
+        self.assertEqual(2, sleep_mock.call_count)
+        self.assertEqual(1, log_mock.error.call_count)
+        self.assertEqual(1, log_mock.info.call_count)
+
+
+@mock.patch.object(tokens, '_authenticate', autospec=True)
+@mock.patch.object(ironic_client, 'get_client', autospec=True)
+@mock.patch.object(utils, 'list_nodes', autospec=True, return_value=[])
+class TestWatcherToken(base.BaseTest):
+    def setUp(self):
+        super(TestWatcherToken, self).setUp()
+        self.fleet = bench_run.Fleet(1, 60, 0.5, 0)
+        self.addCleanup(self.fleet.cleanup)
+        CONF.set_override('configdir', self.fleet.configdir, 'edeploy')
+        CONF.set_override('lockname', None, 'edeploy')
+        CONF.set_override('os_auth_url', 'http://keystone:5000/v2.0',
+                          'ironic')
+        CONF.set_override('os_username', 'admin', 'ironic')
+        CONF.set_override('os_password', 'secret', 'ironic')
+        self.clients = [mock.Mock(name='client1'), mock.Mock(name='client2')]
+
+    def _entry(self, token, lifetime=3600):
+        return {'token': token,
+                'expires': time.time() + lifetime,
+                'endpoints': {'baremetal': 'http://ironic:6385'}}
+
+    def _tokens(self, gc_mock):
+        return [call[1]['os_auth_token'] for call in gc_mock.call_args_list]
+
+    def test_expired_token(self, list_mock, gc_mock, auth_mock):
+        gc_mock.side_effect = self.clients
+        auth_mock.side_effect = [self._entry('token1'),
+                                 self._entry('token2')]
+        watcher = match.Watcher()
+        watcher.connect()
+        watcher.poll()
+        self.assertEqual(['token1'], self._tokens(gc_mock))
+
+        # The token expires after an hour, the next poll uses a new one.
+        now = time.time() + 3600
+        with mock.patch.object(tokens.time, 'time', return_value=now):
+            watcher.poll()
+        self.assertEqual(['token1', 'token2'], self._tokens(gc_mock))
+        list_mock.assert_called_with(self.clients[1])
+
+    @mock.patch.object(match.time, 'sleep', autospec=True)
+    def test_rejected_token(self, sleep_mock, list_mock, gc_mock, auth_mock):
+        gc_mock.side_effect = self.clients
+        auth_mock.side_effect = [self._entry('token1'),
+                                 self._entry('token2')]
+        list_mock.side_effect = [ironic_exc.Unauthorized(), []]
+        watcher = match.Watcher()
+        watcher.connect()
+        watcher.run(10, polls=2)
+        self.assertEqual(['token1', 'token2'], self._tokens(gc_mock))
+        list_mock.assert_called_with(self.clients[1])
+
+
+@mock.patch.object(match.time, 'sleep', autospec=True)
+class TestUpdateNodes(base.BaseTest):
+    def setUp(self):
+        super(TestUpdateNodes, self).setUp()
+        self.client = mock.Mock()
+        self.patch = [{'op': 'add', 'path': '/extra/foo', 'value': 'bar'}]
+
+    def test_update(self, sleep_mock):
+        updated, skipped, failed = match.update_nodes(
+            self.client, [('uuid1', self.patch), ('uuid2', []),
+                          ('uuid3', self.patch)])
+        self.assertEqual(['uuid1', 'uuid3'], updated)
+        self.assertEqual(['uuid2'], skipped)
+        self.assertEqual({}, failed)
+        self.assertEqual(2, self.client.node.update.call_count)
+        self.assertFalse(sleep_mock.called)
+
+    def test_retry_with_backoff(self, sleep_mock):
+        CONF.set_override('retry_interval', 2, 'ironic')
+        self.client.node.update.side_effect = [
+            ironic_exc.Conflict(), ironic_exc.ServiceUnavailable(), None]
+        updated, skipped, failed = match.update_nodes(
+            self.client, [('uuid1', self.patch)])
+        self.assertEqual(['uuid1'], updated)
+        self.assertEqual([mock.call(2), mock.call(4)],
+                         sleep_mock.call_args_list)
+
+    def test_retries_exhausted(self, sleep_mock):
+        CONF.set_override('max_retries', 2, 'ironic')
+        self.client.node.update.side_effect = ironic_exc.Conflict('busy')
+        updated, skipped, failed = match.update_nodes(
+            self.client, [('uuid1', self.patch)])
+        self.assertEqual([], updated)
+        self.assertIn('uuid1', failed)
+        self.assertEqual(3, self.client.node.update.call_count)
+
+    def test_no_retry_on_other_errors(self, sleep_mock):
+        self.client.node.update.side_effect = Exception('boom')
+        updated, skipped, failed = match.update_nodes(
+            self.client, [('uuid1', self.patch)])
+        self.assertEqual({'uuid1': 'boom'}, failed)
+        self.assertEqual(1, self.client.node.update.call_count)
+        self.assertFalse(sleep_mock.called)
+
+    def test_negative_retry_interval_rejected(self, sleep_mock):
+        self.assertRaises(ValueError, CONF.set_override, 'retry_interval',
+                          -1, 'ironic')
@@ -0,0 +1,148 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+import mock
+
+from ahc_tools import metrics
+from ahc_tools.test import base
+
+
+@mock.patch.object(metrics.timeit, 'default_timer', autospec=True)
+class TestTimed(base.BaseTest):
+    def _start(self, timer_mock, times):
+        timer_mock.return_value = 0.0
+        metrics.enable()
+        metrics.get_metrics()
+        # The last time is read by the summary.
+        timer_mock.side_effect = times + [100.0]
+
+    def test_nested(self, timer_mock):
+        self._start(timer_mock, [0.0, 1.0, 3.0, 10.0])
+        with metrics.timed('outer'):
+            with metrics.timed('inner') as phase:
+                phase.bytes = 42
+
+        phases = metrics.get_metrics().summary()['phases']
+        self.assertEqual(2.0, phases['inner']['total'])
+        self.assertEqual(42, phases['inner']['bytes'])
+        # The 2 seconds of the inner phase are not counted twice.
+        self.assertEqual(8.0, phases['outer']['total'])
+        self.assertEqual(0, phases['outer']['bytes'])
+
+    def test_node(self, timer_mock):
+        self._start(timer_mock, [0.0, 1.0, 1.0, 3.0])
+        with metrics.node('uuid1'):
+            with metrics.timed('find_match'):
+                pass
+        with metrics.timed('find_match'):
+            pass
+
+        summary = metrics.get_metrics().summary()
+        self.assertEqual(2, summary['phases']['find_match']['count'])
+        self.assertEqual({'uuid1': {'find_match': {'count': 1, 'total': 1.0,
+                                                   'bytes': 0}}},
+                         summary['nodes'])
+
+    def test_chunks(self, timer_mock):
+        self._start(timer_mock, [0.0, 1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 10.0])
+        with metrics.timed('decode'):
+            chunks = list(metrics.timed_chunks('download', [b'ab', b'c']))
+        self.assertEqual([b'ab', b'c'], chunks)
+
+        phases = metrics.get_metrics().summary()['phases']
+        # Three reads of one second each, the last one hitting the end.
+        self.assertEqual({'count': 1, 'total': 3.0, 'bytes': 3,
+                          'p50': 3.0, 'p95': 3.0, 'max': 3.0},
+                         phases['download'])
+        self.assertEqual(7.0, phases['decode']['total'])
+
+    def test_not_enabled(self, timer_mock):
+        timer_mock.return_value = 0.0
+        with metrics.timed('decode') as phase:
+            phase.bytes = 42
+            chunks = list(metrics.timed_chunks('download', [b'ab', b'c']))
+        self.assertEqual([b'ab', b'c'], chunks)
+        self.assertEqual({}, metrics.get_metrics().summary()['phases'])
+
+
+class TestMetrics(base.BaseTest):
+    def test_percentiles(self):
+        metrics_obj = metrics.Metrics()
+        for seconds in range(100, 0, -1):
+            metrics_obj.record('node_update', float(seconds))
+        phase = metrics_obj.summary()['phases']['node_update']
+        self.assertEqual(100, phase['count'])
+        self.assertEqual(50.0, phase['p50'])
+        self.assertEqual(95.0, phase['p95'])
+        self.assertEqual(100.0, phase['max'])
+        self.assertEqual(5050.0, phase['total'])
+
+    @mock.patch.object(metrics, 'SAMPLE_SIZE', 10)
+    def test_sample_bounded(self):
+        metrics_obj = metrics.Metrics()
+        for seconds in range(1, 1001):
+            metrics_obj.record('node_update', float(seconds))
+        phase = metrics_obj.summary()['phases']['node_update']
+        self.assertEqual(10, len(metrics_obj._phases['node_update']['sample']))
+        self.assertEqual(1000, phase['count'])
+        self.assertEqual(500500.0, phase['total'])
+        self.assertEqual(1000.0, phase['max'])
+        self.assertTrue(1.0 <= phase['p50'] <= phase['p95'] <= 1000.0)
+
+    def test_percentile_single_value(self):
+        self.assertEqual(3, metrics.percentile([3], 50))
+        self.assertEqual(3, metrics.percentile([3], 95))
+
+    def test_threads(self):
+        metrics.enable()
+
+        def run(uuid):
+            with metrics.node(uuid):
+                for _ in range(100):
+                    with metrics.timed('swift_download'):
+                        pass
+
+        threads = [threading.Thread(target=run, args=('uuid%d' % index,))
+                   for index in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        summary = metrics.get_metrics().summary()
+        self.assertEqual(400, summary['phases']['swift_download']['count'])
+        for index in range(4):
+            self.assertEqual(
+                100,
+                summary['nodes']['uuid%d' % index]['swift_download']['count'])
+
+    def test_write(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'metrics.json')
+        metrics_obj = metrics.Metrics()
+        metrics_obj.record('node_list', 1.5)
+
+        metrics_obj.write(path)
+
+        with open(path) as metrics_file:
+            data = json.load(metrics_file)
+        self.assertEqual(metrics.METRICS_VERSION, data['version'])
+        self.assertEqual(1.5, data['phases']['node_list']['total'])
+        self.assertEqual(['metrics.json'], os.listdir(tmpdir))
@@ -0,0 +1,185 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import random
+
+from hardware.cardiff import check
+from hardware.cardiff import utils as cardiff_utils
+import mock
+import numpy
+
+from ahc_tools import analysis
+from ahc_tools import outliers
+from ahc_tools.test import base
+
+
+def _node_facts(rng, index, scale=1.0):
+    """Benchmark facts of a node, scale making it an outlier."""
+    facts = [('system', 'product', 'uuid', 'uuid%d' % index),
+             ('cpu', 'physical_0', 'product', 'Intel Xeon'),
+             ('cpu', 'logical', 'number', '2'),
+             ('cpu', 'logical', 'loops_per_sec', '1800')]
+    for cpu in range(2):
+        facts.append(('cpu', 'logical_%d' % cpu, 'bogomips',
+                      '%.2f' % (4000 * scale * rng.uniform(0.99, 1.01))))
+        facts.append(('cpu', 'logical_%d' % cpu, 'loops_per_sec',
+                      '%d' % (1000 * scale * rng.uniform(0.97, 1.03))))
+        facts.append(('cpu', 'logical_%d' % cpu, 'bandwidth_1K',
+                      '%.1f' % (5000 * scale * rng.uniform(0.95, 1.05))))
+    for mode in ('threaded', 'forked'):
+        facts.append(('cpu', 'logical', '%s_bandwidth_1K' % mode,
+                      '%.1f' % (9000 * rng.uniform(0.9, 1.1))))
+    for disk in ('sda', 'sdb'):
+        facts.append(('disk', disk, 'standalone_read_1M_KBps',
+                      '%d' % (100000 * scale * rng.uniform(0.98, 1.02))))
+        facts.append(('disk', disk, 'standalone_randread_4k_IOps',
+                      '%d' % (2000 * rng.uniform(0.5, 1.5))))
+    for mode in ('bandwidth', 'requests_per_sec'):
+        facts.append(('network', mode, 'eth0',
+                      '%.1f' % (1000 * scale * rng.uniform(0.98, 1.02))))
+    return facts
+
+
+class TestFrame(base.BaseTest):
+    def test_same_labels(self):
+        frame = outliers.Frame([('uuid1', ['b', 'a'], [1, 2]),
+                                ('uuid2', ['b', 'a'], [3, 4])])
+        self.assertEqual(['b', 'a'], frame.rows)
+        self.assertEqual([[1, 3], [2, 4]], frame.values.tolist())
+        self.assertEqual([2, 3], frame.means.tolist())
+        self.assertEqual([1.5, 3.5], frame.host_means.tolist())
+
+    def test_different_labels(self):
+        frame = outliers.Frame([('uuid1', ['b', 'a'], [1, 2]),
+                                ('uuid2', [], []),
+                                ('uuid3', ['b'], [3])])
+        self.assertEqual(['a', 'b'], frame.rows)
+        self.assertEqual([1, 2], frame.counts.tolist())
+        self.assertTrue(numpy.isnan(frame.stds[0]))
+        self.assertEqual([3, 0, 3], frame.host_sums.tolist())
+
+    def test_length_mismatch(self):
+        self.assertRaises(ValueError, outliers.Frame,
+                          [('uuid1', [], [1.0])])
+
+
+class TestChecks(base.BaseTest):
+    def setUp(self):
+        super(TestChecks, self).setUp()
+        rng = random.Random(0)
+        self.facts = [_node_facts(rng, index) for index in range(12)]
+        # One node is slower, and the random reads are unstable.
+        self.facts.append(_node_facts(rng, 12, scale=0.85))
+        self.detail = {'group': '', 'category': '', 'item': ''}
+
+    def _assert_same(self, cardiff_check, args, outliers_check, extra=()):
+        summary_level = (cardiff_utils.print_level |
+                         cardiff_utils.Levels.SUMMARY)
+        for level in (cardiff_utils.print_level, summary_level):
+            with mock.patch.object(cardiff_utils, 'print_level', level):
+                expected = analysis._capture_output(cardiff_check, *args)
+                actual = analysis._capture_output(
+                    outliers_check, *(args[:3] + tuple(extra)))
+            self.assertEqual(expected, actual)
+        return actual
+
+    def _systems(self, category):
+        return cardiff_utils.find_sub_element(self.facts, 'uuid', category)
+
+    def test_logical_disks_perf(self):
+        output = self._assert_same(
+            check.logical_disks_perf,
+            (self._systems('disk'), 'uuid', 1, self.detail, 'KBps'),
+            outliers.logical_disks_perf, ['KBps'])
+        self.assertIn('uuid12 : Curious underperformance', output)
+        output = self._assert_same(
+            check.logical_disks_perf,
+            (self._systems('disk'), 'uuid', 1, self.detail, 'IOps'),
+            outliers.logical_disks_perf, ['IOps'])
+        self.assertIn('UNSTABLE', output)
+
+    def test_cpu_perf(self):
+        output = self._assert_same(
+            check.cpu_perf, (self._systems('cpu'), 'uuid', 1, self.detail),
+            outliers.cpu_perf)
+        self.assertIn('uuid12 : Curious underperformance', output)
+        self.assertIn('CPU Effi.', output)
+
+    def test_memory_perf(self):
+        output = self._assert_same(
+            check.memory_perf, (self._systems('cpu'), 'uuid', 1, self.detail),
+            outliers.memory_perf)
+        self.assertIn('Thread effi.', output)
+        self.assertIn('Benchmark not run on this group', output)
+
+    def test_network_perf(self):
+        output = self._assert_same(
+            check.network_perf,
+            (self._systems('network'), 'uuid', 1, self.detail),
+            outliers.network_perf)
+        self.assertIn('uuid12 : Curious underperformance', output)
+
+    def test_compare_performance(self):
+        groups = [set('uuid%d' % index for index in range(13))]
+        index = analysis.FactsIndex(self.facts, 'uuid')
+        reports = [analysis._capture_output(
+            analysis.compare_performance, index, groups, self.detail,
+            analysis.ReportState(), 1, engine)
+            for engine in ('cardiff', 'numpy')]
+        self.assertEqual(reports[0], reports[1])
+
+    def test_recorded(self):
+        summary_level = (cardiff_utils.print_level |
+                         cardiff_utils.Levels.SUMMARY)
+        checks = (('disk', 'disk'), ('cpu', 'cpu'), ('memory', 'cpu'),
+                  ('network', 'network'))
+        with mock.patch.object(cardiff_utils, 'print_level', summary_level):
+            for engine in ('cardiff', 'numpy'):
+                for kind, category in checks:
+                    args = (kind, self._systems(category), 'uuid', 1,
+                            self.detail, engine)
+                    items = json.loads(json.dumps(
+                        analysis.PerformanceRecorder().record(
+                            analysis._check_performance, *args)))
+                    self.assertNotIn('\033', json.dumps(items))
+                    self.assertEqual(
+                        analysis._capture_output(
+                            analysis._check_performance, *args),
+                        analysis._capture_output(
+                            analysis.render_performance,
+                            {'check': kind, 'group': 1, 'items': items}))
+
+    def test_recorded_items(self):
+        items = analysis.PerformanceRecorder().record(
+            outliers.network_perf, self._systems('network'), 'uuid', 1)
+        self.assertEqual({'type': 'header', 'title': 'network disks perf'},
+                         items[0])
+        metric = items[1]
+        self.assertEqual(('metric', 'bandwidth', 'suspicious'),
+                         (metric['type'], metric['mode'], metric['status']))
+        self.assertEqual(['consistent'] * 12 + ['under'],
+                         [host['class'] for host in metric['hosts']])
+        self.assertEqual('uuid12', metric['hosts'][12]['host'])
+        self.assertLess(metric['hosts'][12]['value'],
+                        metric['mean'] - 2 * metric['stddev'])
+
+    @mock.patch.object(outliers, 'cpu_perf', autospec=True)
+    @mock.patch.object(check, 'cpu_perf', autospec=True)
+    def test_details_printed_by_cardiff(self, cardiff_mock, outliers_mock):
+        level = cardiff_utils.print_level | cardiff_utils.Levels.DETAIL
+        with mock.patch.object(cardiff_utils, 'print_level', level):
+            analysis._check_performance('cpu', [], 'uuid', 1, self.detail,
+                                        'numpy')
+        self.assertTrue(cardiff_mock.called)
+        self.assertFalse(outliers_mock.called)
@@ -0,0 +1,159 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+
+from hardware import matcher
+from hardware import state
+import mock
+
+from ahc_tools import profiles
+from ahc_tools.test import base
+
+SPECS = {
+    'control': [('cpu', 'logical', 'number', '8'),
+                ('disk', '$disk', 'size', 'gt(100)')],
+    'compute': [('cpu', 'logical', 'number', '$ncpus'),
+                ('system', 'product', 'name', 'PowerEdge R630')],
+    'storage': [('disk', 'sdb', 'size', '$size')],
+}
+
+
+class TestIsLiteral(base.BaseTest):
+    def test_literal(self):
+        self.assertTrue(profiles.is_literal(('cpu', 'logical', 'number',
+                                             '8')))
+
+    def test_not_literal(self):
+        for spec in (('cpu', 'logical', 'number', '$ncpus'),
+                     ('disk', '$disk', 'size', '100'),
+                     ('disk', 'sda', 'size', 'gt(100)'),
+                     ('network', 'eth0', 'ipv4', 'network(10.0.0.0/8)'),
+                     ('cpu', 'logical', 'number', 8),
+                     ('cpu', 'logical', 'number')):
+            self.assertFalse(profiles.is_literal(spec), spec)
+
+
+class TestIndexedState(base.BaseTest):
+    def setUp(self):
+        super(TestIndexedState, self).setUp()
+        self.cfg_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cfg_dir)
+        for name, specs in SPECS.items():
+            with open(os.path.join(self.cfg_dir, name + '.specs'), 'w') as f:
+                f.write(repr(specs))
+        with open(os.path.join(self.cfg_dir, 'state'), 'w') as f:
+            f.write(repr([('control', '1'), ('compute', '*'),
+                          ('storage', '*')]))
+        self.compute = [('cpu', 'logical', 'number', '4'),
+                        ('disk', 'sda', 'size', '200'),
+                        ('system', 'product', 'name', 'PowerEdge R630')]
+        self.control = [('cpu', 'logical', 'number', '8'),
+                        ('disk', 'sda', 'size', '200'),
+                        ('system', 'product', 'name', 'PowerEdge R630')]
+
+    def _load(self, cls):
+        sobj = cls(lockname=os.path.join(self.cfg_dir, 'lock'))
+        sobj.load(self.cfg_dir)
+        self.addCleanup(sobj.unlock)
+        return sobj
+
+    def _match_all(self, cls, nodes):
+        sobj = self._load(cls)
+        results = []
+        for hw_items in nodes:
+            try:
+                results.append(sobj.find_match(hw_items))
+            except state.StateError as e:
+                results.append(str(e))
+        sobj.unlock()
+        return results
+
+    def test_same_results_as_state(self):
+        nodes = [self.control, self.compute, self.control,
+                 [('cpu', 'logical', 'number', '2')]]
+        self.assertEqual(self._match_all(state.State, nodes),
+                         self._match_all(profiles.IndexedState, nodes))
+
+    def test_impossible_profiles_skipped(self):
+        sobj = self._load(profiles.IndexedState)
+        with mock.patch.object(matcher, 'match_all',
+                               wraps=matcher.match_all) as match_mock:
+            self.assertEqual('compute', sobj.find_match(self.compute)[0])
+        # control needs 8 CPUs, so its specs never reached the matcher.
+        self.assertEqual([state._INVALID_SPECS, SPECS['compute']],
+                         [call[0][1] for call in match_mock.call_args_list])
+
+    @mock.patch.object(state.State, '_load_specs', autospec=True,
+                       side_effect=lambda obj, name: SPECS[name])
+    def test_specs_loaded_once(self, load_mock):
+        sobj = self._load(profiles.IndexedState)
+        sobj.find_match(self.compute)
+        sobj.find_match(self.compute)
+        self.assertEqual(2, load_mock.call_count)
+
+    def test_reserve(self):
+        sobj = self._load(profiles.IndexedState)
+        self.assertTrue(sobj.reserve({'control': 1, 'compute': 3}))
+        self.assertEqual([('control', 0), ('compute', '*'),
+                          ('storage', '*')], sobj._data)
+        sobj.release({'control': 1, 'compute': 3})
+        self.assertEqual([('control', 1), ('compute', '*'),
+                          ('storage', '*')], sobj._data)
+
+    def test_reserve_conflict(self):
+        sobj = self._load(profiles.IndexedState)
+        data = list(sobj._data)
+        self.assertFalse(sobj.reserve({'compute': 1, 'control': 2}))
+        self.assertFalse(sobj.reserve({'compute': 1, 'gone': 1}))
+        self.assertEqual(data, sobj._data)
+
+    def _state_path(self):
+        return os.path.join(self.cfg_dir, 'state')
+
+    def test_save_unchanged(self):
+        sobj = self._load(profiles.IndexedState)
+        sobj.find_match(self.compute)
+        with mock.patch.object(tempfile, 'mkstemp') as mkstemp_mock:
+            sobj.save()
+        self.assertFalse(mkstemp_mock.called)
+
+    def test_save_atomic(self):
+        os.chmod(self._state_path(), 0o640)
+        sobj = self._load(profiles.IndexedState)
+        sobj.find_match(self.control)
+        with mock.patch.object(os, 'fsync', wraps=os.fsync) as fsync_mock:
+            sobj.save()
+        self.assertEqual(2, fsync_mock.call_count)
+        with open(self._state_path()) as f:
+            self.assertEqual([('control', 0), ('compute', '*'),
+                              ('storage', '*')], eval(f.read()))
+        self.assertEqual(0o640, os.stat(self._state_path()).st_mode & 0o777)
+        self.assertEqual(['lock', 'state'],
+                         sorted(name for name in os.listdir(self.cfg_dir)
+                                if not name.endswith('.specs')))
+
+    def test_save_failed(self):
+        with open(self._state_path()) as f:
+            before = f.read()
+        sobj = self._load(profiles.IndexedState)
+        sobj.find_match(self.control)
+        with mock.patch.object(os, 'fsync', side_effect=OSError('full')):
+            self.assertRaises(OSError, sobj.save)
+        with open(self._state_path()) as f:
+            self.assertEqual(before, f.read())
+        self.assertEqual(['lock', 'state'],
+                         sorted(name for name in os.listdir(self.cfg_dir)
+                                if not name.endswith('.specs')))
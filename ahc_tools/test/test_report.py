@@ -11,14 +11,19 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
+import os
+import shutil
+import tempfile
+
 import mock
 
+from ahc_tools import analysis
+from ahc_tools.bench import fleet
 from ahc_tools import report
 from ahc_tools.test import base
 
-from hardware.cardiff import cardiff
 from hardware.cardiff import compare_sets
-from hardware.cardiff import utils
 from oslo_config import cfg
 
 
@@ -33,49 +38,134 @@ class ReportBase(base.BaseTest):
         self.detail = {'group': '', 'category': '', 'item': ''}
 
 
-@mock.patch.object(utils, 'get_hosts_list', autospec=True)
+@mock.patch.object(analysis, 'FactsIndex', autospec=True)
 @mock.patch.object(compare_sets, 'print_systems_groups', autospec=True)
-@mock.patch.object(cardiff, 'group_systems', autospec=True)
-@mock.patch.object(cardiff, 'compare_performance', autospec=True)
+@mock.patch.object(analysis, 'group_categories', autospec=True)
+@mock.patch.object(analysis, 'performance_report', autospec=True)
+@mock.patch.object(analysis, 'load_state', autospec=True)
 class TestPrintReport(ReportBase):
     def setUp(self):
         super(TestPrintReport, self).setUp()
 
-    def test_groups(self, cp_mock, gs_mock, psg_mock, ghl_mock):
+    def test_groups(self, ls_mock, cp_mock, gc_mock, psg_mock, index_mock):
         CONF.set_override('groups', True)
-        ghl_mock.return_value = []
+        index_mock.return_value.host_set = set()
         report.print_report(self.facts)
-        ghl_mock.assert_called_once_with([], 'uuid')
+        index_mock.assert_called_once_with([], 'uuid')
         psg_mock.assert_called_once_with([[]])
         self.assertFalse(cp_mock.called)
-        self.assertFalse(gs_mock.called)
+        self.assertFalse(gc_mock.called)
 
-    def test_categories(self, cp_mock, gs_mock, psg_mock, ghl_mock):
+    @mock.patch.object(compare_sets, 'print_groups', autospec=True)
+    def test_categories(self, pg_mock, ls_mock, cp_mock, gc_mock, psg_mock,
+                        index_mock):
         CONF.set_override('categories', True)
-        ghl_mock.return_value = []
+        index_mock.return_value.host_set = set(['uuid1', 'uuid2'])
+        gc_mock.return_value = [('Processors', {'sig1': ['uuid1'],
+                                                'sig2': ['uuid2']})]
         report.print_report(self.facts)
-        ghl_mock.assert_called_once_with([], 'uuid')
-        gs_mock.assert_called_once_with({}, self.facts, 'uuid', [[]], 'system')
+        index_mock.assert_called_once_with([], 'uuid')
+        gc_mock.assert_called_once_with(index_mock.return_value, 'system',
+                                        ls_mock.return_value, jobs=1)
+        pg_mock.assert_called_once_with({}, gc_mock.return_value[0][1],
+                                        'Processors')
+        ls_mock.return_value.save.assert_called_once_with()
         self.assertFalse(cp_mock.called)
         self.assertFalse(psg_mock.called)
 
-    def test_outliers(self, cp_mock, gs_mock, psg_mock, ghl_mock):
+    def test_outliers(self, ls_mock, cp_mock, gc_mock, psg_mock, index_mock):
         CONF.set_override('outliers', True)
-        ghl_mock.return_value = []
-        report.print_report(self.facts)
-        ghl_mock.assert_called_once_with([], 'uuid')
-        cp_mock.assert_called_once_with([], 'uuid', [[]], self.detail)
+        index_mock.return_value.host_set = set()
+        cp_mock.return_value = [{'check': 'cpu', 'group': 0,
+                                 'items': [{'type': 'header',
+                                            'title': 'CPU perf'}]}]
+        with mock.patch('sys.stdout') as stdout_mock:
+            report.print_report(self.facts)
+        stdout_mock.write.assert_called_once_with(
+            '\nGroup 0 : Checking CPU perf\n')
+        index_mock.assert_called_once_with([], 'uuid')
+        cp_mock.assert_called_once_with(index_mock.return_value, [set()],
+                                        self.detail, ls_mock.return_value,
+                                        jobs=1, engine='cardiff')
         self.assertFalse(psg_mock.called)
-        self.assertFalse(gs_mock.called)
+        self.assertFalse(gc_mock.called)
 
-    def test_full(self, cp_mock, gs_mock, psg_mock, ghl_mock):
+    def test_full(self, ls_mock, cp_mock, gc_mock, psg_mock, index_mock):
         CONF.set_override('full', True)
-        ghl_mock.return_value = []
+        index_mock.return_value.host_set = set()
+        gc_mock.return_value = []
+        cp_mock.return_value = []
         report.print_report(self.facts)
-        ghl_mock.assert_called_once_with([], 'uuid')
+        index_mock.assert_called_once_with([], 'uuid')
         psg_mock.assert_called_once_with([[]])
-        gs_mock.assert_called_once_with({}, self.facts, 'uuid', [[]], 'system')
-        cp_mock.assert_called_once_with([], 'uuid', [[]], self.detail)
+        gc_mock.assert_called_once_with(index_mock.return_value, 'system',
+                                        ls_mock.return_value, jobs=1)
+        cp_mock.assert_called_once_with(index_mock.return_value, [set()],
+                                        self.detail, ls_mock.return_value,
+                                        jobs=1, engine='cardiff')
+
+
+class TestResult(ReportBase):
+    def setUp(self):
+        super(TestResult, self).setUp()
+        self.facts = fleet.generate_fleet(6, 60, 0.5)
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'result.json')
+
+    def _write_json(self, result):
+        CONF.set_override('format', 'json')
+        with open(self.path, 'w') as result_file:
+            result_file.write(analysis._capture_output(report.write_report,
+                                                       result))
+        CONF.clear_override('format')
+
+    def test_render_json_result(self):
+        CONF.set_override('full', True)
+        text = analysis._capture_output(report.print_report, self.facts)
+        self._write_json(report.compute_report(self.facts))
+
+        result = report.load_result(self.path)
+        self.assertEqual(['categories', 'groups', 'outliers',
+                          'similar_groups', 'unique_id', 'version'],
+                         sorted(result))
+        self.assertEqual(text, analysis._capture_output(
+            report.render_report, result))
+        self.assertIn('Group 0 : Checking CPU perf', text)
+        # The outliers are stored as data, not as the printed text.
+        self.assertNotIn('Group performance',
+                         json.dumps(result['outliers']))
+        metrics = [item for check_report in result['outliers']
+                   for item in check_report['items']
+                   if item['type'] == 'metric']
+        self.assertTrue(metrics)
+        self.assertTrue(set(['min', 'mean', 'max', 'stddev', 'status',
+                             'hosts']).issubset(metrics[0]))
+
+    def test_sections(self):
+        CONF.set_override('groups', True)
+        result = report.compute_report(self.facts)
+        self.assertEqual(['groups', 'unique_id', 'version'], sorted(result))
+        self.assertEqual([sorted(fleet.node_uuid(index)
+                                 for index in range(6))],
+                         [sorted(group) for group in result['groups']])
+
+    def test_json_selected_sections(self):
+        CONF.set_override('full', True)
+        result = report.compute_report(self.facts)
+        CONF.clear_override('full')
+        CONF.set_override('outliers', True)
+        self._write_json(result)
+        with open(self.path) as result_file:
+            self.assertEqual(['outliers', 'unique_id', 'version'],
+                             sorted(json.load(result_file)))
+
+    def test_missing_section(self):
+        CONF.set_override('groups', True)
+        self._write_json(report.compute_report(self.facts))
+        CONF.set_override('categories', True)
+        self.assertRaisesRegexp(ValueError, 'categories',
+                                report.load_result, self.path)
 
 
 @mock.patch.object(report.cfg, 'ConfigParser', autospec=True)
@@ -88,6 +178,76 @@ class TestMain(ReportBase):
     def test_no_args(self, facts_mock, ic_mock, cfg_mock):
         self.assertRaisesRegexp(SystemExit, "1", report.main, args=[])
 
-    @mock.patch.object(report, 'print_report', autospec=True)
-    def test_no_exceptions(self, print_mock, facts_mock, ic_mock, cfg_mock):
+    @mock.patch.object(report, 'write_report', autospec=True)
+    @mock.patch.object(report, 'compute_report', autospec=True)
+    def test_no_exceptions(self, compute_mock, write_mock, facts_mock,
+                           ic_mock, cfg_mock):
+        report.main(args=['-f'])
+        write_mock.assert_called_once_with(compute_mock.return_value)
+
+    @mock.patch.object(report, 'LOG')
+    @mock.patch.object(report.utils, 'stream_facts', autospec=True)
+    @mock.patch.object(report, 'write_report', autospec=True)
+    @mock.patch.object(report, 'compute_report', autospec=True)
+    def test_failed_facts_skipped(self, print_mock, write_mock, fetch_mock,
+                                  log_mock, facts_mock, ic_mock, cfg_mock):
+        fetch_mock.return_value = (
+            [mock.Mock(uuid='uuid1'), mock.Mock(uuid='uuid2')],
+            [None, [('cpu', 'logical', 'number', '4')]],
+            {'uuid1': 'boom'})
         report.main(args=['-f'])
+        print_mock.assert_called_once_with(
+            [[('cpu', 'logical', 'number', '4')]])
+        self.assertEqual(1, log_mock.error.call_count)
+
+    @mock.patch.object(report.snapshot, 'load', autospec=True)
+    @mock.patch.object(report.utils, 'stream_facts', autospec=True)
+    @mock.patch.object(report, 'write_report', autospec=True)
+    @mock.patch.object(report, 'compute_report', autospec=True)
+    def test_snapshot(self, print_mock, write_mock, fetch_mock, load_mock,
+                      facts_mock, ic_mock, cfg_mock):
+        load_mock.return_value = (
+            [mock.Mock(uuid='uuid1')], [[('cpu', 'logical', 'number', '4')]],
+            {})
+        report.main(args=['-f', '--snapshot', '/tmp/fleet.snapshot'])
+        load_mock.assert_called_once_with('/tmp/fleet.snapshot',
+                                          report.utils.node_selected)
+        print_mock.assert_called_once_with(
+            [[('cpu', 'logical', 'number', '4')]])
+        self.assertFalse(ic_mock.called)
+        self.assertFalse(fetch_mock.called)
+
+    @mock.patch.object(report.atexit, 'register', autospec=True)
+    @mock.patch.object(report, 'write_report', autospec=True)
+    @mock.patch.object(report, 'compute_report', autospec=True)
+    def test_metrics(self, print_mock, write_mock, register_mock, facts_mock,
+                     ic_mock, cfg_mock):
+        report.main(args=['-f', '--metrics', '/tmp/metrics.json'])
+        metrics_obj = report.metrics.get_metrics()
+        register_mock.assert_called_once_with(metrics_obj.write,
+                                              '/tmp/metrics.json')
+        self.assertEqual(['node_list', 'report'],
+                         sorted(metrics_obj.summary()['phases']))
+
+    @mock.patch.object(report.utils, 'stream_facts', autospec=True)
+    @mock.patch.object(report, 'write_report', autospec=True)
+    @mock.patch.object(report, 'compute_report', autospec=True)
+    def test_from_result(self, compute_mock, write_mock, fetch_mock,
+                         facts_mock, ic_mock, cfg_mock):
+        result = {'version': report.RESULT_VERSION, 'unique_id': 'uuid',
+                  'groups': [['uuid1']]}
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as result_file:
+            json.dump(result, result_file)
+            result_file.flush()
+            report.main(args=['-g', '--from-result', result_file.name])
+        write_mock.assert_called_once_with(result)
+        self.assertFalse(compute_mock.called)
+        self.assertFalse(fetch_mock.called)
+        self.assertFalse(ic_mock.called)
+
+    @mock.patch.object(report, 'LOG')
+    def test_from_result_invalid(self, log_mock, facts_mock, ic_mock,
+                                 cfg_mock):
+        self.assertRaisesRegexp(SystemExit, '1', report.main,
+                                args=['-g', '--from-result', '/nonexistent'])
+        self.assertEqual(1, log_mock.error.call_count)
@@ -0,0 +1,95 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gzip
+import json
+import os
+import shutil
+import tempfile
+
+import mock
+from oslo_config import cfg
+
+from ahc_tools import snapshot
+from ahc_tools.test import base
+from ahc_tools import utils
+
+CONF = cfg.CONF
+
+
+class SnapshotBase(base.BaseTest):
+    def setUp(self):
+        super(SnapshotBase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'fleet.snapshot')
+        self.nodes = [
+            mock.Mock(uuid='uuid1', extra={'hardware_swift_object': 'obj1'},
+                      properties={'cpus': 4}, provision_state='manageable',
+                      maintenance=False, driver='pxe_ipmitool',
+                      instance_uuid=None),
+            mock.Mock(uuid='uuid2', extra={'hardware_swift_object': 'obj2'},
+                      properties={}, provision_state='manageable',
+                      maintenance=True, driver='pxe_ipmitool',
+                      instance_uuid=None)]
+        self.facts = [[('cpu', 'logical', 'number', '4'),
+                       ('system', 'product', 'uuid', 'uuid1')],
+                      None]
+
+
+class TestSaveLoad(SnapshotBase):
+    def test_round_trip(self):
+        snapshot.save(self.path, self.nodes, self.facts)
+        nodes, facts, errors = snapshot.load(self.path)
+
+        self.assertEqual(['uuid1', 'uuid2'], [node.uuid for node in nodes])
+        self.assertEqual({'hardware_swift_object': 'obj1'}, nodes[0].extra)
+        self.assertEqual({'cpus': 4}, nodes[0].properties)
+        self.assertTrue(nodes[1].maintenance)
+        self.assertEqual(self.facts, facts)
+        self.assertEqual(['uuid2'], list(errors))
+
+    def test_select(self):
+        snapshot.save(self.path, self.nodes, self.facts)
+        nodes, facts, errors = snapshot.load(
+            self.path, lambda node: node.maintenance)
+        self.assertEqual(['uuid2'], [node.uuid for node in nodes])
+        self.assertEqual([None], facts)
+
+    def test_no_temporary_file_left(self):
+        snapshot.save(self.path, self.nodes, self.facts)
+        self.assertEqual(['fleet.snapshot'], os.listdir(self.tmpdir))
+
+    def test_wrong_version(self):
+        with gzip.open(self.path, 'wb') as snapshot_file:
+            snapshot_file.write(json.dumps({'version': 0}).encode('utf-8'))
+        self.assertRaises(ValueError, snapshot.load, self.path)
+
+
+@mock.patch.object(snapshot.cfg, 'ConfigParser', autospec=True)
+@mock.patch.object(utils, 'stream_facts', autospec=True)
+@mock.patch.object(utils, 'get_ironic_client', autospec=True)
+@mock.patch.object(snapshot, 'LOG')
+class TestMain(SnapshotBase):
+    def test_main(self, log_mock, ic_mock, fetch_mock, cfg_mock):
+        ic_mock.return_value.node.list.return_value = self.nodes
+        fetch_mock.side_effect = lambda nodes: (list(nodes), self.facts,
+                                                {'uuid2': 'boom'})
+
+        snapshot.main(args=['--output', self.path])
+
+        ic_mock.return_value.node.list.assert_called_once_with(
+            limit=100, marker=None, fields=list(snapshot.NODE_FIELDS))
+        self.assertEqual(1, log_mock.error.call_count)
+        nodes, facts, errors = snapshot.load(self.path)
+        self.assertEqual(self.facts, facts)
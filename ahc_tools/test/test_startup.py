@@ -0,0 +1,30 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from ahc_tools.bench import startup
+from ahc_tools.test import base
+
+
+class TestStartup(base.BaseTest):
+    def test_no_heavy_imports(self):
+        # The tools run in new interpreters, this one already imported
+        # everything.
+        for name, tool, args in startup.COMMANDS:
+            seconds, modules = startup.run_command(tool, args)
+            self.assertEqual([], startup.heavy_modules(modules), name)
+
+    def test_heavy_modules(self):
+        self.assertEqual(['hardware.cardiff', 'pandas'],
+                         startup.heavy_modules(['pandas', 'json',
+                                                'hardware.cardiff',
+                                                'ahc_tools.report']))
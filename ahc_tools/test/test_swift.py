@@ -0,0 +1,148 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+
+import mock
+from oslo_config import cfg
+from swiftclient import client as swift_client
+from swiftclient import exceptions as swift_exceptions
+
+from ahc_tools.common import swift
+from ahc_tools import exc
+from ahc_tools.test import base
+
+CONF = cfg.CONF
+
+
+@mock.patch.object(swift_client, 'Connection', autospec=True)
+class TestSwiftAPI(base.BaseTest):
+    def test_conf_read_at_init(self, conn_mock):
+        CONF.set_override('username', 'ahc', 'swift')
+        CONF.set_override('os_auth_url', 'http://keystone:5000/v2.0',
+                          'swift')
+        swift.SwiftAPI()
+        kwargs = conn_mock.call_args[1]
+        self.assertEqual('ahc', kwargs['user'])
+        self.assertEqual('http://keystone:5000/v2.0', kwargs['authurl'])
+        self.assertIsNone(kwargs['preauthtoken'])
+
+    def test_get_object_not_modified(self, conn_mock):
+        conn_mock.return_value.get_object.side_effect = (
+            swift_exceptions.ClientException(
+                'Not Modified', http_status=304,
+                http_response_headers={'etag': 'abc'}))
+        swift_api = swift.SwiftAPI()
+        self.assertEqual(({'etag': 'abc'}, None),
+                         swift_api.get_object('obj',
+                                              headers={'If-None-Match': 'abc'},
+                                              resp_headers=True))
+        self.assertRaises(exc.SwiftDownloadError, swift_api.get_object,
+                          'obj', headers={'If-None-Match': 'abc'})
+
+
+@mock.patch.object(swift, 'SwiftAPI')
+class TestSwiftAPIPool(base.BaseTest):
+    def _hold_first_download(self, api_mock, pool):
+        """Start a download that keeps its connection until released."""
+        started = threading.Event()
+        release = threading.Event()
+
+        def blocking_get(object_name):
+            if object_name == 'slow':
+                started.set()
+                release.wait(5)
+            return 'facts'
+
+        api_mock.return_value.get_object.side_effect = blocking_get
+        thread = threading.Thread(target=pool.get_object, args=('slow',))
+        thread.start()
+        self.assertTrue(started.wait(5))
+        return thread, release
+
+    def test_connection_reused(self, api_mock):
+        pool = swift.SwiftAPIPool(size=2)
+        pool.get_object('obj1')
+        pool.get_object('obj2')
+        self.assertEqual(1, api_mock.call_count)
+        api_mock.return_value.get_object.assert_called_with('obj2')
+
+    def test_blocks_when_exhausted(self, api_mock):
+        pool = swift.SwiftAPIPool(size=1)
+        holder, release = self._hold_first_download(api_mock, pool)
+
+        done = threading.Event()
+        waiter = threading.Thread(
+            target=lambda: (pool.get_object('obj2'), done.set()))
+        waiter.start()
+        self.assertFalse(done.wait(0.2))
+
+        release.set()
+        holder.join(5)
+        waiter.join(5)
+        self.assertTrue(done.is_set())
+        self.assertEqual(1, api_mock.call_count)
+
+    def test_token_reused(self, api_mock):
+        api_mock.return_value.connection.url = 'http://swift/v1/AUTH_t'
+        api_mock.return_value.connection.token = 'token'
+        pool = swift.SwiftAPIPool(size=2)
+        pool.get_object('obj1')
+        holder, release = self._hold_first_download(api_mock, pool)
+        pool.get_object('obj2')
+        release.set()
+        holder.join(5)
+        self.assertEqual(2, api_mock.call_count)
+        api_mock.assert_called_with(preauthurl='http://swift/v1/AUTH_t',
+                                    preauthtoken='token')
+
+    def test_failed_connection_discarded(self, api_mock):
+        api_mock.return_value.connection.url = 'http://swift/v1/AUTH_t'
+        api_mock.return_value.connection.token = 'stale'
+        api_mock.return_value.get_object.side_effect = Exception('boom')
+        pool = swift.SwiftAPIPool(size=1)
+        self.assertRaises(Exception, pool.get_object, 'obj1')
+        self.assertRaises(Exception, pool.get_object, 'obj2')
+        self.assertEqual(2, api_mock.call_count)
+        # Nothing learnt from a failed request is used to authenticate.
+        api_mock.assert_called_with()
+
+    def test_chunked_object_holds_connection(self, api_mock):
+        api_mock.return_value.get_object.return_value = iter([b'[', b']'])
+        pool = swift.SwiftAPIPool(size=1)
+        chunks = pool.get_object('obj1', resp_chunk_size=1)
+        self.assertEqual([], pool._free)
+        self.assertEqual([b'[', b']'], list(chunks))
+        self.assertEqual([api_mock.return_value], pool._free)
+
+    def test_partly_read_object_discarded(self, api_mock):
+        api_mock.return_value.get_object.return_value = iter([b'[', b']'])
+        pool = swift.SwiftAPIPool(size=1)
+        chunks = pool.get_object('obj1', resp_chunk_size=1)
+        next(chunks)
+        chunks.close()
+        self.assertEqual([], pool._free)
+        pool.get_object('obj2')
+        self.assertEqual(2, api_mock.call_count)
+
+    def test_pool_size_from_conf(self, api_mock):
+        CONF.set_override('pool_size', 4, 'swift')
+        self.assertEqual(4, swift.SwiftAPIPool().size)
+
+    def test_invalid_pool_size(self, api_mock):
+        self.assertRaises(ValueError, swift.SwiftAPIPool, size=0)
+        self.assertRaises(ValueError, CONF.set_override, 'pool_size', 0,
+                          'swift')
+
+    def test_get_pool_shared(self, api_mock):
+        self.assertIs(swift.get_pool(), swift.get_pool())
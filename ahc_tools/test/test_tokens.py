@@ -0,0 +1,185 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import os
+import shutil
+import stat
+import tempfile
+import time
+
+from ironicclient import client as ironic_client
+from keystoneauth1 import exceptions as ks_exc
+from keystoneauth1.identity import generic
+import mock
+from oslo_config import cfg
+
+from ahc_tools.common import swift
+from ahc_tools.test import base
+from ahc_tools import tokens
+from ahc_tools import utils
+
+CONF = cfg.CONF
+
+CREDENTIALS = ('http://keystone:5000/v2.0', 'admin', 'secret', 'admin')
+
+IRONIC_URL = 'http://ironic:6385'
+
+SWIFT_URL = 'http://swift:8080/v1/AUTH_admin'
+
+
+def _entry(token='token1', lifetime=3600):
+    return {'token': token,
+            'expires': time.time() + lifetime,
+            'endpoints': {'baremetal': IRONIC_URL,
+                          'object-store': SWIFT_URL}}
+
+
+@mock.patch.object(tokens, '_authenticate', autospec=True)
+class TestTokenCache(base.BaseTest):
+    def setUp(self):
+        super(TestTokenCache, self).setUp()
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        self.path = os.path.join(self.cache_dir, 'ahc', 'tokens.json')
+
+    def test_shared_by_services(self, auth_mock):
+        auth_mock.return_value = _entry()
+        token_cache = tokens.TokenCache()
+        self.assertEqual((IRONIC_URL, 'token1'),
+                         token_cache.get_auth('baremetal', *CREDENTIALS))
+        self.assertEqual((SWIFT_URL, 'token1'),
+                         token_cache.get_auth('object-store', *CREDENTIALS))
+        auth_mock.assert_called_once_with(*CREDENTIALS)
+
+    def test_persisted(self, auth_mock):
+        auth_mock.return_value = _entry()
+        tokens.TokenCache(self.path).get_auth('baremetal', *CREDENTIALS)
+        self.assertEqual(0o600, stat.S_IMODE(os.stat(self.path).st_mode))
+        self.assertEqual(
+            0o700, stat.S_IMODE(os.stat(os.path.dirname(self.path)).st_mode))
+        with open(self.path) as token_file:
+            self.assertNotIn('secret', token_file.read())
+
+        token_cache = tokens.TokenCache(self.path)
+        self.assertEqual((SWIFT_URL, 'token1'),
+                         token_cache.get_auth('object-store', *CREDENTIALS))
+        self.assertEqual(1, auth_mock.call_count)
+        self.assertEqual(['tokens.json'],
+                         os.listdir(os.path.dirname(self.path)))
+
+    def test_expiring_token_refreshed(self, auth_mock):
+        auth_mock.side_effect = [
+            _entry(lifetime=tokens.EXPIRY_MARGIN - 1), _entry('token2')]
+        token_cache = tokens.TokenCache(self.path)
+        token_cache.get_auth('baremetal', *CREDENTIALS)
+        self.assertEqual((IRONIC_URL, 'token2'),
+                         token_cache.get_auth('baremetal', *CREDENTIALS))
+        self.assertEqual(2, auth_mock.call_count)
+
+    def test_refreshed_by_another_run(self, auth_mock):
+        auth_mock.side_effect = [_entry(lifetime=0), _entry('token2')]
+        token_cache = tokens.TokenCache(self.path)
+        token_cache.get_auth('baremetal', *CREDENTIALS)
+        tokens.TokenCache(self.path).get_auth('baremetal', *CREDENTIALS)
+        self.assertEqual((IRONIC_URL, 'token2'),
+                         token_cache.get_auth('baremetal', *CREDENTIALS))
+        self.assertEqual(2, auth_mock.call_count)
+
+    def test_forget(self, auth_mock):
+        auth_mock.side_effect = [_entry('token1'), _entry('token2')]
+        for path in (None, self.path):
+            token_cache = tokens.TokenCache(path)
+            token_cache.get_auth('baremetal', *CREDENTIALS)
+            token_cache.forget('token1')
+            self.assertEqual((IRONIC_URL, 'token2'),
+                             token_cache.get_auth('baremetal', *CREDENTIALS))
+            auth_mock.side_effect = [_entry('token1'), _entry('token2')]
+
+    def test_credentials_separated(self, auth_mock):
+        auth_mock.side_effect = [_entry('token1'), _entry('token2')]
+        token_cache = tokens.TokenCache(self.path)
+        token_cache.get_auth('baremetal', *CREDENTIALS)
+        other = CREDENTIALS[:2] + ('changed',) + CREDENTIALS[3:]
+        self.assertEqual((IRONIC_URL, 'token2'),
+                         token_cache.get_auth('baremetal', *other))
+
+    def test_service_not_in_catalog(self, auth_mock):
+        entry = _entry()
+        del entry['endpoints']['object-store']
+        auth_mock.return_value = entry
+        token_cache = tokens.TokenCache()
+        self.assertIsNone(token_cache.get_auth('object-store', *CREDENTIALS))
+        self.assertEqual((IRONIC_URL, 'token1'),
+                         token_cache.get_auth('baremetal', *CREDENTIALS))
+
+    def test_corrupted_file(self, auth_mock):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'w') as token_file:
+            token_file.write('{"truncated')
+        auth_mock.return_value = _entry()
+        self.assertEqual(
+            (IRONIC_URL, 'token1'),
+            tokens.TokenCache(self.path).get_auth('baremetal', *CREDENTIALS))
+
+
+class TestAuthenticate(base.BaseTest):
+    @mock.patch.object(generic.Password, 'get_access', autospec=True)
+    def test_authenticate(self, access_mock):
+        access = access_mock.return_value
+        access.auth_token = 'token1'
+        access.expires = datetime.datetime(2030, 1, 1, 12, 0)
+
+        def url_for(service_type, interface):
+            if service_type == 'baremetal':
+                return IRONIC_URL
+            raise ks_exc.EndpointNotFound()
+
+        access.service_catalog.url_for.side_effect = url_for
+        self.assertEqual({'token': 'token1',
+                          'expires': 1893499200,
+                          'endpoints': {'baremetal': IRONIC_URL}},
+                         tokens._authenticate(*CREDENTIALS))
+
+
+class TestGetAuth(base.BaseTest):
+    def test_no_credentials(self):
+        self.assertIsNone(tokens.get_auth('baremetal', '', '', '', ''))
+
+    @mock.patch.object(tokens, '_authenticate', autospec=True,
+                       side_effect=ks_exc.Unauthorized())
+    def test_failure(self, auth_mock):
+        self.assertIsNone(tokens.get_auth('baremetal', *CREDENTIALS))
+
+    @mock.patch.object(tokens, '_authenticate', autospec=True)
+    def test_clients(self, auth_mock):
+        auth_mock.return_value = _entry()
+        for group in ('ironic', 'swift'):
+            prefix = 'os_' if group == 'ironic' else ''
+            CONF.set_override('os_auth_url', CREDENTIALS[0], group)
+            CONF.set_override(prefix + 'username', CREDENTIALS[1], group)
+            CONF.set_override(prefix + 'password', CREDENTIALS[2], group)
+            CONF.set_override(prefix + 'tenant_name', CREDENTIALS[3], group)
+
+        with mock.patch.object(ironic_client, 'get_client',
+                               autospec=True) as client_mock:
+            utils.get_ironic_client()
+        client_mock.assert_called_once_with(
+            1, ironic_url=IRONIC_URL, os_auth_token='token1',
+            os_ironic_api_version=utils.LIST_API_VERSION)
+
+        with mock.patch.object(swift, 'SwiftAPI') as api_mock:
+            swift.SwiftAPIPool(size=1).get_object('obj1')
+        api_mock.assert_called_once_with(preauthurl=SWIFT_URL,
+                                         preauthtoken='token1')
+        auth_mock.assert_called_once_with(*CREDENTIALS)
@@ -12,22 +12,37 @@
 # limitations under the License.
 
 import json
+import shutil
+import sys
+import tempfile
+import threading
+import zlib
 
+from ironicclient import client as ironic_client
+from ironicclient import exc as ironic_exc
 from ironicclient.exc import AmbiguousAuthSystem
 import mock
 
+from ahc_tools import cache
+from ahc_tools import exc
 from ahc_tools.test import base
 from ahc_tools import utils
 
 
+def _gzip(blob):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(blob) + compressor.flush()
+
+
 class TestGetFacts(base.BaseTest):
-    @mock.patch.object(utils.swift, 'SwiftAPI', autospec=True)
-    @mock.patch.object(utils, 'reload_module', autospec=True)
-    def test_facts(self, rm_mock, swift_mock):
-        swift_conn = swift_mock.return_value
+    @mock.patch.object(utils.swift, 'get_pool', autospec=True)
+    def test_facts(self, pool_mock):
+        swift_conn = pool_mock.return_value
         obj = json.dumps([[u'cpu', u'logical_0', u'bogomips', u'4199.99'],
                           [u'cpu', u'logical_0', u'cache_size', u'4096KB']])
-        swift_conn.get_object.return_value = obj
+        # Cut the blob in the middle of a fact, as Swift would.
+        swift_conn.get_object.return_value = (
+            {'etag': 'abc'}, [obj[:30].encode(), obj[30:].encode()])
         name = 'extra_hardware-UUID1'
         node = mock.Mock(extra={'hardware_swift_object': name})
         expected = [(u'cpu', u'logical_0', u'bogomips', u'4199.99'),
@@ -35,7 +50,30 @@ class TestGetFacts(base.BaseTest):
 
         facts = utils.get_facts(node)
         self.assertEqual(expected, facts)
-        swift_conn.get_object.assert_called_once_with(name)
+        swift_conn.get_object.assert_called_once_with(
+            name,
+            headers={'Accept-Encoding':
+                     utils.facts_parser.accepted_encodings()},
+            resp_headers=True, resp_chunk_size=utils.FACTS_CHUNK_SIZE)
+
+    @mock.patch.object(utils.swift, 'get_pool', autospec=True)
+    def test_metrics(self, pool_mock):
+        blob = json.dumps([['cpu', 'logical', 'number', '4']]).encode()
+        pool_mock.return_value.get_object.return_value = ({}, [blob])
+        node = mock.Mock(uuid='uuid1',
+                         extra={'hardware_swift_object': 'name'})
+
+        utils.metrics.enable()
+        utils.get_facts(node)
+
+        summary = utils.metrics.get_metrics().summary()
+        self.assertEqual(set(['swift_request', 'swift_download',
+                              'facts_decode']),
+                         set(summary['phases']))
+        self.assertEqual(len(blob),
+                         summary['phases']['swift_download']['bytes'])
+        self.assertEqual(len(blob),
+                         summary['nodes']['uuid1']['swift_download']['bytes'])
 
     def test_no_facts(self):
         node = mock.Mock(extra={})
@@ -45,7 +83,212 @@ class TestGetFacts(base.BaseTest):
                                 utils.get_facts, node)
 
 
-@mock.patch.object(utils.client, 'get_client', autospec=True,
+@mock.patch.object(utils.swift, 'get_pool', autospec=True)
+class TestFactsCache(base.BaseTest):
+    def setUp(self):
+        super(TestFactsCache, self).setUp()
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        utils.CONF.set_override('directory', self.cache_dir, 'cache')
+        self.name = 'extra_hardware-UUID1'
+        self.blob = json.dumps([['cpu', 'logical', 'number', '4']])
+        self.expected = [('cpu', 'logical', 'number', '4')]
+
+    def test_stored_and_revalidated(self, pool_mock):
+        swift_conn = pool_mock.return_value
+        swift_conn.get_object.return_value = ({'etag': 'abc'}, [self.blob])
+        self.assertEqual(self.expected, utils._get_swift_facts(self.name))
+
+        swift_conn.get_object.return_value = ({'etag': 'abc'}, None)
+        self.assertEqual(self.expected, utils._get_swift_facts(self.name))
+        swift_conn.get_object.assert_called_with(
+            self.name,
+            headers={'Accept-Encoding':
+                     utils.facts_parser.accepted_encodings(),
+                     'If-None-Match': 'abc'},
+            resp_headers=True, resp_chunk_size=utils.FACTS_CHUNK_SIZE)
+
+    def test_compressed(self, pool_mock):
+        blob = _gzip(self.blob.encode('utf-8'))
+        swift_conn = pool_mock.return_value
+        swift_conn.get_object.return_value = (
+            {'etag': 'abc', 'content-encoding': 'gzip'},
+            [blob[:5], blob[5:]])
+        self.assertEqual(self.expected, utils._get_swift_facts(self.name))
+        self.assertEqual(('abc', blob), cache.get_cache().get(self.name))
+
+        # The cached blob stays compressed.
+        utils.CONF.set_override('offline', True)
+        self.assertEqual(self.expected, utils._get_swift_facts(self.name))
+
+    def test_offline(self, pool_mock):
+        swift_conn = pool_mock.return_value
+        swift_conn.get_object.return_value = ({'etag': 'abc'}, [self.blob])
+        utils._get_swift_facts(self.name)
+
+        utils.CONF.set_override('offline', True)
+        swift_conn.reset_mock()
+        self.assertEqual(self.expected, utils._get_swift_facts(self.name))
+        self.assertFalse(swift_conn.get_object.called)
+        self.assertRaises(exc.FactsNotCachedError,
+                          utils._get_swift_facts, 'extra_hardware-UUID2')
+
+
+@mock.patch.object(utils, 'get_facts', autospec=True)
+class TestFetchFacts(base.BaseTest):
+    def test_node_order_kept(self, facts_mock):
+        nodes = [mock.Mock(uuid='uuid%d' % i) for i in range(20)]
+        facts_mock.side_effect = lambda node: [('system', 'product',
+                                                'uuid', node.uuid)]
+        facts, errors = utils.fetch_facts(nodes, concurrency=4)
+        self.assertEqual({}, errors)
+        self.assertEqual([node.uuid for node in nodes],
+                         [node_facts[0][3] for node_facts in facts])
+
+    def test_failures_isolated(self, facts_mock):
+        nodes = [mock.Mock(uuid='uuid1'), mock.Mock(uuid='uuid2'),
+                 mock.Mock(uuid='uuid3')]
+
+        def get_facts(node):
+            if node.uuid == 'uuid1':
+                raise exc.SwiftDownloadError('boom', 'obj1')
+            if node.uuid == 'uuid2':
+                sys.exit('never introspected\n')
+            return [('cpu', 'logical', 'number', '4')]
+
+        facts_mock.side_effect = get_facts
+        facts, errors = utils.fetch_facts(nodes)
+        self.assertEqual([None, None, [('cpu', 'logical', 'number', '4')]],
+                         facts)
+        self.assertIn('obj1', errors['uuid1'])
+        self.assertEqual('never introspected', errors['uuid2'])
+        self.assertNotIn('uuid3', errors)
+
+    def test_no_nodes(self, facts_mock):
+        self.assertEqual(([], {}), utils.fetch_facts([]))
+        self.assertEqual(([], [], {}), utils.stream_facts(iter([])))
+
+    def test_downloads_overlap_listing(self, facts_mock):
+        nodes = [mock.Mock(uuid='uuid1'), mock.Mock(uuid='uuid2')]
+        first_downloaded = threading.Event()
+
+        def list_nodes():
+            yield nodes[0]
+            # The second page is only listed once the facts of the first
+            # node were downloaded.
+            self.assertTrue(first_downloaded.wait(5))
+            yield nodes[1]
+
+        def get_facts(node):
+            first_downloaded.set()
+            return [('system', 'product', 'uuid', node.uuid)]
+
+        facts_mock.side_effect = get_facts
+        listed, facts, errors = utils.stream_facts(list_nodes())
+        self.assertEqual(nodes, listed)
+        self.assertEqual(['uuid1', 'uuid2'],
+                         [node_facts[0][3] for node_facts in facts])
+
+
+class TestListNodes(base.BaseTest):
+    def setUp(self):
+        super(TestListNodes, self).setUp()
+        self.client = mock.Mock()
+        self.node1 = mock.Mock(uuid='uuid1', provision_state='manageable',
+                               maintenance=False, driver='pxe_ipmitool',
+                               instance_uuid=None,
+                               extra={'hardware_swift_object': 'obj1'})
+        self.node2 = mock.Mock(uuid='uuid2', provision_state='active',
+                               maintenance=False, driver='pxe_ipmitool',
+                               instance_uuid='instance',
+                               extra={'hardware_swift_object': 'obj2'})
+
+    def test_filters_in_query(self):
+        utils.CONF.set_override('provision_state', 'manageable')
+        utils.CONF.set_override('maintenance', False)
+        self.client.node.list.return_value = [self.node1]
+
+        self.assertEqual([self.node1], list(utils.list_nodes(self.client)))
+        self.client.node.list.assert_called_once_with(
+            limit=100, marker=None, fields=['uuid', 'extra', 'properties'],
+            provision_state='manageable', maintenance=False)
+
+    def test_no_filters(self):
+        self.client.node.list.return_value = [self.node1, self.node2]
+        self.assertEqual([self.node1, self.node2],
+                         list(utils.list_nodes(self.client)))
+        self.client.node.list.assert_called_once_with(
+            limit=100, marker=None, fields=['uuid', 'extra', 'properties'])
+
+    def test_pages(self):
+        utils.CONF.set_override('list_page_size', 2, 'ironic')
+        node3 = mock.Mock(uuid='uuid3',
+                          extra={'hardware_swift_object': 'obj3'})
+        self.client.node.list.side_effect = [[self.node1, self.node2],
+                                             [node3]]
+        self.assertEqual([self.node1, self.node2, node3],
+                         list(utils.list_nodes(self.client, ['uuid',
+                                                             'extra'])))
+        self.client.node.list.assert_has_calls([
+            mock.call(limit=2, marker=None, fields=['uuid', 'extra']),
+            mock.call(limit=2, marker='uuid2', fields=['uuid', 'extra'])])
+
+    @mock.patch.object(utils, 'LOG')
+    def test_version_rejected(self, log_mock):
+        utils.CONF.set_override('provision_state', 'manageable')
+        self.client.node.list.side_effect = [
+            ironic_exc.UnsupportedVersion(), [self.node1, self.node2]]
+
+        self.assertEqual([self.node1], list(utils.list_nodes(self.client)))
+        self.client.node.list.assert_called_with(detail=True, limit=0)
+        self.assertEqual(utils.BASE_API_VERSION,
+                         self.client.http_client.os_ironic_api_version)
+        self.assertEqual(1, log_mock.warning.call_count)
+
+    def test_version_rejected_on_next_page(self):
+        utils.CONF.set_override('list_page_size', 2, 'ironic')
+        self.client.node.list.side_effect = [[self.node1, self.node2],
+                                             ironic_exc.NotAcceptable()]
+        self.assertRaises(ironic_exc.NotAcceptable, list,
+                          utils.list_nodes(self.client))
+
+    def test_api_version(self):
+        self.assertEqual(utils.LIST_API_VERSION, utils.ironic_api_version())
+        utils.CONF.set_override('provision_state', 'manageable')
+        self.assertEqual('1.9', utils.ironic_api_version())
+        utils.CONF.set_override('driver', 'pxe_ipmitool')
+        self.assertEqual('1.16', utils.ironic_api_version())
+        utils.CONF.set_override('node', ['uuid1'])
+        self.assertIsNone(utils.ironic_api_version())
+
+    @mock.patch.object(utils, 'LOG')
+    def test_not_introspected_skipped(self, log_mock):
+        self.node2.extra = {}
+        self.client.node.list.return_value = [self.node1, self.node2]
+        self.assertEqual([self.node1], list(utils.list_nodes(self.client)))
+        self.assertEqual(1, log_mock.warning.call_count)
+
+    def test_nodes_by_uuid(self):
+        utils.CONF.set_override('node', ['uuid1', 'uuid2'])
+        utils.CONF.set_override('associated', False)
+        self.client.node.get.side_effect = [self.node1, self.node2]
+
+        self.assertEqual([self.node1], list(utils.list_nodes(self.client)))
+        self.assertFalse(self.client.node.list.called)
+        self.client.node.get.assert_has_calls([mock.call('uuid1'),
+                                               mock.call('uuid2')])
+
+    def test_node_selected(self):
+        self.assertTrue(utils.node_selected(self.node2))
+        utils.CONF.set_override('driver', 'pxe_ipmitool')
+        utils.CONF.set_override('associated', True)
+        self.assertTrue(utils.node_selected(self.node2))
+        self.assertFalse(utils.node_selected(self.node1))
+        utils.CONF.set_override('node', ['uuid1'])
+        self.assertFalse(utils.node_selected(self.node2))
+
+
+@mock.patch.object(ironic_client, 'get_client', autospec=True,
                    side_effect=AmbiguousAuthSystem)
 class TestGetIronicClient(base.BaseTest):
     def test_no_credentials(self, ic_mock):
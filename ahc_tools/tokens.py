@@ -0,0 +1,224 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import calendar
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from oslo_config import cfg
+
+from ahc_tools import conf  # noqa
+from ahc_tools import metrics
+
+CONF = cfg.CONF
+
+LOG = logging.getLogger('ahc_tools.tokens')
+
+# Number of seconds before its expiry a token stops being used, so that
+# it does not expire in the middle of a run.
+EXPIRY_MARGIN = 300
+
+# Services whose endpoint is kept with the token.
+SERVICE_TYPES = ('baremetal', 'object-store')
+
+
+class TokenCache(object):
+    """Keystone tokens and service endpoints, by credentials.
+
+    The tokens are shared by all the clients of a process using the same
+    credentials, and with a path they are also stored on disk for the
+    next runs. The file maps a hash of the credentials to the token, its
+    expiry time and the endpoints of SERVICE_TYPES. It is only readable by
+    its owner and is replaced atomically, so runs using it at the same
+    time never read a partial file.
+    """
+
+    def __init__(self, path=None):
+        """Constructor for creating a TokenCache object.
+
+        :param path: file storing the tokens between runs, None to only
+            keep them in memory
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = self._read()
+
+    def get_auth(self, service_type, auth_url, username, password,
+                 tenant_name):
+        """Return the (endpoint, token) of a service for the credentials.
+
+        A new token is only requested from Keystone when there is no
+        cached one expiring in more than EXPIRY_MARGIN seconds, or when
+        its endpoints lack the service.
+
+        :returns: an (endpoint, token) tuple, or None if the service is
+            not in the catalog of Keystone.
+        """
+        key = _key(auth_url, username, password, tenant_name)
+        with self._lock:
+            entry = self._entries.get(key)
+            if not _usable(entry, service_type):
+                # Another run may have stored a newer token.
+                self._entries = self._read()
+                entry = self._entries.get(key)
+            if not _usable(entry, service_type):
+                entry = _authenticate(auth_url, username, password,
+                                      tenant_name)
+                self._entries = dict(
+                    (other_key, other) for other_key, other
+                    in self._entries.items() if _usable(other))
+                self._entries[key] = entry
+                self._write()
+        endpoint = entry['endpoints'].get(service_type)
+        if not endpoint:
+            return None
+        return endpoint, entry['token']
+
+    def forget(self, token):
+        """Drop a token Keystone or a service rejected.
+
+        The next get_auth with the same credentials requests a new token.
+        """
+        with self._lock:
+            # Another run may have stored other tokens meanwhile.
+            entries = self._read() if self.path else self._entries
+            self._entries = dict(
+                (key, entry) for key, entry in entries.items()
+                if isinstance(entry, dict) and entry.get('token') != token)
+            self._write()
+
+    def _read(self):
+        if not self.path:
+            return {}
+        try:
+            with open(self.path) as token_file:
+                entries = json.load(token_file)
+        except (IOError, OSError, ValueError):
+            return {}
+        return entries if isinstance(entries, dict) else {}
+
+    def _write(self):
+        if not self.path:
+            return
+        directory = os.path.dirname(self.path) or '.'
+        tmp_path = None
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory, 0o700)
+            # mkstemp creates the file readable by its owner only.
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            with os.fdopen(fd, 'w') as token_file:
+                json.dump(self._entries, token_file)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as e:
+            LOG.warning('Failed to store the Keystone tokens in %s: %s' %
+                        (self.path, e))
+            if tmp_path and os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+
+def _key(auth_url, username, password, tenant_name):
+    # The password is part of the key, so that changing it in the
+    # configuration does not reuse the token of the previous one.
+    credentials = '\0'.join((auth_url, username, password, tenant_name))
+    return hashlib.sha256(credentials.encode('utf-8')).hexdigest()
+
+
+def _usable(entry, service_type=None):
+    if not isinstance(entry, dict):
+        return False
+    try:
+        if entry['expires'] - EXPIRY_MARGIN <= time.time():
+            return False
+        return service_type is None or service_type in entry['endpoints']
+    except (KeyError, TypeError):
+        return False
+
+
+def _authenticate(auth_url, username, password, tenant_name):
+    """Request a token from Keystone, return its cache entry."""
+    # keystoneauth1 is imported on first use, like the clients.
+    from keystoneauth1 import exceptions as ks_exc
+    from keystoneauth1.identity import generic
+    from keystoneauth1 import session
+
+    auth = generic.Password(auth_url=auth_url,
+                            username=username,
+                            password=password,
+                            project_name=tenant_name,
+                            user_domain_id='default',
+                            project_domain_id='default')
+    with metrics.timed('keystone_auth'):
+        access = auth.get_access(session.Session())
+
+    endpoints = {}
+    for service_type in SERVICE_TYPES:
+        try:
+            endpoints[service_type] = access.service_catalog.url_for(
+                service_type=service_type, interface='public')
+        except ks_exc.EndpointNotFound:
+            pass
+    return {'token': access.auth_token,
+            'expires': calendar.timegm(access.expires.utctimetuple()),
+            'endpoints': endpoints}
+
+
+def get_auth(service_type, auth_url, username, password, tenant_name):
+    """Return the (endpoint, token) of a service from the process cache.
+
+    :returns: an (endpoint, token) tuple, or None if the credentials are
+        not configured or no token could be obtained, the client then
+        authenticating itself.
+    """
+    if not (auth_url and username and password):
+        return None
+    try:
+        return get_token_cache().get_auth(service_type, auth_url, username,
+                                          password, tenant_name)
+    except Exception as e:
+        LOG.warning('Failed to get a Keystone token for %s, the client '
+                    'authenticates itself: %s' % (service_type, e))
+        return None
+
+
+def forget_token(token):
+    """Drop a rejected token from the process-wide TokenCache."""
+    try:
+        get_token_cache().forget(token)
+    except Exception as e:
+        LOG.warning('Failed to drop a Keystone token: %s' % e)
+
+
+_TOKEN_CACHE = None
+_TOKEN_CACHE_LOCK = threading.Lock()
+
+
+def get_token_cache():
+    """Return the process-wide TokenCache."""
+    global _TOKEN_CACHE
+    with _TOKEN_CACHE_LOCK:
+        if _TOKEN_CACHE is None:
+            _TOKEN_CACHE = TokenCache(CONF.cache.token_file or None)
+        return _TOKEN_CACHE
+
+
+def reset_token_cache():
+    """Drop the process-wide TokenCache."""
+    global _TOKEN_CACHE
+    with _TOKEN_CACHE_LOCK:
+        _TOKEN_CACHE = None
@@ -11,21 +11,40 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import json
 import logging
+from multiprocessing import pool as mp_pool
 import sys
 
-from ironicclient import client
-from ironicclient.exc import AmbiguousAuthSystem
 from oslo_config import cfg
-from six.moves import reload_module
+import six
 
+from ahc_tools import cache
 from ahc_tools.common import swift
+from ahc_tools import exc
+from ahc_tools import facts_parser
+from ahc_tools import metrics
+from ahc_tools import tokens
 
 DEFAULT_CONF_FILES = ['/etc/ahc-tools/ahc-tools.conf']
 
 CONF = cfg.CONF
 
+LOG = logging.getLogger('ahc_tools.utils')
+
+# Size of the chunks in which the facts are read from Swift.
+FACTS_CHUNK_SIZE = 64 * 1024
+
+# Node fields the tools read, the only ones requested when listing nodes.
+LIST_FIELDS = ('uuid', 'extra', 'properties')
+
+# Ironic API version with the fields projection of the node list, and the
+# versions of the node filters needing a newer one.
+LIST_API_VERSION = '1.8'
+FILTER_API_VERSIONS = {'provision_state': '1.9', 'driver': '1.16'}
+
+# Ironic API version of the servers rejecting LIST_API_VERSION.
+BASE_API_VERSION = '1.1'
+
 
 def get_facts(node):
     """Get the facts stored on the Ironic DB"""
@@ -39,26 +58,282 @@ def get_facts(node):
                    "running this tool.\n")
         sys.exit(err_msg)
 
-    return _get_swift_facts(object_name)
+    with metrics.node(node.uuid):
+        return _get_swift_facts(object_name)
+
+
+def node_filters():
+    """Return the node filters of the command line as node.list kwargs."""
+    filters = {}
+    for name in ('provision_state', 'maintenance', 'associated', 'driver'):
+        if CONF[name] is not None:
+            filters[name] = CONF[name]
+    return filters
+
+
+def node_selected(node):
+    """Whether a node passes the node filters of the command line."""
+    if CONF.node and node.uuid not in CONF.node:
+        return False
+    filters = node_filters()
+    associated = filters.pop('associated', None)
+    if (associated is not None and
+            bool(getattr(node, 'instance_uuid', None)) != associated):
+        return False
+    return all(getattr(node, name, None) == value
+               for name, value in filters.items())
+
+
+def list_nodes(ironic_client, fields=LIST_FIELDS):
+    """Iterate over the nodes selected by the node filters.
+
+    The nodes are listed page by page, [ironic]/list_page_size at a time,
+    and only with the given fields. The filters are part of the Ironic
+    query, and the nodes given with --node are fetched one by one instead
+    of listing all of them. Nodes that were never introspected are left
+    out, with a warning, so that no facts download is attempted for them.
+
+    :param ironic_client: Ironic client instance
+    :param fields: node fields to request, they must include uuid and
+        extra
+    """
+    for node in _query_nodes(ironic_client, fields):
+        if node.extra.get('hardware_swift_object'):
+            yield node
+        else:
+            LOG.warning('Node %s was never introspected, it is skipped.' %
+                        node.uuid)
+
+
+def _query_nodes(ironic_client, fields):
+    if CONF.node:
+        for uuid in CONF.node:
+            # All the fields are needed to apply the filters.
+            node = ironic_client.node.get(uuid)
+            if node_selected(node):
+                yield node
+        return
+
+    from ironicclient import exc as ironic_exc
+
+    page_size = CONF.ironic.list_page_size
+    marker = None
+    while True:
+        try:
+            with metrics.timed('node_list'):
+                page = ironic_client.node.list(limit=page_size,
+                                               marker=marker,
+                                               fields=list(fields),
+                                               **node_filters())
+        except (ironic_exc.UnsupportedVersion,
+                ironic_exc.NotAcceptable) as e:
+            if marker is not None:
+                raise
+            LOG.warning('Ironic rejected the node list with API version '
+                        '%s, listing all the nodes at once: %s' %
+                        (ironic_api_version(), e))
+            for node in _list_all_nodes(ironic_client):
+                yield node
+            return
+        for node in page:
+            yield node
+        if len(page) < page_size:
+            return
+        marker = page[-1].uuid
+
+
+def _list_all_nodes(ironic_client):
+    # The base version has neither the fields projection nor all the
+    # filters, the nodes are filtered here instead. The client keeps it
+    # for the updates, which do not need a newer one.
+    ironic_client.http_client.os_ironic_api_version = BASE_API_VERSION
+    with metrics.timed('node_list'):
+        nodes = ironic_client.node.list(detail=True, limit=0)
+    return [node for node in nodes if node_selected(node)]
+
+
+def ironic_api_version():
+    """Return the Ironic API version the node list needs, or None.
+
+    This is the version of the fields projection, or of the newest node
+    filter given on the command line. Nodes given with --node are fetched
+    one by one, which needs no particular version.
+    """
+    if CONF.node:
+        return None
+    versions = [LIST_API_VERSION] + [FILTER_API_VERSIONS[name]
+                                     for name in node_filters()
+                                     if name in FILTER_API_VERSIONS]
+    return max(versions,
+               key=lambda version: tuple(map(int, version.split('.'))))
+
+
+def fetch_facts(nodes, concurrency=None):
+    """Download the facts of several nodes concurrently.
+
+    See stream_facts, which this calls.
+
+    :returns: a (facts, errors) tuple. facts has one entry per node, in
+        the order of ``nodes``, which is None if the download failed.
+        errors maps the uuid of each failed node to its error message.
+    """
+    nodes, facts, errors = stream_facts(nodes, concurrency)
+    return facts, errors
+
+
+def stream_facts(nodes, concurrency=None):
+    """Download the facts of nodes while they are being produced.
+
+    The download of the facts of a node starts as soon as the node is
+    read from ``nodes``, so with list_nodes the first downloads overlap
+    the listing of the next pages. At most ``concurrency`` downloads,
+    [swift]/concurrency by default, run at the same time. A failure only
+    affects the node it happened on.
+
+    :param nodes: iterable of Ironic nodes
+    :param concurrency: maximum number of concurrent downloads
+    :returns: a (nodes, facts, errors) tuple. nodes is the list of the
+        nodes read from ``nodes``. facts has one entry per node, in the
+        same order, which is None if the download failed. errors maps the
+        uuid of each failed node to its error message.
+    """
+    workers = concurrency or CONF.swift.concurrency
+    if isinstance(nodes, (list, tuple)):
+        if not nodes:
+            return [], [], {}
+        workers = min(workers, len(nodes))
+
+    listed = []
+    pending = []
+    thread_pool = mp_pool.ThreadPool(workers)
+    try:
+        for node in nodes:
+            listed.append(node)
+            pending.append(thread_pool.apply_async(fetch_node_facts,
+                                                   (node,)))
+        results = [result.get() for result in pending]
+    finally:
+        thread_pool.close()
+        thread_pool.join()
+
+    facts = []
+    errors = {}
+    for node, (node_facts, error) in zip(listed, results):
+        facts.append(node_facts)
+        if error is not None:
+            errors[node.uuid] = error
+    return listed, facts, errors
+
+
+def fetch_node_facts(node):
+    """Return a (facts, error) tuple, facts is None if get_facts failed."""
+    try:
+        return get_facts(node), None
+    # get_facts exits when the node was never introspected, which must not
+    # stop the downloads running in the other threads.
+    except (Exception, SystemExit) as e:
+        return None, str(e).strip()
 
 
 def _get_swift_facts(object_name):
-    reload_module(sys.modules['ahc_tools.common.swift'])
-    swift_api = swift.SwiftAPI()
-    facts_blob = json.loads(swift_api.get_object(object_name))
-    facts = [tuple(fact) for fact in facts_blob]
-    return facts
-
-
-def get_ironic_client():
-    """Get Ironic client instance."""
-    kwargs = {'os_password': CONF.ironic.os_password,
-              'os_username': CONF.ironic.os_username,
-              'os_tenant_name': CONF.ironic.os_tenant_name,
-              'os_auth_url': CONF.ironic.os_auth_url}
+    # The facts are decoded while they are downloaded, straight into
+    # tuples, instead of decoding the whole blob into lists first.
+    with metrics.timed('facts_decode'):
+        encoding, chunks = _get_facts_chunks(object_name)
+        return list(facts_parser.iter_facts(
+            facts_parser.decompress_chunks(chunks, encoding)))
+
+
+def _get_facts_chunks(object_name):
+    """Get the chunks of the facts blob from the local cache or from Swift.
+
+    A cached blob is revalidated against Swift with its ETag and only
+    downloaded again when it changed. In offline mode Swift is not used.
+    The blob is transferred and cached compressed when Swift, or a proxy
+    in front of it, compresses it.
+
+    :returns: an (encoding, chunks) tuple, encoding being the
+        Content-Encoding of the download, None for a cached blob.
+    """
+    facts_cache = cache.get_cache()
+    cached = facts_cache.get(object_name) if facts_cache else None
+
+    if CONF.offline:
+        if cached is None:
+            raise exc.FactsNotCachedError(object_name)
+        return None, [cached[1]]
+
+    headers = {'Accept-Encoding': facts_parser.accepted_encodings()}
+    if cached:
+        headers['If-None-Match'] = cached[0]
+    with metrics.timed('swift_request'):
+        resp_headers, chunks = swift.get_pool().get_object(
+            object_name, headers=headers, resp_headers=True,
+            resp_chunk_size=FACTS_CHUNK_SIZE)
+    if chunks is None:
+        return None, [cached[1]]
+    chunks = metrics.timed_chunks('swift_download', chunks)
+
+    encoding = resp_headers.get('content-encoding')
+    etag = resp_headers.get('etag')
+    if facts_cache and etag:
+        return encoding, _cache_chunks(facts_cache, object_name, etag,
+                                       chunks)
+    return encoding, chunks
+
+
+def _cache_chunks(facts_cache, object_name, etag, chunks):
+    """Yield the chunks and cache the blob once all of them were read."""
+    blob = []
+    for chunk in chunks:
+        if isinstance(chunk, six.text_type):
+            chunk = chunk.encode('utf-8')
+        blob.append(chunk)
+        yield chunk
+    facts_cache.put(object_name, etag, b''.join(blob))
+
+
+def get_ironic_auth():
+    """Return the (endpoint, token) of Ironic from the token cache.
+
+    :returns: an (endpoint, token) tuple, or None if the client has to
+        authenticate itself, see tokens.get_auth.
+    """
+    return tokens.get_auth('baremetal', CONF.ironic.os_auth_url,
+                           CONF.ironic.os_username, CONF.ironic.os_password,
+                           CONF.ironic.os_tenant_name)
+
+
+def get_ironic_client(auth=None):
+    """Get Ironic client instance.
+
+    A client created with a cached token cannot authenticate again once
+    the token expires, a new client has to be created with the next token.
+
+    :param auth: (endpoint, token) tuple returned by get_ironic_auth,
+        looked up when not given
+    """
+    # ironicclient takes most of the start up time of the tools, it is
+    # only imported once a client is actually needed.
+    from ironicclient import client
+    from ironicclient import exc as ironic_exc
+
+    auth = auth or get_ironic_auth()
+    if auth:
+        # With a token and an endpoint, the client skips Keystone.
+        kwargs = {'ironic_url': auth[0],
+                  'os_auth_token': auth[1]}
+    else:
+        kwargs = {'os_password': CONF.ironic.os_password,
+                  'os_username': CONF.ironic.os_username,
+                  'os_tenant_name': CONF.ironic.os_tenant_name,
+                  'os_auth_url': CONF.ironic.os_auth_url}
+    api_version = ironic_api_version()
+    if api_version:
+        kwargs['os_ironic_api_version'] = api_version
     try:
         ironic = client.get_client(1, **kwargs)
-    except AmbiguousAuthSystem:
+    except ironic_exc.AmbiguousAuthSystem:
         err_msg = ("Some credentials are missing from the [ironic] section of "
                    "the configuration. The following configuration files were "
                    "searched: (%s)." % ', '.join(CONF.config_file))